@@ -0,0 +1,86 @@
+"""Benchmark per-query overhead of the hot queries: python bench_queries.py [username] [iterations]
+
+Runs every statement in main.QUERIES through a plain cursor (text protocol,
+parsed by the server on every call) and through StatementCache (prepared
+once, then executed with the binary protocol), and prints the mean time per
+call. The inserts are rolled back at the end.
+"""
+import sys
+import time
+from datetime import datetime
+
+import mysql.connector
+
+from main import DB_CONFIG, FX_BASE_CURRENCY, QUERIES, StatementCache
+
+
+def query_params(user_id, username, category_id):
+    return {
+        "user_by_username": (username,),
+        "month_total": (FX_BASE_CURRENCY, user_id),
+        "budget_total": (user_id,),
+        "month_expenses_by_category": (FX_BASE_CURRENCY, user_id),
+        "recent_transactions": (user_id,),
+        "insert_transaction": (user_id, 1.0, FX_BASE_CURRENCY, category_id, "Expense",
+                               datetime.now().date(), "bench_queries"),
+        "data_version": (user_id,),
+    }
+
+
+def time_text(connection, name, params, iterations):
+    cursor = connection.cursor()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        cursor.execute(QUERIES[name], params)
+        if cursor.with_rows:
+            cursor.fetchall()
+    elapsed = time.perf_counter() - started
+    cursor.close()
+    return elapsed / iterations
+
+
+def time_prepared(connection, name, params, iterations):
+    statements = StatementCache(connection)
+    statements.execute(name, params)  # prepare outside the timed loop, as the app does once
+    if statements.cursor(name).with_rows:
+        statements.cursor(name).fetchall()
+    started = time.perf_counter()
+    for _ in range(iterations):
+        cursor = statements.execute(name, params)
+        if cursor.with_rows:
+            cursor.fetchall()
+    elapsed = time.perf_counter() - started
+    statements.close()
+    return elapsed / iterations
+
+
+def main():
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 2000
+    connection = mysql.connector.connect(**DB_CONFIG)
+    cursor = connection.cursor()
+    if len(sys.argv) > 1:
+        cursor.execute("SELECT id, username FROM users WHERE username = %s", (sys.argv[1],))
+    else:
+        cursor.execute("SELECT id, username FROM users ORDER BY id LIMIT 1")
+    user = cursor.fetchone()
+    cursor.execute("SELECT id FROM categories WHERE user_id = 0 AND name = 'Utilities'")
+    category = cursor.fetchone()
+    cursor.close()
+    if user is None or category is None:
+        sys.exit("No such user; sign up in the app first")
+
+    params = query_params(*user, category[0])
+    print(f"{'query':<30}{'text (us)':>12}{'prepared (us)':>16}{'change':>10}")
+    try:
+        for name in QUERIES:
+            text = time_text(connection, name, params[name], iterations)
+            prepared = time_prepared(connection, name, params[name], iterations)
+            print(f"{name:<30}{text * 1e6:>12.0f}{prepared * 1e6:>16.0f}"
+                  f"{(prepared - text) / text:>+10.0%}")
+    finally:
+        connection.rollback()
+        connection.close()
+
+
+if __name__ == "__main__":
+    main()
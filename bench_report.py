@@ -0,0 +1,71 @@
+"""Benchmark the annual PDF report: python bench_report.py [transactions]
+
+Builds a report from synthetic data for one year, with and without the
+charts, and prints how the time splits between the table and the charts.
+"""
+import os
+import random
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+from main import FX_BASE_CURRENCY, FinanceReport, Money, format_money
+
+EXPENSE_CATEGORIES = ["Travel", "Dining Out", "Shopping", "Entertainment",
+                      "Transportation", "Education", "Utilities", "Health"]
+WORDS = ["groceries", "monthly", "subscription", "payment", "refund", "dinner", "with", "friends",
+         "train", "ticket", "to", "the", "airport", "and", "back", "electricity", "bill"]
+COLORS = ["#4e73df", "#1cc88a", "#f6c23e", "#e74a3b", "#5a5c69"]
+
+
+def synthetic_year(count, year):
+    """Return (rows, monthly, yearly, trend) for count random expenses in the given year"""
+    random.seed(42)
+    start = datetime(year, 1, 1)
+    rows, monthly, yearly, trend = [], {}, {}, {}
+    for _ in range(count):
+        date = start + timedelta(days=random.randrange(365))
+        amount = Decimal(random.randrange(100, 50000)).scaleb(-2)
+        category = random.choice(EXPENSE_CATEGORIES)
+        description = " ".join(random.choices(WORDS, k=random.randrange(1, 30)))
+        rows.append((date.strftime("%Y-%m-%d"),
+                     format_money(Money.of(amount).cents, FX_BASE_CURRENCY), category, "Expense",
+                     description))
+        yearly[category] = yearly.get(category, 0) + amount
+        trend[(date.month, category)] = trend.get((date.month, category), 0) + amount
+        if date.month == 12:
+            monthly[category] = monthly.get(category, 0) + amount
+    rows.sort(reverse=True)
+    return rows, monthly, yearly, trend
+
+
+def run(summary, rows, charts, path):
+    started = time.perf_counter()
+    FinanceReport("Benchmark Report").build(path, summary, rows, charts)
+    return time.perf_counter() - started
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    rows, monthly, yearly, trend = synthetic_year(count, 2025)
+    charts = FinanceReport.standard_charts("December 2025", monthly, yearly, trend, COLORS[0],
+                                           COLORS, FX_BASE_CURRENCY)
+    total = format_money(Money.of(sum(yearly.values())).cents, FX_BASE_CURRENCY)
+    summary = [f"Total Expenses: {total}"]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = os.path.join(tmp_dir, "report.pdf")
+        run(summary, rows[:10], charts, path)  # warm up fonts and matplotlib
+        table = min(run(summary, rows, [], path) for _ in range(3))
+        full = min(run(summary, rows, charts, path) for _ in range(3))
+        size = os.path.getsize(path)
+
+    print(f"{count} transactions, {len(charts)} charts, {size / 1024:.0f} KiB")
+    print(f"table only:   {table:.2f}s")
+    print(f"with charts:  {full:.2f}s ({full - table:.2f}s for the charts)")
+
+
+if __name__ == "__main__":
+    main()
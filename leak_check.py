@@ -0,0 +1,328 @@
+"""Memory and leak check of a long GUI session: python leak_check.py [options]
+
+Drives the real application headlessly (under Xvfb when there is no
+DISPLAY) through scripted cycles: every sidebar screen is opened, the
+three reports are generated and their windows closed, and a transaction
+is added and deleted on the Transactions screen. After each cycle it runs
+the garbage collector and records the traced Python memory (tracemalloc),
+the process RSS, the live matplotlib figures, the Tk widgets, the Tcl
+commands and the pending after() callbacks.
+
+The first --warmup cycles fill caches and are not judged. After them the
+check fails (exit status 1) if traced memory grows by more than
+--max-growth bytes per cycle on average, or if any of the counts ends
+higher than it started, and prints the source lines that allocated the
+growth. Every cycle ends on the dashboard with the same data, so a
+healthy session settles at a constant footprint.
+
+The session logs in as --username (created with --seed-rows transactions
+on first run). Message boxes are recorded instead of shown; an error
+dialog fails the check.
+"""
+import argparse
+import gc
+import os
+import shutil
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import date
+
+import bcrypt
+import numpy as np
+
+DEFAULT_USERNAME = "leakcheck_user"
+PASSWORD = "leakcheck"
+MARKER = "leak_check"
+COUNTERS = ("figures", "widgets", "tcl_commands", "after_callbacks")
+
+
+def start_xvfb():
+    """Start Xvfb on a free display, point DISPLAY at it and return the process"""
+    if shutil.which("Xvfb") is None:
+        raise RuntimeError("no DISPLAY and Xvfb is not installed")
+    for number in range(99, 199):
+        if os.path.exists(f"/tmp/.X11-unix/X{number}") or os.path.exists(f"/tmp/.X{number}-lock"):
+            continue
+        process = subprocess.Popen(["Xvfb", f":{number}", "-screen", "0", "1280x1024x24",
+                                    "-nolisten", "tcp"],
+                                   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        deadline = time.monotonic() + 10
+        while time.monotonic() < deadline:
+            if os.path.exists(f"/tmp/.X11-unix/X{number}"):
+                os.environ["DISPLAY"] = f":{number}"
+                return process
+            if process.poll() is not None:
+                break
+            time.sleep(0.05)
+        process.kill()
+    raise RuntimeError("could not start Xvfb")
+
+
+def rss_bytes():
+    """Resident set size of this process, or 0 where /proc is not available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return 0
+
+
+class Dialogs:
+    """Stands in for tkinter.messagebox, which would block a headless session"""
+
+    def __init__(self, messagebox):
+        self.errors = []
+        self.shown = 0
+        messagebox.showinfo = self.info
+        messagebox.showwarning = self.info
+        messagebox.showerror = self.error
+
+    def info(self, title, message, **options):
+        self.shown += 1
+        return "ok"
+
+    def error(self, title, message, **options):
+        self.shown += 1
+        self.errors.append(f"{title}: {message}")
+        return "ok"
+
+
+class LeakCheck:
+    """Runs the scripted cycles against one FinanceTracker and records a sample after each"""
+
+    def __init__(self, app, settle, plt, figure_class):
+        self.app = app
+        self.root = app.root
+        self.settle_seconds = settle
+        self.plt = plt
+        self.figure_class = figure_class
+        self.samples = []
+        self.snapshot = None  # tracemalloc snapshot of the last cycle
+        self.report_windows = 0
+
+    def settle(self):
+        """Run the event loop until idle callbacks and short timers have fired"""
+        deadline = time.monotonic() + self.settle_seconds
+        while True:
+            self.root.update()
+            if time.monotonic() >= deadline:
+                break
+            time.sleep(0.01)
+
+    def widgets(self, widget=None):
+        widget = widget or self.root
+        return sum(1 + self.widgets(child) for child in widget.winfo_children())
+
+    def button(self, text):
+        """Return the button on screen with the given label"""
+        pending = [self.root]
+        while pending:
+            widget = pending.pop()
+            if widget.winfo_class() == "Button" and widget.cget("text") == text:
+                return widget
+            pending.extend(widget.winfo_children())
+        raise LookupError(f"No '{text}' button on screen")
+
+    def click(self, text):
+        self.button(text).invoke()
+        self.settle()
+
+    def login(self, username):
+        self.app.entry_username.insert(0, username)
+        self.app.entry_password.insert(0, PASSWORD)
+        self.click("Login")
+        if not self.app.current_user:
+            raise RuntimeError(f"Could not log in as {username}")
+
+    def navigation(self):
+        for screen in ("Dashboard", "Transactions", "Reports", "Trends", "Budgets",
+                       "Recurring", "Currencies"):
+            self.click(screen)
+
+    def reports(self):
+        """Generate the reports, then close their windows as the user would"""
+        self.click("Reports")
+        for report in ("Generate Monthly Report", "Generate YTD Report",
+                       "Generate Comparison Report"):
+            self.click(report)
+        self.report_windows = len(self.plt.get_fignums())
+        self.plt.close("all")
+        self.settle()
+
+    def edit(self, cycle):
+        """Add a transaction through the form, then select and delete it"""
+        app = self.app
+        self.click("Transactions")
+        description = f"{MARKER} {cycle}"
+        app.entry_amount.insert(0, "12.34")
+        app.category_var.set(app.category_names("Expense")[0])
+        app.entry_description.insert(0, description)
+        self.click("Add Transaction")
+
+        rows = [item for item in app.transaction_list.get_children()
+                if app.transaction_list.set(item, "Description") == description]
+        if not rows:
+            raise RuntimeError(f"Added transaction '{description}' is not listed")
+        app.transaction_list.selection_set(rows)
+        self.click("Delete Selected")
+
+    def cycle(self, number):
+        self.navigation()
+        self.reports()
+        self.edit(number)
+        self.click("Dashboard")
+        self.sample()
+
+    def sample(self):
+        """Record the counters, then replace the allocation snapshot
+
+        The snapshot is taken after measuring, as snapshots are traced too.
+        """
+        gc.collect()
+        current, _ = tracemalloc.get_traced_memory()
+        self.samples.append({
+            "traced": current,
+            "rss": rss_bytes(),
+            "figures": sum(isinstance(obj, self.figure_class) for obj in gc.get_objects()),
+            "widgets": self.widgets(),
+            "tcl_commands": len(self.root.tk.splitlist(self.root.tk.call("info", "commands"))),
+            "after_callbacks": len(self.root.tk.splitlist(self.root.tk.call("after", "info"))),
+        })
+        self.snapshot = None
+        self.snapshot = tracemalloc.take_snapshot().filter_traces(
+            [tracemalloc.Filter(False, tracemalloc.__file__)])
+
+    def print_sample(self, number, warmup):
+        sample = self.samples[-1]
+        print(f"{number:>5}{'*' if number <= warmup else ' '}"
+              f"{sample['traced'] / 2 ** 20:>11.2f}{sample['rss'] / 2 ** 20:>10.1f}"
+              f"{sample['figures']:>9}{sample['widgets']:>9}{sample['tcl_commands']:>10}"
+              f"{sample['after_callbacks']:>8}{self.report_windows:>9}", flush=True)
+
+
+def judge(samples, warmup, max_growth):
+    """Return the failure messages for the samples after warmup"""
+    judged = samples[warmup:]
+    failures = []
+    traced = np.array([sample["traced"] for sample in judged], dtype=float)
+    if len(traced) >= 2:
+        slope = np.polyfit(np.arange(len(traced)), traced, 1)[0]
+        if slope > max_growth:
+            failures.append(f"traced memory grows {slope / 1024:.1f} KiB per cycle "
+                            f"(limit {max_growth / 1024:.1f} KiB)")
+    for counter in COUNTERS:
+        first, last = judged[0][counter], judged[-1][counter]
+        if last > first:
+            failures.append(f"{counter.replace('_', ' ')} grew from {first} to {last}")
+    return failures
+
+
+def ensure_user(username, seed_rows):
+    """Create the leak check user with seed_rows transactions if it does not exist yet"""
+    import random
+    from main import Database, FinanceData
+    from loadtest import random_transaction
+
+    database = Database()
+    database.connect()
+    try:
+        data = FinanceData(database)
+        if data.find_user(username):
+            return
+        password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt()).decode()
+        data.user_id = data.create_user(username, password_hash)
+        rng = random.Random(0)
+        with database.transaction():
+            for _ in range(seed_rows):
+                data.add_transaction(*random_transaction(rng, date.today()))
+        print(f"Created {username} with {seed_rows} transactions")
+    finally:
+        database.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--cycles", type=int, default=20,
+                        help="cycles judged after the warmup (default: %(default)s)")
+    parser.add_argument("--warmup", type=int, default=3,
+                        help="cycles run before judging (default: %(default)s)")
+    parser.add_argument("--max-growth", type=int, default=64 * 1024,
+                        help="allowed traced memory growth per cycle in bytes "
+                             "(default: %(default)s)")
+    parser.add_argument("--settle", type=float, default=0.2,
+                        help="seconds the event loop runs after each action "
+                             "(default: %(default)s)")
+    parser.add_argument("--username", default=DEFAULT_USERNAME,
+                        help=f"user to log in as, password '{PASSWORD}' (default: %(default)s)")
+    parser.add_argument("--seed-rows", type=int, default=2000,
+                        help="transactions created for a new user (default: %(default)s)")
+    parser.add_argument("--frames", type=int, default=10,
+                        help="traceback frames kept per allocation (default: %(default)s)")
+    parser.add_argument("--top", type=int, default=15,
+                        help="allocation sites shown on failure (default: %(default)s)")
+    args = parser.parse_args()
+    if args.cycles < 2:
+        parser.error("--cycles must be at least 2, the growth is judged between cycles")
+    if args.warmup < 0:
+        parser.error("--warmup must not be negative")
+
+    xvfb = None
+    if not os.environ.get("DISPLAY"):
+        try:
+            xvfb = start_xvfb()
+        except (OSError, RuntimeError) as e:
+            print(f"Cannot run headless: {e}", file=sys.stderr)
+            return 2
+    # The report windows use pyplot; interactive mode keeps plt.show() from blocking
+    os.environ["MPLBACKEND"] = "TkAgg"
+
+    try:
+        import tkinter as tk
+        from tkinter import messagebox
+        import matplotlib.pyplot as plt
+        from matplotlib.figure import Figure
+        from main import FinanceTracker
+
+        ensure_user(args.username, args.seed_rows)
+        plt.ion()
+        dialogs = Dialogs(messagebox)
+
+        tracemalloc.start(args.frames)
+        root = tk.Tk()
+        app = FinanceTracker(root)
+        check = LeakCheck(app, args.settle, plt, Figure)
+        check.login(args.username)
+
+        print(f"{'cycle':>6}{'traced MiB':>11}{'RSS MiB':>10}{'figures':>9}{'widgets':>9}"
+              f"{'Tcl cmds':>10}{'afters':>8}{'reports':>9}")
+        first_judged = max(args.warmup, 1)
+        baseline = None
+        for number in range(1, args.warmup + args.cycles + 1):
+            check.cycle(number)
+            check.print_sample(number, args.warmup)
+            if number == first_judged:
+                baseline = check.snapshot
+
+        failures = judge(check.samples, args.warmup, args.max_growth)
+        if dialogs.errors:
+            failures.append(f"{len(dialogs.errors)} error dialogs, first: {dialogs.errors[0]}")
+        if failures:
+            print("\nFAILED:\n  " + "\n  ".join(failures))
+            print(f"\nLargest allocation growth since cycle {first_judged}:")
+            for stat in check.snapshot.compare_to(baseline, "lineno")[:args.top]:
+                print(f"  {stat}")
+        else:
+            print(f"\nOK: no growth over {args.cycles} cycles")
+        app.on_close()
+        return 1 if failures else 0
+    finally:
+        tracemalloc.stop()
+        if xvfb is not None:
+            xvfb.terminate()
+            xvfb.wait()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,240 @@
+"""Concurrent multi-user load test: python loadtest.py [options]
+
+Starts a number of virtual users, each on its own connection, that run a
+weighted mix of the application's operations (log in, add a transaction,
+view the list, open the dashboard, open the reports, export a PDF) through
+the same FinanceData queries the app uses. Concurrency is ramped in steps;
+for each step it prints throughput, latency percentiles per operation, the
+error count and the InnoDB row lock waits seen by the server during the step.
+
+The virtual users are loadtest_user_1 .. loadtest_user_N; they are created
+(with --seed-rows transactions each) on first run and reused afterwards.
+Remove them with --cleanup.
+"""
+import argparse
+import random
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from datetime import date, timedelta
+
+import bcrypt
+
+from main import (DEFAULT_EXPENSE_CATEGORIES, DEFAULT_INCOME_CATEGORIES, Database,
+                  FinanceData, FinanceReport, Money, format_money)
+from rebalance_shards import delete_user
+
+USER_PREFIX = "loadtest_user_"
+PASSWORD = "loadtest"
+
+# (operation, weight); login and pdf are expensive and only added when enabled
+DEFAULT_MIX = [("add", 30), ("view", 25), ("dashboard", 30), ("reports", 15)]
+LOCK_COUNTERS = ("Innodb_row_lock_waits", "Innodb_row_lock_time")
+
+
+def random_transaction(rng, today):
+    day = today - timedelta(days=rng.randrange(365))
+    if rng.random() < 0.2:
+        return (round(rng.uniform(500, 5000), 2), rng.choice(DEFAULT_INCOME_CATEGORIES),
+                "Income", day, "loadtest")
+    return (round(rng.uniform(1, 300), 2), rng.choice(DEFAULT_EXPENSE_CATEGORIES),
+            "Expense", day, "loadtest")
+
+
+def seed_users(database, count, rows, rng):
+    """Create the missing virtual users and return {username: user id}"""
+    password_hash = bcrypt.hashpw(PASSWORD.encode(), bcrypt.gensalt()).decode()
+    today = date.today()
+    users = {}
+    for n in range(1, count + 1):
+        username = f"{USER_PREFIX}{n}"
+        data = FinanceData(database)
+        user = data.find_user(username)
+        if user:
+            users[username] = user[0]
+            continue
+        data.user_id = data.create_user(username, password_hash)
+        seed = []
+        for _ in range(rows):
+            amount, category, trans_type, day, description = random_transaction(rng, today)
+            seed.append((data.user_id, amount, data.category_id(category, trans_type),
+                         trans_type, day, description))
+        with database.transaction():
+            database.executemany(
+                "INSERT INTO transactions (user_id, amount, category_id, type, date, description) "
+                "VALUES (%s, %s, %s, %s, %s, %s)", seed)
+        users[username] = data.user_id
+    return users
+
+
+def cleanup(database):
+    ids = [row[0] for row in database.fetchall(
+        "SELECT id FROM users WHERE username LIKE %s", (USER_PREFIX + "%",))]
+    for user_id in ids:
+        delete_user(database, user_id)  # every per-user table, children first
+    print(f"Removed {len(ids)} load test users")
+
+
+def lock_counters(database):
+    rows = database.fetchall(
+        "SHOW GLOBAL STATUS WHERE Variable_name IN (%s, %s)", LOCK_COUNTERS)
+    return {name: int(value) for name, value in rows}
+
+
+class VirtualUser(threading.Thread):
+    """Runs the operation mix for one user until stop is set"""
+
+    def __init__(self, username, user_id, mix, stop, think_time, seed):
+        super().__init__(daemon=True)
+        self.username = username
+        self.data = FinanceData(Database(retries=0), user_id)
+        self.operations, self.weights = zip(*mix)
+        self.stop = stop
+        self.think_time = think_time
+        self.rng = random.Random(seed)
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+
+    def run(self):
+        try:
+            self.data.database.connect()
+            while not self.stop.is_set():
+                operation = self.rng.choices(self.operations, self.weights)[0]
+                started = time.perf_counter()
+                try:
+                    getattr(self, "op_" + operation)()
+                except Exception:
+                    self.errors[operation] += 1
+                else:
+                    self.latencies[operation].append(time.perf_counter() - started)
+                if self.think_time:
+                    self.stop.wait(self.rng.expovariate(1 / self.think_time))
+        except Exception:
+            self.errors["connect"] += 1
+        finally:
+            self.data.database.close()
+
+    def op_login(self):
+        user = self.data.find_user(self.username)
+        bcrypt.checkpw(PASSWORD.encode(), user[1].encode())
+
+    def op_add(self):
+        self.data.add_transaction(*random_transaction(self.rng, date.today()))
+
+    def op_view(self):
+        self.data.list_transactions()
+        self.data.transaction_totals()
+
+    def op_dashboard(self):
+        self.data.month_totals()
+        self.data.budget_total()
+        self.data.month_expenses_by_category()
+        self.data.recent_transactions()
+
+    def op_reports(self):
+        today = date.today()
+        month_start = date(today.year, today.month, 1)
+        self.data.expenses_by_category_between(
+            month_start, (month_start + timedelta(days=32)).replace(day=1))
+        self.data.ytd_expenses_by_category()
+        self.data.expense_trend(date(today.year, 1, 1), date(today.year + 1, 1, 1))
+
+    def op_pdf(self):
+        # Formatted like FinanceTracker.generate_pdf: own currency, else the reporting one
+        currency = self.data.reporting_currency()
+
+        def money(amount):
+            amount = Money.of(amount, currency)
+            return format_money(amount.cents, amount.currency)
+
+        income, expense = self.data.transaction_totals()
+        summary = [f"Total Income: {money(income)}", f"Total Expenses: {money(expense)}",
+                   f"Balance: {money(income - expense)}"]
+        rows = [(str(d), money(a), c, t, desc or "")
+                for d, a, c, t, desc in self.data.report_rows()]
+        with tempfile.NamedTemporaryFile(suffix=".pdf") as pdf_file:
+            FinanceReport(f"Financial Report for {self.username}").build(
+                pdf_file.name, summary, rows, [])
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def run_step(users, concurrency, duration, mix, think_time, monitor):
+    stop = threading.Event()
+    chosen = list(users.items())[:concurrency]
+    workers = [VirtualUser(username, user_id, mix, stop, think_time, seed=n)
+               for n, (username, user_id) in enumerate(chosen)]
+    before = lock_counters(monitor)
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    time.sleep(duration)
+    stop.set()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+    after = lock_counters(monitor)
+
+    latencies = defaultdict(list)
+    errors = 0
+    for worker in workers:
+        for operation, values in worker.latencies.items():
+            latencies[operation].extend(values)
+        errors += sum(worker.errors.values())
+    completed = sum(len(values) for values in latencies.values())
+
+    print(f"\n{concurrency} users, {elapsed:.1f}s: {completed / elapsed:.1f} ops/s, "
+          f"{errors} errors, row lock waits "
+          f"{after['Innodb_row_lock_waits'] - before['Innodb_row_lock_waits']} "
+          f"({after['Innodb_row_lock_time'] - before['Innodb_row_lock_time']} ms)")
+    print(f"  {'operation':<12}{'count':>8}{'p50 (ms)':>11}{'p95 (ms)':>11}{'p99 (ms)':>11}")
+    for operation, values in sorted(latencies.items()):
+        print(f"  {operation:<12}{len(values):>8}{percentile(values, 0.50) * 1e3:>11.1f}"
+              f"{percentile(values, 0.95) * 1e3:>11.1f}{percentile(values, 0.99) * 1e3:>11.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--steps", default="1,5,10,25",
+                        help="comma separated concurrency levels (default: %(default)s)")
+    parser.add_argument("--duration", type=float, default=30.0,
+                        help="seconds per step (default: %(default)s)")
+    parser.add_argument("--think-time", type=float, default=0.0,
+                        help="mean pause between operations in seconds (default: none)")
+    parser.add_argument("--seed-rows", type=int, default=1000,
+                        help="transactions created per new virtual user (default: %(default)s)")
+    parser.add_argument("--login", action="store_true",
+                        help="include logins, which run bcrypt on the client")
+    parser.add_argument("--pdf", action="store_true",
+                        help="include PDF exports, which render on the client")
+    parser.add_argument("--cleanup", action="store_true",
+                        help="delete the load test users and their data, then exit")
+    args = parser.parse_args()
+
+    monitor = Database()
+    monitor.connect()
+    try:
+        if args.cleanup:
+            cleanup(monitor)
+            return
+        steps = [int(step) for step in args.steps.split(",")]
+        mix = list(DEFAULT_MIX)
+        if args.login:
+            mix.append(("login", 5))
+        if args.pdf:
+            mix.append(("pdf", 2))
+        users = seed_users(monitor, max(steps), args.seed_rows, random.Random(0))
+        print(f"{len(users)} virtual users, mix: "
+              + ", ".join(f"{name} {weight}" for name, weight in mix))
+        for concurrency in steps:
+            run_step(users, concurrency, args.duration, mix, args.think_time, monitor)
+    finally:
+        monitor.close()
+
+
+if __name__ == "__main__":
+    main()
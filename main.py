@@ -4,19 +4,3074 @@ import mysql.connector
 import bcrypt
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
+from matplotlib.figure import Figure
 from datetime import datetime, timedelta
 import calendar
 from fpdf import FPDF
 from PIL import Image, ImageTk
 import logging
-from mysql.connector import Error
+from mysql.connector import Error, IntegrityError, DataError, ProgrammingError
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+import numpy as np
+import os
+import mmap
+import struct
+import hashlib
+import time
+import json
+import uuid
+import queue
+import threading
+import tempfile
+import weakref
+import random
+import sys
+import argparse
+import bisect
+import csv
+import atexit
+import logging.handlers
+from contextlib import contextmanager
+from functools import lru_cache, total_ordering
+
+# Logging: records are queued by the calling thread and written by a background listener
+LOG_CONFIG = {
+    "path": "finance_tracker.log",
+    "max_bytes": 5 * 1024 * 1024,  # rotate at 5 MB
+    "backup_count": 5,
+    "json": False,  # one JSON object per line instead of text
+}
+
+
+class JsonLogFormatter(logging.Formatter):
+    """Format records as one JSON object per line"""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        return json.dumps(entry)
+
+
+class SamplingFilter(logging.Filter):
+    """Keep one in N records of high-volume events
+
+    A record is sampled when it is logged with extra={"sample": N}; the
+    count is kept per call site. Other records always pass.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        rate = getattr(record, "sample", None)
+        if not rate or rate <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        with self._lock:
+            count = self._counts.get(key, 0)
+            self._counts[key] = count + 1
+        if count % rate:
+            return False
+        if count:
+            record.msg = f"{record.msg} (1 of {rate} similar messages logged)"
+        return True
+
+
+def configure_logging(config=LOG_CONFIG):
+    """Route the root logger through a queue to a rotating file written by a listener thread
+
+    Called by the entry point only, so scripts importing this module keep
+    their own logging and stay out of the application's log.
+    """
+    handler = logging.handlers.RotatingFileHandler(
+        config["path"], maxBytes=config["max_bytes"], backupCount=config["backup_count"],
+        encoding='utf-8', delay=True)
+    if config["json"]:
+        handler.setFormatter(JsonLogFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
+
+    log_queue = queue.SimpleQueue()
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    queue_handler.addFilter(SamplingFilter())
+
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(queue_handler)
+    # Its INFO messages (e.g. about categorical units) are not about the application
+    logging.getLogger("matplotlib").setLevel(logging.WARNING)
+
+    listener = logging.handlers.QueueListener(log_queue, handler)
+    listener.start()
+    atexit.register(listener.stop)  # flush the queue on exit
+    return listener
+
+
+DB_CONFIG = {
+    "host": "localhost",
+    "user": "root",
+    "password": "root",
+    "database": "finance_tracker"
+}
+
+# Read replicas for report queries, e.g. [{**DB_CONFIG, "host": "replica1"}]; empty to read
+# everything from the primary. A replica further behind than REPLICA_MAX_LAG seconds is skipped.
+REPLICA_CONFIGS = []
+REPLICA_MAX_LAG = 5.0
+
+# Shards holding users' rows, e.g. [DB_CONFIG, {**DB_CONFIG, "host": "shard1"}]; empty keeps
+# everyone in DB_CONFIG. shard_directory in the DB_CONFIG database records each user's shard,
+# and fx_rates there is shared by all shards. Replicas only serve users on DB_CONFIG.
+SHARD_CONFIGS = []
+SHARD_VIRTUAL_NODES = 64  # points per shard on the hash ring that places new users
+
+# Hot queries, executed as server-side prepared statements through StatementCache
+# Date filters compare the bare column with a range so the (user_id, date) index can seek;
+# plan_check.py fails on plans that scan transactions
+QUERIES = {
+    "user_by_username": "SELECT id, password FROM users WHERE username = %s",
+    # Totals are grouped by currency; only foreign currency rows need the day for conversion
+    "month_total": """SELECT type, currency, IF(currency = %s, NULL, date) AS day, SUM(amount) 
+        FROM transactions 
+        WHERE user_id = %s 
+        AND date > LAST_DAY(CURDATE() - INTERVAL 1 MONTH) AND date <= LAST_DAY(CURDATE()) 
+        GROUP BY type, currency, day""",
+    "budget_total": "SELECT COALESCE(SUM(amount), 0) FROM budgets WHERE user_id = %s",
+    "month_expenses_by_category": """SELECT category_id, currency, 
+        IF(currency = %s, NULL, date) AS day, SUM(amount) 
+        FROM transactions 
+        WHERE user_id = %s AND type = 'Expense' 
+        AND date > LAST_DAY(CURDATE() - INTERVAL 1 MONTH) AND date <= LAST_DAY(CURDATE()) 
+        GROUP BY category_id, currency, day""",
+    "recent_transactions": """SELECT t.id, t.amount, c.name, t.type, t.date, t.description, 
+        t.currency 
+        FROM transactions t 
+        JOIN categories c ON c.id = t.category_id 
+        WHERE t.user_id = %s 
+        ORDER BY t.date DESC LIMIT 5""",
+    "insert_transaction": """INSERT INTO transactions 
+        (user_id, amount, currency, category_id, type, date, description) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s)""",
+    "data_version": """SELECT COALESCE(MAX(version), 0) 
+        FROM user_data_versions 
+        WHERE user_id = %s""",
+}
+
+# Tables whose changes bump the owner's row in user_data_versions
+VERSIONED_TABLES = ("transactions", "budgets")
+
+# Built-in categories, shared by all users (categories.user_id = 0)
+DEFAULT_EXPENSE_CATEGORIES = ["Travel", "Dining Out", "Shopping", "Entertainment",
+                              "Transportation", "Education", "Utilities", "Health"]
+DEFAULT_INCOME_CATEGORIES = ["Rental", "Stock Income", "Social Security Benefit",
+                             "Wage", "Tips and Bonus", "Other Income"]
+
+# Currencies offered for transactions; fx_rates holds their value in FX_BASE_CURRENCY
+FX_BASE_CURRENCY = "USD"
+CURRENCIES = ["USD", "EUR", "GBP", "JPY", "CAD", "AUD", "CHF", "CNY", "INR", "MXN"]
+CURRENCY_SYMBOLS = {"USD": "$", "EUR": "€", "GBP": "£", "JPY": "¥", "CNY": "¥", "INR": "₹"}
+
+# Local data: snapshot files for warm starts and offline reads, write-behind journals
+LOCAL_DATA_DIR = os.path.join(os.path.expanduser("~"), ".finance_tracker")
+
+
+@total_ordering
+class Money:
+    """An exact amount of money, held as integer cents
+
+    Amounts typed by the user, read from the DECIMAL(10,2) columns or summed
+    from the snapshot are converted to Money once, so adding and comparing
+    them is integer arithmetic. Decimal is only used at the database boundary
+    (Database adapts Money parameters) and float only for charts.
+
+    currency is an ISO code, or None where it is implied (such as budgets,
+    which are in the user's reporting currency). Combining amounts in two
+    different currencies raises ValueError; convert them with FxRates first.
+    """
+    __slots__ = ('cents', 'currency')
+
+    def __init__(self, cents=0, currency=None):
+        self.cents = int(cents)
+        self.currency = currency
+
+    @classmethod
+    def of(cls, value, currency=None):
+        """Convert Money, Decimal, int, float or a numeric string, rounding half up to cents
+
+        currency is given to the result unless value is Money with a currency.
+        """
+        if isinstance(value, Money):
+            return value if value.currency or not currency else cls(value.cents, currency)
+        if isinstance(value, int):
+            return cls(value * 100, currency)
+        if isinstance(value, float):
+            value = repr(value)
+        try:
+            value = Decimal(value)
+        except InvalidOperation:
+            raise ValueError(f"Not an amount: {value!r}") from None
+        if not value.is_finite():
+            raise ValueError(f"Not an amount: {value!r}")
+        return cls(int(value.scaleb(2).to_integral_value(ROUND_HALF_UP)), currency)
+
+    @classmethod
+    def parse(cls, text):
+        """Parse user input such as '12', '1,234.50' or '$5.5'; raises ValueError
+
+        Unlike of(), more than two decimal places is an error rather than rounded.
+        """
+        text = text.strip().replace(",", "")
+        if text[:1] in CURRENCY_SYMBOLS.values():
+            text = text[1:]
+        money = cls.of(text)
+        if Decimal(text) != money.to_decimal():
+            raise ValueError(f"Amount has more than two decimal places: {text}")
+        return money
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __float__(self):
+        return self.cents / 100
+
+    def _currency_with(self, other):
+        if self.currency and other.currency and self.currency != other.currency:
+            raise ValueError(f"Cannot combine {self.currency} and {other.currency} amounts")
+        return self.currency or other.currency
+
+    def __add__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents + other.cents, self._currency_with(other))
+        if other == 0:  # lets sum() start from 0
+            return self
+        return NotImplemented
+
+    __radd__ = __add__
+
+    def __sub__(self, other):
+        if isinstance(other, Money):
+            return Money(self.cents - other.cents, self._currency_with(other))
+        return NotImplemented
+
+    def __neg__(self):
+        return Money(-self.cents, self.currency)
+
+    def __abs__(self):
+        return Money(abs(self.cents), self.currency)
+
+    def __mul__(self, factor):
+        if isinstance(factor, int):
+            return Money(self.cents * factor, self.currency)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __truediv__(self, other):
+        """Money / Money is a ratio; Money / int is not supported as it would need rounding"""
+        if isinstance(other, Money):
+            self._currency_with(other)
+            return self.cents / other.cents
+        return NotImplemented
+
+    def __eq__(self, other):
+        if isinstance(other, Money):
+            return self.cents == other.cents and (
+                not self.currency or not other.currency or self.currency == other.currency)
+        return NotImplemented
+
+    def __lt__(self, other):
+        if isinstance(other, Money):
+            self._currency_with(other)
+            return self.cents < other.cents
+        return NotImplemented
+
+    def __hash__(self):
+        return hash(self.cents)
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __str__(self):
+        return str(self.to_decimal())
+
+    def __repr__(self):
+        if self.currency:
+            return f"Money({str(self)!r}, {self.currency!r})"
+        return f"Money({str(self)!r})"
+
+    def __format__(self, spec):
+        return format(self.to_decimal(), spec)
+
+
+@lru_cache(maxsize=8192)
+def format_money(cents, currency=None):
+    """Format integer cents as $1,234.56 (or €, CHF ...); cached, as lists repeat amounts a lot"""
+    currency = currency or FX_BASE_CURRENCY
+    symbol = CURRENCY_SYMBOLS.get(currency, currency + " ")
+    sign = "-" if cents < 0 else ""
+    dollars, cents = divmod(abs(cents), 100)
+    return f"{sign}{symbol}{dollars:,}.{cents:02d}"
+
+
+def adapt_params(params):
+    """Replace Money in query parameters with Decimal, which mysql.connector can send"""
+    if isinstance(params, dict):
+        return {key: value.to_decimal() if isinstance(value, Money) else value
+                for key, value in params.items()}
+    return tuple(value.to_decimal() if isinstance(value, Money) else value for value in params)
+
+
+class StatementCache:
+    """Prepared statements for the QUERIES registry, prepared once on one connection
+
+    Each statement gets its own prepared cursor: mysql.connector re-prepares
+    whenever a cursor executes a different SQL string, so a dedicated cursor
+    executing the same string object keeps its server-side statement.
+    Use statements_for() to get the cache of a connection.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self._cursors = {}
+
+    def cursor(self, name):
+        """Return the prepared cursor of a registered statement"""
+        cursor = self._cursors.get(name)
+        if cursor is None:
+            cursor = self._cursors[name] = self.connection.cursor(prepared=True)
+        return cursor
+
+    def execute(self, name, params=()):
+        """Execute a registered statement and return its cursor"""
+        cursor = self.cursor(name)
+        cursor.execute(QUERIES[name], params)
+        return cursor
+
+    def fetchall(self, name, params=()):
+        """Execute a registered query and return all rows"""
+        return self.execute(name, params).fetchall()
+
+    def fetchone(self, name, params=()):
+        """Execute a registered query and return its first row, or None"""
+        rows = self.fetchall(name, params)  # read every row so the connection is free again
+        return rows[0] if rows else None
+
+    def close(self):
+        """Deallocate all prepared statements"""
+        for cursor in self._cursors.values():
+            try:
+                cursor.close()
+            except Error:
+                pass
+        self._cursors.clear()
+
+
+_statement_caches = weakref.WeakKeyDictionary()
+
+
+def statements_for(connection):
+    """Return the StatementCache of a connection, creating it on first use"""
+    cache = _statement_caches.get(connection)
+    if cache is None:
+        cache = _statement_caches[connection] = StatementCache(connection)
+    return cache
+
+
+class Database:
+    """MySQL connection manager with liveness pings, reconnect with backoff and idle recycling
+
+    Queries are either a name from QUERIES, executed as a prepared statement,
+    or SQL text. The connection runs in autocommit mode; use transaction()
+    for statements that must be applied together. Reads are retried on a
+    fresh connection when the connection is lost, unless a transaction is
+    open; writes are not retried since they may already have been applied.
+    """
+
+    # Client and server errors meaning the connection is gone, not that the statement failed
+    CONNECTION_ERRORS = {1053, 1927, 2002, 2003, 2006, 2013, 2055, 4031}
+
+    def __init__(self, config=None, retries=3, base_delay=0.2, max_delay=5.0,
+                 ping_after=30.0, recycle_after=600.0):
+        self.config = dict(config or DB_CONFIG)
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.ping_after = ping_after  # ping before use when idle longer than this
+        self.recycle_after = recycle_after  # reconnect before use when idle longer than this
+        self.connection = None
+        self._cursor = None
+        self._last_used = 0.0
+        self.in_transaction = False
+        self.last_write = 0.0  # time.monotonic() of the last write through this connection
+
+    @classmethod
+    def is_connection_error(cls, err):
+        return getattr(err, 'errno', None) in cls.CONNECTION_ERRORS
+
+    def backoff(self, attempt):
+        """Exponential backoff with full jitter"""
+        time.sleep(random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt)))
+
+    def connect(self):
+        """Open a new connection, retrying with backoff"""
+        self.close()
+        for attempt in range(self.retries + 1):
+            try:
+                self.connection = mysql.connector.connect(autocommit=True, **self.config)
+                break
+            except Error as err:
+                if attempt == self.retries or not self.is_connection_error(err):
+                    raise
+                logging.warning(f"Connection attempt {attempt + 1} failed: {err}")
+                self.backoff(attempt)
+        self._cursor = self.connection.cursor(buffered=True)
+        self._last_used = time.monotonic()
+        return self.connection
+
+    def close(self):
+        """Close the connection and its prepared statements"""
+        if self.connection is not None:
+            try:
+                statements_for(self.connection).close()
+                self.connection.close()
+            except Error:
+                pass
+        self.connection = None
+        self._cursor = None
+        self.in_transaction = False
+
+    def ensure_connection(self):
+        """Return a live connection, checking it if it sat idle and replacing it if needed"""
+        idle = time.monotonic() - self._last_used
+        if self.connection is not None and not self.in_transaction:
+            if idle > self.recycle_after:
+                logging.info(f"Recycling connection idle for {idle:.0f}s")
+                self.close()
+            elif idle > self.ping_after:
+                try:
+                    self.connection.ping(reconnect=False)
+                except Error as err:
+                    logging.warning(f"Connection failed liveness check: {err}")
+                    self.close()
+        if self.connection is None:
+            self.connect()
+        self._last_used = time.monotonic()
+        return self.connection
+
+    def _run(self, query, params):
+        params = adapt_params(params)
+        connection = self.ensure_connection()
+        if query in QUERIES:
+            return statements_for(connection).execute(query, params)
+        self._cursor.execute(query, params)
+        return self._cursor
+
+    def _read(self, query, params):
+        for attempt in range(self.retries + 1):
+            try:
+                return self._run(query, params).fetchall()
+            except Error as err:
+                if self.in_transaction or attempt == self.retries or not self.is_connection_error(err):
+                    raise
+                logging.warning(f"Connection lost during read, retrying: {err}")
+                self.close()
+                self.backoff(attempt)
+
+    def fetchall(self, query, params=()):
+        """Run a read-only query and return all rows"""
+        return self._read(query, params)
+
+    def fetchone(self, query, params=()):
+        """Run a read-only query and return its first row, or None"""
+        rows = self._read(query, params)
+        return rows[0] if rows else None
+
+    def fetch_status(self, query):
+        """Run a status statement such as SHOW REPLICA STATUS and return its first row as a dict"""
+        cursor = self._run(query, ())
+        row = cursor.fetchone()
+        return dict(zip(cursor.column_names, row)) if row else None
+
+    def execute(self, query, params=()):
+        """Run a write and return its cursor, for rowcount and lastrowid"""
+        try:
+            cursor = self._run(query, params)
+            self.last_write = time.monotonic()
+            return cursor
+        except Error as err:
+            if self.is_connection_error(err):
+                self.close()
+            raise
+
+    def executemany(self, sql, seq_params):
+        """Run a write for every parameter tuple; inserts are sent as one multi-row statement"""
+        try:
+            self.ensure_connection()
+            self._cursor.executemany(sql, [adapt_params(params) for params in seq_params])
+            self.last_write = time.monotonic()
+            return self._cursor
+        except Error as err:
+            if self.is_connection_error(err):
+                self.close()
+            raise
+
+    @contextmanager
+    def transaction(self):
+        """Run the enclosed writes in one transaction, rolled back if anything fails"""
+        connection = self.ensure_connection()
+        connection.start_transaction()
+        self.in_transaction = True
+        try:
+            yield self
+            connection.commit()
+            self.last_write = time.monotonic()
+        except BaseException:
+            try:
+                connection.rollback()
+            except Error:
+                self.close()
+            raise
+        finally:
+            self.in_transaction = False
+
+
+class ReplicaRouter:
+    """Route report reads to a read replica that is fresh enough, falling back to the primary
+
+    A replica serves a read only when its replication delay, checked at
+    most every check_interval seconds, is below max_lag and shorter than the
+    time since this client's last write, so users always read their own
+    writes. Writes never go through the router.
+    """
+
+    def __init__(self, primary, replica_configs=None, max_lag=REPLICA_MAX_LAG,
+                 check_interval=10.0):
+        self.primary = primary
+        self.replicas = [Database(config, retries=0) for config in
+                         (REPLICA_CONFIGS if replica_configs is None else replica_configs)]
+        self.max_lag = max_lag
+        self.check_interval = check_interval
+        self.last_write = 0.0  # writes made through other connections, see note_write
+        self._lags = {}  # replica index -> (checked at, seconds behind or None if unusable)
+        self._next = 0
+
+    def note_write(self):
+        """Record a write this client made through a connection other than the primary's"""
+        self.last_write = time.monotonic()
+
+    def lag(self, index):
+        """Return how many seconds the replica is behind, or None if it cannot serve reads"""
+        checked_at, lag = self._lags.get(index, (None, None))
+        now = time.monotonic()
+        if checked_at is not None and now - checked_at < self.check_interval:
+            return lag
+
+        replica = self.replicas[index]
+        try:
+            status = replica.fetch_status("SHOW REPLICA STATUS")
+            lag = None
+            if status is not None:
+                lag = status.get("Seconds_Behind_Source", status.get("Seconds_Behind_Master"))
+            if lag is None:
+                logging.warning(f"Replica {replica.config.get('host')} is not replicating",
+                                extra={"sample": 30})
+        except Error as err:
+            logging.warning(f"Replica {replica.config.get('host')} unavailable: {err}",
+                            extra={"sample": 30})
+            replica.close()
+            lag = None
+        self._lags[index] = (now, lag)
+        return lag
+
+    def database_for_read(self):
+        """Return the database a report read should use"""
+        since_write = time.monotonic() - max(self.primary.last_write, self.last_write)
+        for offset in range(len(self.replicas)):
+            index = (self._next + offset) % len(self.replicas)
+            lag = self.lag(index)
+            if lag is not None and lag <= self.max_lag and lag < since_write:
+                self._next = index + 1  # spread reads over the replicas
+                return self.replicas[index]
+        return self.primary
+
+    def _read(self, method, query, params):
+        database = self.database_for_read()
+        if database is self.primary:
+            return getattr(database, method)(query, params)
+        try:
+            return getattr(database, method)(query, params)
+        except Error as err:
+            logging.warning(f"Replica read failed, using the primary: {err}")
+            self._lags[self.replicas.index(database)] = (time.monotonic(), None)
+            return getattr(self.primary, method)(query, params)
+
+    def fetchall(self, query, params=()):
+        return self._read("fetchall", query, params)
+
+    def fetchone(self, query, params=()):
+        return self._read("fetchone", query, params)
+
+    def close(self):
+        for replica in self.replicas:
+            replica.close()
+
+
+def shard_configs():
+    """Return the connection settings of every database holding users"""
+    return SHARD_CONFIGS or [DB_CONFIG]
+
+
+class ShardRouter:
+    """Map users to the shard databases holding their rows
+
+    shard_directory, in the directory database (DB_CONFIG), records the shard
+    of every username and hands out user ids, so ids are unique across
+    shards and a user keeps theirs when moved. New users are placed on a
+    consistent-hash ring of the shards, so adding a shard only claims the
+    users hashing next to its points; existing users only move through
+    rebalance_shards.py. Lookups are cached for the life of the router.
+    """
+
+    def __init__(self, directory, configs=None, virtual_nodes=SHARD_VIRTUAL_NODES):
+        self.directory = directory
+        configs = SHARD_CONFIGS if configs is None else configs
+        self.shards = [directory if config == directory.config else Database(config)
+                       for config in configs] or [directory]
+        ring = sorted((self.hash(f"shard-{index}-{node}"), index)
+                      for index in range(len(self.shards)) for node in range(virtual_nodes))
+        self._points = [point for point, _ in ring]
+        self._owners = [index for _, index in ring]
+        self._locations = {}  # username -> (user id, shard, moved_at)
+
+    @staticmethod
+    def hash(key):
+        return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+    def ring_shard(self, username):
+        """Return the shard the ring assigns to a username"""
+        index = bisect.bisect(self._points, self.hash(username)) % len(self._points)
+        return self._owners[index]
+
+    def create_directory(self):
+        self.directory.execute("""
+            CREATE TABLE IF NOT EXISTS shard_directory (
+                user_id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(50) UNIQUE NOT NULL,
+                shard SMALLINT UNSIGNED NOT NULL,
+                moved_at TIMESTAMP NULL,
+                INDEX (shard)
+            )
+        """)
+
+    def locate(self, username, cached=True):
+        """Return (user id, shard, time of the last move or None) of a username, or None"""
+        if not cached or username not in self._locations:
+            row = self.directory.fetchone(
+                "SELECT user_id, shard, moved_at FROM shard_directory WHERE username = %s",
+                (username,))
+            if row is None:
+                return None
+            self._locations[username] = row
+        return self._locations[username]
+
+    def database_for(self, username):
+        """Return the shard database of a username, or None for an unknown username"""
+        location = self.locate(username)
+        return self.shards[location[1]] if location else None
+
+    def register(self, username, shard=None, user_id=None):
+        """Add a username to the directory, on its ring shard by default; returns (id, shard)"""
+        shard = self.ring_shard(username) if shard is None else shard
+        user_id = self.directory.execute(
+            "INSERT INTO shard_directory (user_id, username, shard) VALUES (%s, %s, %s)",
+            (user_id, username, shard)).lastrowid
+        self._locations[username] = (user_id, shard, None)
+        return user_id, shard
+
+    def unregister(self, username):
+        self.directory.execute("DELETE FROM shard_directory WHERE username = %s", (username,))
+        self._locations.pop(username, None)
+
+    def set_shard(self, username, shard):
+        """Point a username at another shard once its rows have been copied there"""
+        self.directory.execute(
+            "UPDATE shard_directory SET shard = %s, moved_at = NOW() WHERE username = %s",
+            (shard, username))
+        self._locations.pop(username, None)
+
+    def close(self):
+        for shard in self.shards:
+            shard.close()
+        self.directory.close()
+
+
+class FxRates:
+    """Exchange rates with effective dates, cached in memory and applied to whole columns
+
+    fx_rates holds the value of one unit of a currency in FX_BASE_CURRENCY
+    from its effective date until the next rate; other pairs go through the
+    base currency. Days before a currency's first rate use that first rate,
+    and a currency without any rate counts 1:1 (with a warning) rather than
+    breaking the totals.
+    """
+
+    def __init__(self):
+        self._dates = {}  # currency -> sorted effective date ordinals
+        self._rates = {}  # currency -> base currency value per unit, aligned with _dates
+        self.loaded = False
+
+    def load(self, database):
+        """(Re)load every rate; the table is small and changes rarely"""
+        dates, rates = {}, {}
+        for currency, day, rate in database.fetchall(
+                "SELECT currency, effective_date, rate FROM fx_rates "
+                "ORDER BY currency, effective_date"):
+            dates.setdefault(currency, []).append(day.toordinal())
+            rates.setdefault(currency, []).append(float(rate))
+        self._dates = {currency: np.array(days, dtype=np.int64) for currency, days in dates.items()}
+        self._rates = {currency: np.array(values) for currency, values in rates.items()}
+        self.loaded = True
+
+    def has_rate(self, currency):
+        return currency == FX_BASE_CURRENCY or currency in self._dates
+
+    def rates(self, currency, ordinals):
+        """Return the base currency value of one unit of currency on each day"""
+        ordinals = np.asarray(ordinals, dtype=np.int64)
+        if currency == FX_BASE_CURRENCY:
+            return np.ones(len(ordinals))
+        dates = self._dates.get(currency)
+        if dates is None:
+            logging.warning(f"No exchange rate for {currency}, counting it 1:1",
+                            extra={"sample": 100})
+            return np.ones(len(ordinals))
+        index = np.searchsorted(dates, ordinals, side='right') - 1
+        return self._rates[currency][np.maximum(index, 0)]
+
+    def factors(self, currency, target, ordinals):
+        """Return the multipliers converting currency to target on each day"""
+        if currency == target:
+            return np.ones(len(ordinals))
+        return self.rates(currency, ordinals) / self.rates(target, ordinals)
+
+    def convert(self, cents, codes, names, ordinals, target):
+        """Convert cents in currencies names[codes] on days ordinals to float cents of target"""
+        result = cents.astype(float)
+        for code, name in enumerate(names):
+            if name == target:
+                continue
+            rows = codes == code
+            if rows.any():
+                result[rows] *= self.factors(name, target, ordinals[rows])
+        return result
+
+    def sum_converted(self, rows, target):
+        """Sum (key, currency, day, amount) rows into {key: Money in target}
+
+        day is only needed for amounts not in target; each currency is
+        converted with one vectorized lookup.
+        """
+        totals, foreign = {}, {}
+        for key, currency, day, amount in rows:
+            if currency == target:
+                totals[key] = totals.get(key, 0) + Money.of(amount).cents
+            else:
+                foreign.setdefault(currency, []).append((key, day, amount))
+        for currency, items in foreign.items():
+            ordinals = np.fromiter((day.toordinal() for _, day, _ in items), np.int64, len(items))
+            cents = np.fromiter((Money.of(amount).cents for _, _, amount in items), float,
+                                len(items))
+            converted = cents * self.factors(currency, target, ordinals)
+            for (key, _, _), value in zip(items, converted.tolist()):
+                totals[key] = totals.get(key, 0) + value
+        return {key: Money(round(value), target) for key, value in totals.items()}
+
+
+class TransactionSnapshot:
+    """Columnar in-memory copy of one user's transactions for fast aggregations
+
+    cents holds each amount in its own currency. Totals are in the reporting
+    currency: set_currency() gives the rates, and the converted column is
+    computed once, vectorized, whenever the rows change.
+    """
+
+    EPOCH_ORDINAL = datetime(1970, 1, 1).toordinal()
+
+    # File layout: header, password hash, category names, currency names, then the columns,
+    # each section 8-byte aligned
+    FILE_MAGIC = b'FTSNAP02'
+    # magic, user_id, watermark, saved_at, budget cents, rows,
+    # password/names/currency names/descriptions lengths, reporting currency
+    # (exchange rates are not saved: offline, other currencies count 1:1)
+    FILE_HEADER = struct.Struct('<8sIqqqQIIII3s')
+    FILE_COLUMNS = [('ids', np.int64), ('dates', np.int32), ('cents', np.int64),
+                    ('categories', np.int16), ('is_income', np.bool_), ('currencies', np.int16)]
+
+    def __init__(self, user_id):
+        self.user_id = user_id
+        self.password_hash = None
+        self.budget_total = Money(0)
+        self.saved_at = None
+        self.fx = None
+        self.reporting_currency = None
+        self._mmap = None
+        self.clear()
+
+    def clear(self):
+        """Drop all rows and reset the watermark"""
+        self.ids = np.empty(0, dtype=np.int64)
+        self.dates = np.empty(0, dtype=np.int32)  # date.toordinal()
+        self.cents = np.empty(0, dtype=np.int64)
+        self.categories = np.empty(0, dtype=np.int16)  # index into category_names
+        self.is_income = np.empty(0, dtype=bool)
+        self.currencies = np.empty(0, dtype=np.int16)  # index into currency_names
+        self.descriptions = np.empty(0, dtype=object)
+        self.category_names = []
+        self.category_codes = {}
+        self.currency_names = []
+        self.currency_codes = {}
+        self._converted = None
+        self.watermark = 0  # highest transaction id loaded
+
+    def __len__(self):
+        return len(self.ids)
+
+    def load(self, database):
+        """Load all transactions of the user"""
+        self.clear()
+        self.fetch_since(database, 0)
+
+    def refresh(self, database):
+        """Fetch rows added since the watermark, reloading if rows were removed elsewhere"""
+        self.fetch_since(database, self.watermark)
+        count = database.fetchone("SELECT COUNT(*) FROM transactions WHERE user_id = %s",
+                                  (self.user_id,))[0]
+        if count != np.count_nonzero(self.ids > 0):
+            self.load(database)
+
+    def fetch_since(self, database, watermark):
+        """Append the user's transactions with an id above the watermark"""
+        rows = database.fetchall("""
+            SELECT t.id, t.amount, c.name, t.type, t.date, t.description, t.currency 
+            FROM transactions t 
+            JOIN categories c ON c.id = t.category_id 
+            WHERE t.user_id = %s AND t.id > %s 
+            ORDER BY t.id
+        """, (self.user_id, watermark))
+        if rows:
+            self.append([(trans_id, Money.of(amount, currency), category, trans_type, date,
+                          description)
+                         for trans_id, amount, category, trans_type, date, description, currency
+                         in rows])
+
+    def append(self, rows):
+        """Append (id, amount, category, type, date, description) rows
+
+        An amount without a currency is taken to be in the reporting currency.
+        """
+        count = len(rows)
+        ids, amounts, categories, types, dates, descriptions = zip(*rows)
+        amounts = [Money.of(amount) for amount in amounts]
+        default_currency = self.reporting_currency or FX_BASE_CURRENCY
+
+        for category in categories:
+            if category not in self.category_codes:
+                self.category_codes[category] = len(self.category_names)
+                self.category_names.append(category)
+        for amount in amounts:
+            currency = amount.currency or default_currency
+            if currency not in self.currency_codes:
+                self.currency_codes[currency] = len(self.currency_names)
+                self.currency_names.append(currency)
+
+        self.ids = np.concatenate([self.ids, np.fromiter(ids, np.int64, count)])
+        self.cents = np.concatenate([self.cents, np.fromiter(
+            (amount.cents for amount in amounts), np.int64, count)])
+        self.currencies = np.concatenate([self.currencies, np.fromiter(
+            (self.currency_codes[amount.currency or default_currency] for amount in amounts),
+            np.int16, count)])
+        self.categories = np.concatenate([self.categories, np.fromiter(
+            (self.category_codes[category] for category in categories), np.int16, count)])
+        self.is_income = np.concatenate([self.is_income, np.fromiter(
+            (trans_type == 'Income' for trans_type in types), bool, count)])
+        self.dates = np.concatenate([self.dates, np.fromiter(
+            (self._ordinal(value) for value in dates), np.int32, count)])
+        self.descriptions = np.concatenate([self.descriptions, np.array(
+            [(description or "").replace("\0", "") for description in descriptions], dtype=object)])
+        self.watermark = max(self.watermark, int(self.ids.max()))
+        self._converted = None
+
+    def discard(self, ids):
+        """Remove transactions by id"""
+        keep = ~np.isin(self.ids, np.asarray(list(ids), dtype=np.int64))
+        self.ids = self.ids[keep]
+        self.dates = self.dates[keep]
+        self.cents = self.cents[keep]
+        self.categories = self.categories[keep]
+        self.is_income = self.is_income[keep]
+        self.currencies = self.currencies[keep]
+        self.descriptions = self.descriptions[keep]
+        self._converted = None
+
+    def set_currency(self, fx, currency):
+        """Report totals in currency, converting with the FxRates fx"""
+        self.fx = fx
+        self.reporting_currency = currency
+        self._converted = None
+
+    def converted(self):
+        """Return the amounts as cents of the reporting currency (float where converted)"""
+        if self._converted is None:
+            target = self.reporting_currency or FX_BASE_CURRENCY
+            if self.fx is None or all(name == target for name in self.currency_names):
+                self._converted = self.cents
+            else:
+                self._converted = self.fx.convert(self.cents, self.currencies,
+                                                  self.currency_names, self.dates, target)
+        return self._converted
+
+    def rows(self, limit=None):
+        """Return (id, amount, category, type, date, description) tuples, newest first"""
+        order = np.lexsort((-self.ids, -self.dates.astype(np.int64)))
+        if limit is not None:
+            order = order[:limit]
+        return [(int(self.ids[i]),
+                 Money(self.cents[i], self.currency_names[self.currencies[i]]),
+                 self.category_names[self.categories[i]],
+                 'Income' if self.is_income[i] else 'Expense',
+                 datetime.fromordinal(int(self.dates[i])).date(),
+                 self.descriptions[i]) for i in order]
+
+    @staticmethod
+    def _align(offset):
+        return (offset + 7) & ~7
+
+    def save(self, path):
+        """Write the snapshot to a binary file, replacing the old one atomically"""
+        self.detach()
+        stored = self.ids > 0  # optimistic rows are not in the database yet
+        password = (self.password_hash or "").encode('utf-8')
+        names = "\n".join(self.category_names).encode('utf-8')
+        currency_names = "\n".join(self.currency_names).encode('utf-8')
+        descriptions = "\0".join(self.descriptions[stored]).encode('utf-8')
+        header = self.FILE_HEADER.pack(
+            self.FILE_MAGIC, self.user_id, self.watermark, int(time.time()),
+            Money.of(self.budget_total).cents, int(stored.sum()), len(password), len(names),
+            len(currency_names), len(descriptions),
+            (self.reporting_currency or "").encode('ascii'))
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".tmp"
+        # Owner only: the file holds the password hash and every description
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, 'O_BINARY', 0),
+                     0o600)
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, 0o600)  # a leftover temporary file keeps its old mode
+        with open(fd, 'wb') as f:
+            for chunk in [header, password, names, currency_names] + \
+                    [getattr(self, name)[stored].tobytes() for name, _ in self.FILE_COLUMNS] + \
+                    [descriptions]:
+                f.write(chunk)
+                f.write(b'\0' * (self._align(len(chunk)) - len(chunk)))
+            # On disk before the rename, so a crash cannot leave a truncated snapshot
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def open(cls, path):
+        """Map a snapshot file into memory; the columns are read-only views of the file"""
+        with open(path, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        (magic, user_id, watermark, saved_at, budget_cents, count, password_len, names_len,
+         currency_names_len, descriptions_len, currency) = cls.FILE_HEADER.unpack_from(mapped, 0)
+        if magic != cls.FILE_MAGIC:
+            mapped.close()
+            raise ValueError(f"Not a snapshot file: {path}")
+
+        snapshot = cls(user_id)
+        snapshot._mmap = mapped
+        snapshot.watermark = watermark
+        snapshot.saved_at = datetime.fromtimestamp(saved_at)
+        snapshot.reporting_currency = currency.rstrip(b'\0').decode('ascii') or None
+        snapshot.budget_total = Money(budget_cents, snapshot.reporting_currency)
+
+        offset = cls._align(cls.FILE_HEADER.size)
+        snapshot.password_hash = mapped[offset:offset + password_len].decode('utf-8') or None
+        offset = cls._align(offset + password_len)
+        names = mapped[offset:offset + names_len].decode('utf-8')
+        snapshot.category_names = names.split("\n") if names else []
+        snapshot.category_codes = {name: code for code, name in enumerate(snapshot.category_names)}
+        offset = cls._align(offset + names_len)
+        names = mapped[offset:offset + currency_names_len].decode('utf-8')
+        snapshot.currency_names = names.split("\n") if names else []
+        snapshot.currency_codes = {name: code for code, name in enumerate(snapshot.currency_names)}
+        offset = cls._align(offset + currency_names_len)
+
+        for name, dtype in cls.FILE_COLUMNS:
+            column = np.frombuffer(mapped, dtype=dtype, count=count, offset=offset)
+            setattr(snapshot, name, column)
+            offset = cls._align(offset + column.nbytes)
+
+        descriptions = mapped[offset:offset + descriptions_len].decode('utf-8')
+        snapshot.descriptions = np.array(descriptions.split("\0") if count else [], dtype=object)
+        return snapshot
+
+    def detach(self):
+        """Copy the columns out of the mapped file so it can be closed and replaced"""
+        if self._mmap is None:
+            return
+        for name, _ in self.FILE_COLUMNS:
+            setattr(self, name, np.array(getattr(self, name)))
+        self._converted = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            pass  # a view is still alive elsewhere; the map is released with it
+        self._mmap = None
+
+    @staticmethod
+    def _ordinal(value):
+        # Handle both date strings and datetime objects
+        if isinstance(value, str):
+            return datetime.strptime(value.split()[0], "%Y-%m-%d").toordinal()
+        return value.toordinal()
+
+    def to_amount(self, cents):
+        """Convert reporting currency cents (bincount sums are floats) to Money"""
+        return Money(round(cents), self.reporting_currency)
+
+    def _mask(self, start=None, end=None, income=None, month=None):
+        mask = np.ones(len(self), dtype=bool)
+        if start is not None:
+            mask &= self.dates >= start.toordinal()
+        if end is not None:
+            mask &= self.dates < end.toordinal()
+        if income is not None:
+            mask &= self.is_income == income
+        if month is not None:
+            months = (self.dates - self.EPOCH_ORDINAL).astype('datetime64[D]').astype('datetime64[M]')
+            mask &= months.astype(np.int64) % 12 == month - 1
+        return mask
+
+    def total(self, start=None, end=None, income=None, month=None):
+        """Sum of the matching amounts; start is inclusive and end exclusive"""
+        return self.to_amount(self.converted()[self._mask(start, end, income, month)].sum())
+
+    def count(self, start=None, end=None, income=None, month=None):
+        """Number of matching transactions; start is inclusive and end exclusive"""
+        return int(self._mask(start, end, income, month).sum())
+
+    def _group_key(self, key, mask):
+        """Return the integer group values of the masked rows and a function labelling them"""
+        if key == 'category':
+            return self.categories[mask], self.category_names.__getitem__
+        if key == 'type':
+            return self.is_income[mask].astype(np.int8), lambda k: 'Income' if k else 'Expense'
+        if key == 'day':
+            return self.dates[mask], lambda k: datetime.fromordinal(k).date()
+        if key == 'week':
+            # Ordinal 1 is a Monday, so this is the ordinal of the week's Monday
+            dates = self.dates[mask]
+            return dates - (dates - 1) % 7, lambda k: datetime.fromordinal(k).date()
+        if key in ('month', 'year'):
+            days = (self.dates[mask] - self.EPOCH_ORDINAL).astype('datetime64[D]')
+            if key == 'month':
+                return (days.astype('datetime64[M]').astype(np.int64),
+                        lambda k: (1970 + k // 12, k % 12 + 1))
+            return days.astype('datetime64[Y]').astype(np.int64), lambda k: 1970 + k
+        raise ValueError(f"Unknown grouping: {key}")
+
+    def group_by(self, key, start=None, end=None, income=None, month=None):
+        """Sum the matching amounts by 'category', 'type', 'year', 'month', 'week' or 'day'
+
+        key may also be a tuple of those names, e.g. ('month', 'category'), in
+        which case the labels are tuples. Returns a dict of group label ->
+        Money total, for groups with rows only.
+        """
+        mask = self._mask(start, end, income, month)
+        keys = key if isinstance(key, tuple) else (key,)
+
+        codes, labels = [], []
+        for name in keys:
+            values, label = self._group_key(name, mask)
+            uniques, inverse = np.unique(values, return_inverse=True)
+            codes.append(inverse.reshape(-1))
+            labels.append((uniques, label))
+
+        shape = [len(uniques) for uniques, _ in labels]
+        flat = np.ravel_multi_index(codes, shape) if mask.any() else np.empty(0, dtype=np.int64)
+        groups, inverse = np.unique(flat, return_inverse=True)
+        sums = np.bincount(inverse.reshape(-1), weights=self.converted()[mask],
+                           minlength=len(groups))
+
+        result = {}
+        for indexes, total in zip(zip(*np.unravel_index(groups, shape)), sums):
+            group = tuple(label(int(uniques[i])) for i, (uniques, label) in zip(indexes, labels))
+            result[group if isinstance(key, tuple) else group[0]] = self.to_amount(total)
+        return result
+
+
+class WriteBehindQueue:
+    """Durable local journal of new transactions, written to MySQL in batches by a background thread
+
+    Entries are appended to a JSON-lines journal (fsynced) before they are
+    acknowledged and stay there until their batch is committed. Each entry
+    carries a client key stored in transactions.client_key, so replaying a
+    batch after a crash or a lost commit acknowledgement is a no-op.
+    """
+
+    INSERT_SQL = """INSERT INTO transactions 
+        (user_id, amount, currency, category_id, type, date, description, client_key) 
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s) 
+        ON DUPLICATE KEY UPDATE id = id"""
+
+    def __init__(self, user_id, path, batch_size=200, flush_interval=1.0, max_backoff=60.0,
+                 config=None):
+        self.user_id = user_id
+        self.path = path
+        self.rejected_path = path + ".rejected"
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_backoff = max_backoff
+
+        # ('flushed', [entries]), ('conflict', entry, message) or ('retry', count, message)
+        self.events = queue.Queue()
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop = threading.Event()
+        self._database = Database(config, retries=0)  # the flush loop does its own backoff
+        self._data = FinanceData(self._database, user_id)
+        self._next_temp_id = -1
+        self._pending = self._read_journal()
+
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self._thread.start()
+
+    def _read_journal(self):
+        entries = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entries.append(json.loads(line))
+                    except ValueError:
+                        logging.error(f"Skipping damaged journal line in {self.path}")
+        for entry in entries:
+            entry["temp_id"] = self._new_temp_id()
+        return entries
+
+    def _new_temp_id(self):
+        # Negative ids mark optimistic rows that are not in the database yet
+        temp_id = self._next_temp_id
+        self._next_temp_id -= 1
+        return temp_id
+
+    def append(self, amount, category, trans_type, date, description):
+        """Journal a new transaction and schedule it for writing; returns the entry
+
+        Without a currency on amount, the user's reporting currency is used when it is written.
+        """
+        entry = {
+            "key": uuid.uuid4().hex,
+            "amount": str(amount),
+            "currency": getattr(amount, "currency", None),
+            "category": category,
+            "type": trans_type,
+            "date": date.isoformat(),
+            "description": description
+        }
+        with self._lock:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps(entry) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            entry["temp_id"] = self._new_temp_id()
+            self._pending.append(entry)
+        self._wakeup.set()
+        return entry
+
+    def pending(self):
+        """Return the entries not yet written to the database"""
+        with self._lock:
+            return list(self._pending)
+
+    def stop(self, timeout=5.0):
+        """Flush what can be flushed within the timeout and stop the background thread"""
+        self._stop.set()
+        self._wakeup.set()
+        self._thread.join(timeout)
+
+    def _run(self):
+        backoff = self.flush_interval
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+
+            with self._lock:
+                batch = self._pending[:self.batch_size]
+            if not batch:
+                if self._stop.is_set():
+                    break
+                continue
+
+            try:
+                self._flush(batch)
+                backoff = self.flush_interval
+            except Error as err:
+                logging.warning(f"Write-behind flush of {len(batch)} transactions failed, "
+                                f"retrying in {backoff:.0f}s: {err}", extra={"sample": 10})
+                self.events.put(('retry', len(batch), str(err)))
+                self._database.close()
+                if self._stop.wait(backoff):
+                    break
+                backoff = min(backoff * 2, self.max_backoff)
+            else:
+                self._wakeup.set()  # more entries may be waiting
+        self._database.close()
+
+    def _params(self, entry):
+        return (self.user_id, Money.of(entry["amount"]),
+                entry.get("currency") or self._data.reporting_currency(),
+                self._data.category_id(entry["category"], entry["type"]), entry["type"],
+                entry["date"], entry["description"], entry["key"])
+
+    def _flush(self, batch):
+        database = self._database
+        rows, rejected = [], []
+        for entry in batch:
+            try:
+                rows.append((entry, self._params(entry)))
+            except ValueError as err:  # the category name is taken by the other type
+                rejected.append((entry, str(err)))
+        try:
+            if rows:
+                with database.transaction():
+                    database.executemany(self.INSERT_SQL, [params for _, params in rows])
+            flushed = [entry for entry, _ in rows]
+        except (IntegrityError, DataError):
+            # Some row is refused by the server: insert one by one to isolate it. Any other
+            # error (a missing table or column, a lost connection) is not the rows' fault and
+            # goes to the retry backoff with the whole batch still journaled.
+            flushed = []
+            for entry, params in rows:
+                try:
+                    database.execute(self.INSERT_SQL, params)
+                    flushed.append(entry)
+                except (IntegrityError, DataError) as err:
+                    rejected.append((entry, str(err)))
+
+        self._complete(flushed, rejected)
+        logging.info(f"Write-behind flushed {len(flushed)} transactions, rejected {len(rejected)}")
+
+    def _complete(self, flushed, rejected):
+        done = {entry["key"] for entry in flushed}
+        done.update(entry["key"] for entry, _ in rejected)
+
+        with self._lock:
+            self._pending = [entry for entry in self._pending if entry["key"] not in done]
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                for entry in self._pending:
+                    f.write(json.dumps({k: v for k, v in entry.items() if k != "temp_id"}) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+
+            if rejected:
+                with open(self.rejected_path, 'a', encoding='utf-8') as f:
+                    for entry, message in rejected:
+                        record = {k: v for k, v in entry.items() if k != "temp_id"}
+                        record["error"] = message
+                        f.write(json.dumps(record) + "\n")
+
+        if flushed:
+            self.events.put(('flushed', flushed))
+        for entry, message in rejected:
+            self.events.put(('conflict', entry, message))
+
+
+class TombstonePurger:
+    """Background thread that permanently removes a user's deleted transactions once they can no longer be undone
+
+    The session of each user purges only that user's tombstones, on the
+    user's shard, so clients never contend over other users' rows. Rows
+    are purged in small batches, each its own autocommitted DELETE, so a
+    large cleanup never holds locks on deleted_transactions for long.
+    Tombstones of users who do not log in again are left to
+    'python main.py --purge-deleted'.
+    """
+
+    MAX_AGE = 600  # seconds, well past the undo window
+    BATCH_SIZE = 1000
+    PURGE_SQL = """DELETE FROM deleted_transactions 
+        WHERE deleted_at < NOW() - INTERVAL %s SECOND 
+        LIMIT %s"""
+    USER_PURGE_SQL = """DELETE FROM deleted_transactions 
+        WHERE user_id = %s AND deleted_at < NOW() - INTERVAL %s SECOND 
+        LIMIT %s"""
+
+    def __init__(self, user_id, config=None, max_age=MAX_AGE, interval=60.0,
+                 batch_size=BATCH_SIZE):
+        self.user_id = user_id
+        self.max_age = max_age
+        self.interval = interval
+        self.batch_size = batch_size
+
+        self._stop = threading.Event()
+        # A failed pass is simply retried next interval
+        self._database = Database(config, retries=0)
+        self._thread = threading.Thread(target=self._run, name="tombstone-purge", daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=5.0):
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def purge(self):
+        """Delete the user's expired tombstones batch by batch; returns the number of rows removed"""
+        removed = 0
+        while not self._stop.is_set():
+            count = self._database.execute(
+                self.USER_PURGE_SQL, (self.user_id, self.max_age, self.batch_size)).rowcount
+            removed += count
+            if count < self.batch_size:
+                break
+        return removed
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                removed = self.purge()
+                if removed:
+                    logging.info(f"Purged {removed} deleted transactions")
+            except Error as err:
+                logging.warning(f"Purging deleted transactions failed: {err}")
+                self._database.close()
+        self._database.close()
+
+
+class RecurrenceSchedule:
+    """Cron-style schedule of days: 'DAY-OF-MONTH MONTH DAY-OF-WEEK'
+
+    Each field is '*', a number, a range 'a-b', a step '*/n' or 'a-b/n', or
+    a comma separated list of those; the day of the month may also be 'L',
+    the last day. Days of the week run from 0 (Sunday) to 6, 7 is Sunday
+    too. As in cron, when both day fields are restricted a day matching
+    either is due. Examples: '1 * *' on the 1st of every month, '* * 5'
+    every Friday, '15 1,4,7,10 *' quarterly, 'L * *' on month ends.
+    """
+
+    FIELDS = (("day of month", 1, 31), ("month", 1, 12), ("day of week", 0, 7))
+    HORIZON = 366 * 8  # days searched for the next occurrence, covers Feb 29
+
+    def __init__(self, expression):
+        parts = expression.split()
+        if len(parts) != 3:
+            raise ValueError("A schedule has three fields: day of month, month, day of week")
+        self.expression = " ".join(parts)
+
+        days, months, weekdays = parts
+        day_items = days.upper().split(',')
+        self.last_day = 'L' in day_items
+        day_items = [item for item in day_items if item != 'L']
+        self.days = self._parse(",".join(day_items), *self.FIELDS[0]) if day_items else set()
+        self.months = self._parse(months, *self.FIELDS[1])
+        self.weekdays = {day % 7 for day in self._parse(weekdays, *self.FIELDS[2])}
+        self.any_day = parts[0] == '*'
+        self.any_weekday = parts[2] == '*'
+
+    @staticmethod
+    def _parse(field, name, low, high):
+        values = set()
+        for item in field.split(','):
+            spec, _, step = item.partition('/')
+            if spec == '*':
+                first, last = low, high
+            elif '-' in spec:
+                first, last = (int(value) for value in spec.split('-', 1))
+            elif spec.isdigit():
+                first = last = int(spec)
+                if step:
+                    last = high
+            else:
+                raise ValueError(f"Invalid {name}: {item}")
+            step = int(step) if step else 1
+            if not low <= first <= last <= high or step < 1:
+                raise ValueError(f"Invalid {name}: {item}")
+            values.update(range(first, last + 1, step))
+        return values
+
+    def matches(self, day):
+        if day.month not in self.months:
+            return False
+        day_matches = day.day in self.days or (
+            self.last_day and day.day == calendar.monthrange(day.year, day.month)[1])
+        weekday_matches = day.isoweekday() % 7 in self.weekdays
+        if self.any_day and self.any_weekday:
+            return True
+        if self.any_day:
+            return weekday_matches
+        if self.any_weekday:
+            return day_matches
+        return day_matches or weekday_matches
+
+    def month_days(self, year, month):
+        """Return the due days of a month, in order, without testing each day"""
+        if month not in self.months:
+            return []
+        first_weekday, length = calendar.monthrange(year, month)
+        if self.any_day and self.any_weekday:
+            return list(range(1, length + 1))
+        days = set()
+        if not self.any_day:
+            days.update(day for day in self.days if day <= length)
+            if self.last_day:
+                days.add(length)
+        if not self.any_weekday:
+            first_weekday = (first_weekday + 1) % 7  # Sunday is 0 here
+            for weekday in self.weekdays:
+                days.update(range(1 + (weekday - first_weekday) % 7, length + 1, 7))
+        return sorted(days)
+
+    def occurrences(self, start, end):
+        """Yield the due days from start to end, both inclusive
+
+        Only the scheduled months are visited, and the due days of each are
+        computed from its length and first weekday.
+        """
+        for index in range(month_index(start), month_index(end) + 1):
+            year, month = divmod(index, 12)
+            for day in self.month_days(year, month + 1):
+                day = datetime(year, month + 1, day).date()
+                if start <= day <= end:
+                    yield day
+
+    def next_on_or_after(self, day):
+        """Return the first due day not before day, or None if there is none within the horizon"""
+        return next(self.occurrences(day, day + timedelta(days=self.HORIZON)), None)
+
+
+class RecurringMaterializer:
+    """Insert the due occurrences of recurring rules as transactions
+
+    Rules are read in id order, a batch at a time, through the
+    (active, next_date) index, so only rules with something due are
+    touched. The occurrences of a batch are written with multi-row inserts
+    and the rules' next_date watermarks advanced in the same transaction.
+    Each occurrence has a client key derived from its rule and day, so a
+    batch replayed after a crash, or by two materializers at once, inserts
+    nothing twice.
+    """
+
+    INSERT_SQL = WriteBehindQueue.INSERT_SQL
+
+    def __init__(self, database, batch_size=500, insert_chunk=1000):
+        self.database = database
+        self.batch_size = batch_size
+        self.insert_chunk = insert_chunk
+
+    @staticmethod
+    def occurrence_key(rule_id, day):
+        return hashlib.md5(f"recurring:{rule_id}:{day.isoformat()}".encode()).hexdigest()
+
+    def run(self, today=None, user_id=None):
+        """Materialize everything due up to today, for one user or all; returns rows inserted"""
+        today = today or datetime.now().date()
+        user_filter = "AND user_id = %s" if user_id is not None else ""
+        inserted = last_id = 0
+        while True:
+            rules = self.database.fetchall(f"""
+                SELECT id, user_id, amount, currency, category_id, type, description, schedule, 
+                end_date, next_date 
+                FROM recurring_rules 
+                WHERE active = TRUE AND next_date <= %s AND id > %s {user_filter} 
+                ORDER BY id 
+                LIMIT %s
+            """, (today, last_id, *([user_id] if user_id is not None else []), self.batch_size))
+            if not rules:
+                break
+            inserted += self._materialize(rules, today)
+            last_id = rules[-1][0]
+        if inserted:
+            logging.info(f"Materialized {inserted} recurring transactions")
+        return inserted
+
+    def _materialize(self, rules, today):
+        rows, advanced, finished = [], [], []
+        for (rule_id, user_id, amount, currency, category_id, trans_type, description,
+             expression, end_date, next_date) in rules:
+            try:
+                schedule = RecurrenceSchedule(expression)
+            except ValueError as e:
+                logging.error(f"Disabling recurring rule {rule_id}: {e}")
+                finished.append(rule_id)
+                continue
+
+            until = min(today, end_date) if end_date else today
+            for day in schedule.occurrences(next_date, until):
+                rows.append((user_id, amount, currency, category_id, trans_type, day,
+                             description, self.occurrence_key(rule_id, day)))
+
+            following = schedule.next_on_or_after(until + timedelta(days=1))
+            if following is None or end_date and following > end_date:
+                finished.append(rule_id)
+            else:
+                advanced.append((rule_id, following))
+
+        inserted = 0
+        with self.database.transaction():
+            for start in range(0, len(rows), self.insert_chunk):
+                inserted += self.database.executemany(
+                    self.INSERT_SQL, rows[start:start + self.insert_chunk]).rowcount
+            if advanced:
+                cases = " ".join(["WHEN %s THEN %s"] * len(advanced))
+                self.database.execute(f"""
+                    UPDATE recurring_rules SET next_date = CASE id {cases} END 
+                    WHERE id IN ({", ".join(["%s"] * len(advanced))})
+                """, (*[value for pair in advanced for value in pair],
+                      *[rule_id for rule_id, _ in advanced]))
+            if finished:
+                self.database.execute(f"""
+                    UPDATE recurring_rules SET active = FALSE 
+                    WHERE id IN ({", ".join(["%s"] * len(finished))})
+                """, finished)
+        return inserted
+
+
+def month_index(day):
+    """Months since year 0, so consecutive months are consecutive integers"""
+    return day.year * 12 + day.month - 1
+
+
+def month_start(index):
+    return datetime(index // 12, index % 12 + 1, 1).date()
+
+
+class CashFlowForecast:
+    """Projected amounts per (type, category) series for this month and the months after it"""
+
+    def __init__(self, keys, months, actual, projected, elapsed):
+        self.keys = keys            # [(type, category)]
+        self.months = months        # [(year, month)], the current month first
+        self.actual = actual        # amounts so far this month, one per key
+        self.projected = projected  # keys x months, full-month amounts
+        self.elapsed = elapsed      # share of the current month that has passed
+
+    def month_end(self):
+        """Return the amounts expected by the end of this month, one per key
+
+        What has been spent stays; the rest of the month gets its share of the
+        full-month projection.
+        """
+        remaining = self.projected[:, 0] * (1 - self.elapsed)
+        return self.actual + remaining
+
+    def total(self, trans_type, month_end=True):
+        """Sum the month-end (or, with month_end False, every future month's) amounts of a type"""
+        rows = np.fromiter((key[0] == trans_type for key in self.keys), bool, len(self.keys))
+        if month_end:
+            return float(self.month_end()[rows].sum())
+        return self.projected[rows, 1:].sum(axis=0)
+
+    def top_categories(self, trans_type, count=3):
+        """Return the count largest [(category, month-end amount)] of a type, largest first"""
+        month_end = self.month_end()
+        ranked = sorted(((float(month_end[row]), key[1]) for row, key in enumerate(self.keys)
+                         if key[0] == trans_type and month_end[row] > 0), reverse=True)
+        return [(category, amount) for amount, category in ranked[:count]]
+
+    def net_by_month(self):
+        """Return [((year, month), income - expense)], the current month projected to its end"""
+        net = [self.total('Income') - self.total('Expense')]
+        net += (self.total('Income', False) - self.total('Expense', False)).tolist()
+        return list(zip(self.months, net))
+
+
+class CashFlowForecaster:
+    """Forecasts monthly totals per user, type and category from the monthly history
+
+    The model runs over every series at once with NumPy: the level is the
+    mean of the last WINDOW completed months, deseasonalized and scaled by a
+    per-calendar-month index once MIN_SEASONS years of history exist (plain
+    rolling mean before that). Months before a user's first transaction are
+    NaN so new users are not dragged towards zero.
+
+    Forecasts are cached per user. The model is only refitted when the
+    completed months change (a new month, or a row added or deleted before
+    this month); new transactions this month just update the actuals.
+    """
+    HISTORY_MONTHS = 36
+    WINDOW = 3
+    SEASON = 12
+    MIN_SEASONS = 2
+
+    def __init__(self, horizon=3):
+        self.horizon = horizon
+        self._cache = {}  # user id -> (month, fingerprint, keys, projected)
+
+    @classmethod
+    def project(cls, history, horizon):
+        """Forecast horizon months following history (series x months, NaN before any data)"""
+        series, months = history.shape
+        observed = ~np.isnan(history)
+        values = np.where(observed, history, 0.0)
+
+        index = np.ones((series, cls.SEASON))
+        seasons = months // cls.SEASON
+        if seasons >= cls.MIN_SEASONS:
+            # The block ends at the last history month, so its column j is the
+            # calendar month of forecast step k whenever k % SEASON == j
+            span = slice(months - seasons * cls.SEASON, months)
+            sums = values[:, span].reshape(series, seasons, cls.SEASON).sum(axis=1)
+            counts = observed[:, span].reshape(series, seasons, cls.SEASON).sum(axis=1)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                means = sums / counts
+                overall = sums.sum(axis=1, keepdims=True) / counts.sum(axis=1, keepdims=True)
+                seasonal = means / overall
+            valid = (counts >= cls.MIN_SEASONS) & (overall > 0) & np.isfinite(seasonal)
+            index = np.where(valid, seasonal, 1.0)
+
+        window = min(cls.WINDOW, months)
+        recent_index = index[:, np.arange(-window, 0) % cls.SEASON]
+        recent_observed = observed[:, months - window:] & (recent_index > 0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            deseasonalized = np.where(recent_observed,
+                                      values[:, months - window:] / recent_index, 0.0)
+            level = deseasonalized.sum(axis=1) / recent_observed.sum(axis=1)
+        level = np.nan_to_num(level)
+        return np.maximum(index[:, np.arange(horizon) % cls.SEASON] * level[:, None], 0.0)
+
+    @classmethod
+    def history_matrix(cls, rows, current, first_months=None):
+        """Arrange (key, month index, amount) rows into keys, history and current month arrays
+
+        history covers the HISTORY_MONTHS before current; a key's months before
+        first_months[key] (default: its earliest row) are NaN.
+        """
+        keys = {}
+        series = np.fromiter((keys.setdefault(key, len(keys)) for key, _, _ in rows),
+                             np.int64, len(rows))
+        months = np.fromiter((index for _, index, _ in rows), np.int64, len(rows))
+        amounts = np.fromiter((float(amount) for _, _, amount in rows), float, len(rows))
+
+        first = current - cls.HISTORY_MONTHS
+        history = np.zeros((len(keys), cls.HISTORY_MONTHS + 1))
+        np.add.at(history, (series, months - first), amounts)
+        earliest = np.full(len(keys), current)
+        np.minimum.at(earliest, series, months)
+        if first_months is not None:
+            earliest = np.fromiter((first_months[key] for key in keys), np.int64, len(keys))
+        history[np.arange(cls.HISTORY_MONTHS + 1) + first < earliest[:, None]] = np.nan
+        return list(keys), history[:, :-1], np.nan_to_num(history[:, -1])
+
+    def forecast(self, user_id, today, load_rows, fingerprint):
+        """Return the user's CashFlowForecast as of today
+
+        load_rows(start, end) returns (type, category, year, month, amount)
+        rows for the months from start up to end (exclusive); fingerprint
+        identifies the state of the completed months, such as their row count
+        and sum.
+        """
+        current = month_index(today)
+        this_month, next_month = month_start(current), month_start(current + 1)
+        cached = self._cache.get(user_id)
+        if cached is None or cached[:2] != (current, fingerprint):
+            rows = [((trans_type, category), year * 12 + month - 1, amount)
+                    for trans_type, category, year, month, amount
+                    in load_rows(month_start(current - self.HISTORY_MONTHS), this_month)]
+            first = min((index for _, index, _ in rows), default=current)
+            keys, history, _ = self.history_matrix(rows, current,
+                                                   {key: first for key, _, _ in rows})
+            projected = self.project(history, self.horizon + 1)
+            cached = self._cache[user_id] = (current, fingerprint, keys, projected)
+        _, _, keys, projected = cached
+
+        actual = {(trans_type, category): float(amount) for trans_type, category, _, _, amount
+                  in load_rows(this_month, next_month)}
+        known = set(keys)
+        new_keys = [key for key in actual if key not in known]
+        keys = keys + new_keys
+        projected = np.vstack([projected, np.zeros((len(new_keys), self.horizon + 1))])
+        actual = np.fromiter((actual.get(key, 0.0) for key in keys), float, len(keys))
+
+        days = calendar.monthrange(today.year, today.month)[1]
+        months = [(day.year, day.month) for day in
+                  (month_start(current + step) for step in range(self.horizon + 1))]
+        return CashFlowForecast(keys, months, actual, projected, today.day / days)
+
+
+def forecast_all(database, today, horizon=3, fx=None):
+    """Forecast every user's series in one query and one vectorized pass
+
+    Returns (keys, months, month_end, projected) with keys (user id, type,
+    category) and projected holding the months after this one. Amounts are
+    in each user's reporting currency; for this batch job other currencies
+    are converted at the rate of the first day of their month (fx, loaded
+    from database if not given).
+    """
+    current = month_index(today)
+    first = current - CashFlowForecaster.HISTORY_MONTHS
+    start, end = month_start(first), month_start(current + 1)
+    if FinanceData(database).has_monthly_totals():
+        rows = database.fetchall(
+            """SELECT m.user_id, m.type, c.name, m.year, m.month, m.currency, m.total 
+            FROM monthly_totals m 
+            JOIN categories c ON c.id = m.category_id 
+            WHERE m.year BETWEEN %s AND %s AND m.count > 0""",
+            (start.year, today.year))
+    else:
+        rows = database.fetchall(
+            """SELECT t.user_id, t.type, c.name, t.year, t.month, t.currency, t.total 
+            FROM (SELECT user_id, type, category_id, YEAR(date) AS year, MONTH(date) AS month, 
+                  currency, SUM(amount) AS total 
+                  FROM transactions 
+                  WHERE date >= %s AND date < %s 
+                  GROUP BY user_id, type, category_id, YEAR(date), MONTH(date), currency) t 
+            JOIN categories c ON c.id = t.category_id""",
+            (start, end))
+
+    user_currencies = dict(database.fetchall("SELECT id, currency FROM users"))
+    by_target = {}
+    for user_id, trans_type, category, year, month, currency, amount in rows:
+        index = year * 12 + month - 1
+        if first <= index <= current:
+            by_target.setdefault(user_currencies.get(user_id, FX_BASE_CURRENCY), []).append(
+                ((user_id, trans_type, category, index), currency, month_start(index), amount))
+    if fx is None:
+        fx = FxRates()
+        fx.load(database)
+    rows = [((user_id, trans_type, category), index, amount)
+            for target, target_rows in by_target.items()
+            for (user_id, trans_type, category, index), amount
+            in fx.sum_converted(target_rows, target).items()]
+    # A user's history starts at their first month, whichever category it was in
+    user_first = {}
+    for (user_id, _, _), index, _ in rows:
+        user_first[user_id] = min(user_first.get(user_id, current), index)
+    first_months = {key: user_first[key[0]] for key, _, _ in rows}
+
+    keys, history, actual = CashFlowForecaster.history_matrix(rows, current, first_months)
+    projected = CashFlowForecaster.project(history, horizon + 1)
+    elapsed = today.day / calendar.monthrange(today.year, today.month)[1]
+    month_end = actual + projected[:, 0] * (1 - elapsed)
+    months = [(day.year, day.month) for day in
+              (month_start(current + step) for step in range(1, horizon + 1))]
+    return keys, months, month_end, projected[:, 1:]
+
+
+class AnomalyDetector:
+    """Flags likely duplicate transactions and unusual amounts with sorted, grouped NumPy passes
+
+    Works on columns (ids, cents, group, day ordinals) such as the snapshot's,
+    where group identifies a category, type and currency. Everything is a sort
+    followed by comparisons of neighbours or per-group statistics, so the
+    cost is O(n log n) rather than pairwise.
+    """
+    DUPLICATE_DAYS = 3   # same amount and category this close together is a likely duplicate
+    MIN_GROUP = 8        # categories with fewer transactions are not scored for outliers
+    IQR_FACTOR = 3.0     # outside Q1 - k*IQR .. Q3 + k*IQR
+    Z_THRESHOLD = 3.5
+
+    def __init__(self, ids, cents, groups, dates):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.cents = np.asarray(cents, dtype=np.int64)
+        self.groups = np.asarray(groups, dtype=np.int64)
+        self.dates = np.asarray(dates, dtype=np.int64)
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        groups = ((snapshot.categories.astype(np.int64) * 2 + snapshot.is_income)
+                  * max(len(snapshot.currency_names), 1) + snapshot.currencies)
+        return cls(snapshot.ids, snapshot.cents, groups, snapshot.dates)
+
+    @classmethod
+    def from_rows(cls, rows):
+        """Build from (id, amount, category, type, date, description) rows"""
+        count = len(rows)
+        codes = {}
+        return cls(
+            np.fromiter((row[0] for row in rows), np.int64, count),
+            np.fromiter((Money.of(row[1]).cents for row in rows), np.int64, count),
+            np.fromiter((codes.setdefault((row[2], row[3], getattr(row[1], 'currency', None)),
+                                          len(codes)) for row in rows), np.int64, count),
+            np.fromiter((TransactionSnapshot._ordinal(row[4]) for row in rows), np.int64, count))
+
+    def duplicates(self, days=None):
+        """Return a mask of the rows that have a twin (same group and amount) within days"""
+        days = self.DUPLICATE_DAYS if days is None else days
+        order = np.lexsort((self.dates, self.cents, self.groups))
+        groups, cents, dates = self.groups[order], self.cents[order], self.dates[order]
+        # Sorted by date within (group, amount), a close pair is always a neighbouring pair
+        close = ((groups[1:] == groups[:-1]) & (cents[1:] == cents[:-1])
+                 & (dates[1:] - dates[:-1] <= days))
+        flagged = np.zeros(len(order), dtype=bool)
+        flagged[1:] |= close
+        flagged[:-1] |= close
+        mask = np.zeros(len(order), dtype=bool)
+        mask[order] = flagged
+        return mask
+
+    def outliers(self, method='iqr'):
+        """Return a mask of the amounts far from the rest of their group
+
+        method is 'iqr' (outside the interquartile fences) or 'zscore' (more
+        than Z_THRESHOLD standard deviations from the group mean).
+        """
+        if not len(self.ids):
+            return np.zeros(0, dtype=bool)
+        uniques, inverse, counts = np.unique(self.groups, return_inverse=True,
+                                             return_counts=True)
+        inverse = inverse.reshape(-1)
+        values = self.cents.astype(float)
+
+        if method == 'zscore':
+            sums = np.bincount(inverse, weights=values)
+            squares = np.bincount(inverse, weights=values * values)
+            mean = sums / counts
+            std = np.sqrt(np.maximum(squares / counts - mean * mean, 0.0))
+            with np.errstate(invalid='ignore', divide='ignore'):
+                score = np.abs(values - mean[inverse]) / std[inverse]
+            flagged = np.nan_to_num(score) > self.Z_THRESHOLD
+        elif method == 'iqr':
+            # Quantiles per group from one sort: group g occupies starts[g]..starts[g] + counts[g]
+            order = np.lexsort((values, inverse))
+            ordered = values[order]
+            starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+
+            def quantile(q):
+                position = starts + q * (counts - 1)
+                low = np.floor(position).astype(np.int64)
+                high = np.minimum(low + 1, starts + counts - 1)
+                return ordered[low] + (ordered[high] - ordered[low]) * (position - low)
+
+            q1, q3 = quantile(0.25), quantile(0.75)
+            spread = (q3 - q1) * self.IQR_FACTOR
+            flagged = ((values < (q1 - spread)[inverse]) | (values > (q3 + spread)[inverse]))
+        else:
+            raise ValueError(f"Unknown outlier method: {method}")
+        return flagged & (counts[inverse] >= self.MIN_GROUP)
+
+    def flags(self, method='iqr'):
+        """Return {transaction id: 'duplicate' or 'outlier'}; duplicates win"""
+        result = dict.fromkeys(self.ids[self.outliers(method)].tolist(), 'outlier')
+        result.update(dict.fromkeys(self.ids[self.duplicates()].tolist(), 'duplicate'))
+        return result
+
+
+# Report charts, rendered with the object-oriented matplotlib API
+def save_report_chart(fig, path):
+    # JPEG embeds into the PDF as-is; PNG alpha channels are re-encoded pixel by pixel by FPDF
+    fig.savefig(path, dpi=150, facecolor='white', pil_kwargs={'quality': 90})
+
+
+def render_bar_chart(path, title, labels, values, color, currency=None):
+    """Render a bar chart of amounts in currency to an image file and return its path"""
+    fig = Figure(figsize=(8, 4.5), dpi=100)
+    ax = fig.add_subplot(111)
+    bars = ax.bar(labels, values, color=color)
+    ax.set_title(title, fontsize=12)
+    for bar in bars:
+        ax.text(bar.get_x() + bar.get_width() / 2, bar.get_height(),
+                format_money(round(bar.get_height() * 100), currency),
+                ha='center', va='bottom', fontsize=8)
+    for label in ax.get_xticklabels():
+        label.set_rotation(30)
+        label.set_horizontalalignment('right')
+    fig.tight_layout()
+    save_report_chart(fig, path)
+    return path
+
+
+def render_pie_chart(path, title, labels, values, colors, currency=None):
+    """Render a pie chart of amounts in currency to an image file and return its path"""
+    fig = Figure(figsize=(8, 4.5), dpi=100)
+    ax = fig.add_subplot(111)
+    ax.pie(values, labels=[f"{label}\n{format_money(round(value * 100), currency)}"
+                           for label, value in zip(labels, values)],
+           autopct=lambda p: f"{p:.1f}%", startangle=140, colors=colors, textprops={'fontsize': 8})
+    ax.set_title(title, fontsize=12)
+    fig.tight_layout()
+    save_report_chart(fig, path)
+    return path
+
+
+def render_trend_chart(path, title, months, series):
+    """Render one line per category over the given months to an image file and return its path"""
+    fig = Figure(figsize=(8, 4.5), dpi=100)
+    ax = fig.add_subplot(111)
+    for name, values in series.items():
+        ax.plot(months, values, marker='o', markersize=3, label=name)
+    ax.set_title(title, fontsize=12)
+    ax.legend(fontsize=7, ncol=2)
+    fig.tight_layout()
+    save_report_chart(fig, path)
+    return path
+
+
+def trend_bucket(start, end, max_points=400):
+    """Return the coarsest of 'day', 'week' and 'month' needed to keep a range under max_points"""
+    days = (end - start).days
+    if days <= max_points:
+        return 'day'
+    if days / 7 <= max_points:
+        return 'week'
+    return 'month'
+
+
+def bucket_start(day, bucket):
+    """Return the first day of the bucket containing day"""
+    if bucket == 'week':
+        return day - timedelta(days=day.weekday())
+    if bucket == 'month':
+        return day.replace(day=1)
+    return day
+
+
+def daily_heatmap_grid(series, start, end):
+    """Lay {date: amount} out as a 7 x weeks grid (Monday first row), NaN outside start..end"""
+    first = bucket_start(start, 'week')
+    weeks = (end - first).days // 7 + 1
+    grid = np.full(weeks * 7, np.nan)
+    offsets = np.arange((end - start).days + 1) + (start - first).days
+    grid[offsets] = 0.0
+    if series:
+        days = np.fromiter(((day - first).days for day in series), np.int64, len(series))
+        grid[days] = np.fromiter((float(amount) for amount in series.values()), float,
+                                 len(series))
+    return grid.reshape(weeks, 7).T, first
+
+
+def monthly_heatmap_grid(series, first_year, last_year):
+    """Lay {month start: amount} out as a years x 12 grid"""
+    grid = np.zeros((last_year - first_year + 1, 12))
+    for day, amount in series.items():
+        grid[day.year - first_year, day.month - 1] += float(amount)
+    return grid
+
+
+class FinanceReport(FPDF):
+    """Multi-page PDF report: summary, wrapped transaction table and embedded charts"""
+
+    TABLE_COLUMNS = [("Date", 25, 'L'), ("Amount", 28, 'R'), ("Category", 35, 'L'),
+                     ("Type", 20, 'L'), ("Description", 82, 'L')]
+    LINE_HEIGHT = 5
+    CHART_RATIO = 4.5 / 8
+
+    def __init__(self, report_title):
+        super().__init__()
+        self.report_title = report_title
+        self._text_widths = {}
+        self.set_auto_page_break(True, margin=15)
+        self.alias_nb_pages()
+
+    def footer(self):
+        self.set_y(-12)
+        self.set_font("Arial", 'I', 8)
+        self.cell(0, 6, f"Page {self.page_no()}/{{nb}}", 0, 0, 'C')
+
+    @staticmethod
+    def latin1(text):
+        # The core PDF fonts only cover Latin-1
+        return str(text).encode('latin-1', 'replace').decode('latin-1')
+
+    def text_width(self, text):
+        """Width of text at the current font, cached since descriptions reuse the same words"""
+        key = (self.font_family, self.font_style, self.font_size_pt, text)
+        width = self._text_widths.get(key)
+        if width is None:
+            width = self._text_widths[key] = self.get_string_width(text)
+        return width
+
+    def wrap(self, text, width):
+        """Split text into lines that fit in a cell of the given width at the current font"""
+        width -= 2 * self.c_margin
+        space = self.text_width(" ")
+        lines = []
+        for paragraph in self.latin1(text).splitlines() or [""]:
+            words = paragraph.split(" ")
+            widths = [self.text_width(word) for word in words]
+            if sum(widths) + space * (len(words) - 1) <= width:
+                lines.append(paragraph)
+                continue
+
+            line, line_width = None, 0
+            for word, word_width in zip(words, widths):
+                if line is not None and line_width + space + word_width <= width:
+                    line += " " + word
+                    line_width += space + word_width
+                    continue
+                if line is not None:
+                    lines.append(line)
+                while word_width > width:
+                    cut = len(word) - 1
+                    while cut > 1 and self.get_string_width(word[:cut]) > width:
+                        cut -= 1
+                    lines.append(word[:cut])
+                    word = word[cut:]
+                    word_width = self.text_width(word)
+                line, line_width = word, word_width
+            lines.append(line)
+        return lines
+
+    def table_header(self):
+        self.set_font("Arial", 'B', 9)
+        self.set_fill_color(230, 230, 230)
+        for title, width, _ in self.TABLE_COLUMNS:
+            self.cell(width, 7, title, 1, 0, 'C', True)
+        self.ln()
+        self.set_font("Arial", '', 8)
+
+    def table(self, rows):
+        """Lay out rows of cell texts, wrapping long values and repeating the header on new pages
+
+        A row that fits on a page is moved to the next page whole; a longer
+        one is split and continues below the header of the next page.
+        """
+        self.table_header()
+        max_lines = int((self.page_break_trigger - self.t_margin - 7) // self.LINE_HEIGHT)
+
+        for row in rows:
+            cells = [self.wrap(value, width)
+                     for value, (_, width, _) in zip(row, self.TABLE_COLUMNS)]
+            total = max(len(lines) for lines in cells)
+            start = 0
+            while start < total:
+                remaining = total - start
+                room = int((self.page_break_trigger - self.get_y()) // self.LINE_HEIGHT)
+                if remaining > room and (remaining <= max_lines or room < 1):
+                    self.add_page()
+                    self.table_header()
+                    continue
+                count = min(remaining, room)
+                self.table_lines(cells, start, count)
+                start += count
+
+    def table_lines(self, cells, start, count):
+        """Draw lines start .. start + count of a row's wrapped cells, with their borders"""
+        height = count * self.LINE_HEIGHT
+        x, y = self.l_margin, self.get_y()
+        for lines, (_, width, align) in zip(cells, self.TABLE_COLUMNS):
+            self.rect(x, y, width, height)
+            for i, line in enumerate(lines[start:start + count]):
+                self.set_xy(x, y + i * self.LINE_HEIGHT)
+                self.cell(width, self.LINE_HEIGHT, line, 0, 0, align)
+            x += width
+        self.set_xy(self.l_margin, y + height)
+
+    def charts(self, paths):
+        """Add the chart images, two per page"""
+        self.add_page()
+        self.set_font("Arial", 'B', 12)
+        self.cell(0, 10, "Charts", 0, 1)
+
+        width = self.w - self.l_margin - self.r_margin
+        height = width * self.CHART_RATIO
+        for path in paths:
+            if self.get_y() + height > self.page_break_trigger:
+                self.add_page()
+            self.image(path, x=self.l_margin, y=self.get_y(), w=width)
+            self.set_y(self.get_y() + height + 5)
+
+    @staticmethod
+    def standard_charts(month_label, monthly, yearly, trend, primary_color, colors, currency=None):
+        """Return the (render function, args) jobs for the monthly, YTD and category trend charts
+
+        monthly and yearly map category -> amount in currency, trend maps
+        (month, category) -> amount.
+        """
+        jobs = []
+        if monthly:
+            jobs.append((render_bar_chart, (f"Expenses by Category - {month_label}",
+                                            list(monthly), [float(v) for v in monthly.values()],
+                                            primary_color, currency)))
+        if yearly:
+            total = sum(Money.of(value, currency) for value in yearly.values())
+            total = format_money(total.cents, total.currency)
+            jobs.append((render_pie_chart, (f"Year-to-Date Expenses - Total {total}",
+                                            list(yearly), [float(v) for v in yearly.values()],
+                                            [colors[i % len(colors)] for i in range(len(yearly))],
+                                            currency)))
+        if trend:
+            months = [calendar.month_abbr[m] for m in range(1, 13)]
+            series = {}
+            for (month, category), amount in sorted(trend.items()):
+                series.setdefault(category, [0.0] * 12)[month - 1] = float(amount)
+            jobs.append((render_trend_chart, ("Monthly Expenses by Category", months, series)))
+        return jobs
+
+    def build(self, path, summary, rows, charts):
+        """Write the report
+
+        summary is a list of text lines, rows a list of cell texts matching
+        TABLE_COLUMNS and charts a list of (render function, args) jobs.
+        """
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            self.add_page()
+            self.set_font("Arial", 'B', 16)
+            self.cell(0, 10, self.latin1(self.report_title), 0, 1, 'C')
+            self.ln(5)
+
+            self.set_font("Arial", 'B', 12)
+            self.cell(0, 10, "Transaction Summary", 0, 1)
+            self.set_font("Arial", '', 10)
+            for line in summary:
+                self.cell(0, 6, self.latin1(line), 0, 1)
+            self.ln(5)
+
+            self.set_font("Arial", 'B', 12)
+            self.cell(0, 10, "Transaction Details", 0, 1)
+            self.table(rows)
+
+            paths = [render(os.path.join(tmp_dir, f"chart_{i}.jpg"), *args)
+                     for i, (render, args) in enumerate(charts)]
+            if paths:
+                self.charts(paths)
+            self.output(path)
+
+
+class SchemaMigrations:
+    """Ordered, idempotent schema migrations recorded in the schema_version table
+
+    Every step tolerates being run against a database that already has its
+    changes (tables created by older releases have no schema_version rows),
+    so an interrupted migration can simply be run again. Heavy steps, which
+    rewrite or scan large tables, are only applied at startup while the
+    database is still empty; otherwise they wait for 'python main.py
+    --migrate' while the light steps after them are applied. The
+    application must keep working without them, except for the REQUIRED
+    ones it runs at startup behind a progress dialog, and they must work
+    when applied after later steps.
+    """
+
+    # (version, description, method, heavy)
+    MIGRATIONS = [
+        (1, "Create users, transactions and budgets", "create_base_tables", False),
+        (2, "Add transactions.client_key for write-behind", "add_client_key", True),
+        (3, "Create deleted_transactions for undo", "create_deleted_transactions", False),
+        (4, "Move categories to a dimension table", "create_categories", True),
+        (5, "Track a data version per user", "create_change_feed", False),
+        (6, "Maintain monthly totals per category", "create_monthly_totals", True),
+        (7, "Create recurring transaction rules", "create_recurring_rules", False),
+        (8, "Add transaction currencies and exchange rates", "add_currencies", False),
+        (9, "Index transactions by user and date", "add_transactions_date_index", True),
+    ]
+
+    # Heavy steps the application cannot run without, so it applies them at startup anyway
+    # (offline, read-only, if that fails). Without 2 only write-behind is unavailable.
+    REQUIRED = {4}
+
+    def __init__(self, database):
+        self.database = database
+
+    @property
+    def latest(self):
+        return self.MIGRATIONS[-1][0]
+
+    def applied_versions(self):
+        try:
+            return {row[0] for row in self.database.fetchall("SELECT version FROM schema_version")}
+        except ProgrammingError as err:
+            if err.errno == 1146:  # no schema_version table yet
+                return set()
+            raise
+
+    def pending(self):
+        applied = self.applied_versions()
+        return [migration for migration in self.MIGRATIONS if migration[0] not in applied]
+
+    def has_data(self):
+        try:
+            return self.database.fetchone("SELECT 1 FROM transactions LIMIT 1") is not None
+        except ProgrammingError as err:
+            if err.errno == 1146:
+                return False
+            raise
+
+    def migrate(self, include_heavy=False, include=()):
+        """Apply the pending migrations in order and return the ones deferred
+
+        Heavy migrations are skipped unless include_heavy is set, their
+        version is in include, or there is no data for them to process.
+        """
+        pending = self.pending()
+        if not pending:
+            return []
+        if any(heavy for _, _, _, heavy in pending) and not self.has_data():
+            include_heavy = True
+
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INT PRIMARY KEY,
+                description VARCHAR(200) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        deferred = []
+        for migration in pending:
+            version, description, method, heavy = migration
+            if heavy and not include_heavy and version not in include:
+                logging.warning(f"Deferring heavy schema migration {version} ({description}); "
+                                f"run 'python main.py --migrate'")
+                deferred.append(migration)
+                continue
+            started = time.perf_counter()
+            getattr(self, method)()
+            self.database.execute(
+                "INSERT INTO schema_version (version, description) VALUES (%s, %s)",
+                (version, description))
+            logging.info(f"Applied schema migration {version} ({description}) in "
+                         f"{time.perf_counter() - started:.1f}s")
+        return deferred
+
+    def table_exists(self, table):
+        return bool(self.database.fetchone("""
+            SELECT COUNT(*) FROM information_schema.TABLES 
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s
+        """, (table,))[0])
+
+    def index_exists(self, table, index):
+        return bool(self.database.fetchone("""
+            SELECT COUNT(*) FROM information_schema.STATISTICS 
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND INDEX_NAME = %s
+        """, (table, index))[0])
+
+    def column_exists(self, table, column):
+        return bool(self.database.fetchone("""
+            SELECT COUNT(*) FROM information_schema.COLUMNS 
+            WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s AND COLUMN_NAME = %s
+        """, (table, column))[0])
+
+    # Migrations
+    def create_base_tables(self):
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS users (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                username VARCHAR(50) UNIQUE NOT NULL,
+                password VARCHAR(255) NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS transactions (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                category VARCHAR(50) NOT NULL,
+                type ENUM('Income', 'Expense') NOT NULL,
+                date DATE NOT NULL,
+                description TEXT,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """)
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS budgets (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                category VARCHAR(50) NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                UNIQUE (user_id, category)
+            )
+        """)
+
+    def add_client_key(self):
+        # Idempotency key for write-behind inserts
+        if not self.column_exists("transactions", "client_key"):
+            self.database.execute("""
+                ALTER TABLE transactions 
+                ADD COLUMN client_key CHAR(32) NULL AFTER description, 
+                ADD UNIQUE (client_key)
+            """)
 
-# Configure logging
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    filename='finance_tracker.log'
-)
+    def create_deleted_transactions(self):
+        # Deleted transactions, kept until the undo window has passed
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS deleted_transactions (
+                id INT PRIMARY KEY,
+                user_id INT NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                category VARCHAR(50) NOT NULL,
+                type ENUM('Income', 'Expense') NOT NULL,
+                date DATE NOT NULL,
+                description TEXT,
+                client_key CHAR(32) NULL,
+                created_at TIMESTAMP NULL,
+                undo_key CHAR(32) NOT NULL,
+                deleted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                INDEX (user_id, undo_key),
+                INDEX (deleted_at)
+            )
+        """)
+
+    def create_categories(self):
+        """Replace the category strings of transactions, budgets and deleted_transactions with ids
+
+        Each step is guarded, so an interrupted migration resumes where it stopped.
+        """
+        self.create_categories_table()
+
+        for table in ("transactions", "budgets", "deleted_transactions"):
+            if not self.column_exists(table, "category"):
+                continue
+            logging.info(f"Migrating {table}.category to category ids")
+            trans_type = "x.type" if table != "budgets" else "'Expense'"
+
+            # Strings that are not built-in categories become categories of their user
+            self.database.execute(f"""
+                INSERT IGNORE INTO categories (user_id, name, type) 
+                SELECT DISTINCT x.user_id, x.category, {trans_type} 
+                FROM {table} x 
+                WHERE NOT EXISTS (SELECT 1 FROM categories c 
+                                  WHERE c.user_id = 0 AND c.name = x.category)
+            """)
+            if not self.column_exists(table, "category_id"):
+                self.database.execute(f"""
+                    ALTER TABLE {table} ADD COLUMN category_id SMALLINT UNSIGNED NULL AFTER amount
+                """)
+            self.database.execute(f"""
+                UPDATE {table} x 
+                JOIN categories c ON c.name = x.category AND c.user_id IN (0, x.user_id) 
+                SET x.category_id = c.id 
+                WHERE x.category_id IS NULL
+            """)
+
+            changes = ["MODIFY category_id SMALLINT UNSIGNED NOT NULL"]
+            if table != "deleted_transactions":
+                changes.append("ADD FOREIGN KEY (category_id) REFERENCES categories(id)")
+            if table == "budgets":
+                changes.append("ADD UNIQUE KEY user_category (user_id, category_id)")
+                changes += [f"DROP INDEX `{row[0]}`" for row in self.database.fetchall("""
+                    SELECT DISTINCT INDEX_NAME FROM information_schema.STATISTICS 
+                    WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'budgets' 
+                    AND COLUMN_NAME = 'category'
+                """)]
+            changes.append("DROP COLUMN category")
+            self.database.execute(f"ALTER TABLE {table} " + ", ".join(changes))
+
+    def create_categories_table(self):
+        # Category dimension: built-in categories have user_id 0
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS categories (
+                id SMALLINT UNSIGNED AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL DEFAULT 0,
+                name VARCHAR(50) NOT NULL,
+                type ENUM('Income', 'Expense') NOT NULL,
+                UNIQUE (user_id, name)
+            )
+        """)
+        self.database.executemany(
+            "INSERT IGNORE INTO categories (user_id, name, type) VALUES (0, %s, %s)",
+            [(name, 'Expense') for name in DEFAULT_EXPENSE_CATEGORIES] +
+            [(name, 'Income') for name in DEFAULT_INCOME_CATEGORIES])
+
+    def create_change_feed(self):
+        """Create the per-user version counter and the triggers that bump it"""
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS user_data_versions (
+                user_id INT PRIMARY KEY,
+                version BIGINT UNSIGNED NOT NULL DEFAULT 0,
+                FOREIGN KEY (user_id) REFERENCES users(id)
+            )
+        """)
+
+        try:
+            existing = {row[0] for row in self.database.fetchall("""
+                SELECT TRIGGER_NAME FROM information_schema.TRIGGERS 
+                WHERE TRIGGER_SCHEMA = DATABASE()
+            """)}
+            for table in VERSIONED_TABLES:
+                for event, row in (("INSERT", "NEW"), ("UPDATE", "NEW"), ("DELETE", "OLD")):
+                    name = f"{table}_{event.lower()}_version"
+                    if name in existing:
+                        continue
+                    self.database.execute(f"""
+                        CREATE TRIGGER {name} AFTER {event} ON {table} 
+                        FOR EACH ROW 
+                        INSERT INTO user_data_versions (user_id, version) 
+                        VALUES ({row}.user_id, 1) 
+                        ON DUPLICATE KEY UPDATE version = version + 1
+                    """)
+        except Error as e:
+            # Creating triggers may need privileges the account lacks; the app works without it
+            logging.warning(f"Change feed unavailable, dashboard will not auto-refresh: {e}")
+
+    def create_monthly_totals(self):
+        """Create the monthly_totals rollup, kept current by triggers on transactions
+
+        Without the triggers the rollup would go stale, so it is dropped again
+        if they cannot be created and reports keep grouping transactions.
+        Run with the application closed: rows written during the backfill
+        may be counted twice.
+        """
+        # Totals are per currency once transactions have one (migration 8 may come first)
+        currency = self.column_exists("transactions", "currency")
+        self.database.execute(f"""
+            CREATE TABLE IF NOT EXISTS monthly_totals (
+                user_id INT NOT NULL,
+                year SMALLINT NOT NULL,
+                month TINYINT NOT NULL,
+                category_id SMALLINT UNSIGNED NOT NULL,
+                type ENUM('Income', 'Expense') NOT NULL,
+                {"currency CHAR(3) NOT NULL DEFAULT 'USD'," if currency else ""}
+                total DECIMAL(14,2) NOT NULL,
+                count INT NOT NULL,
+                PRIMARY KEY (user_id, type, year, month, category_id{", currency" if currency else ""})
+            )
+        """)
+        if not self.create_monthly_totals_triggers(currency):
+            self.database.execute("DROP TABLE monthly_totals")
+            return
+
+        columns = "user_id, YEAR(date), MONTH(date), category_id, type" + (
+            ", currency" if currency else "")
+        self.database.execute(f"""
+            REPLACE INTO monthly_totals 
+            (user_id, year, month, category_id, type{", currency" if currency else ""}, 
+             total, count) 
+            SELECT {columns}, SUM(amount), COUNT(*) 
+            FROM transactions 
+            GROUP BY {columns}
+        """)
+
+    MONTHLY_TOTALS_TRIGGERS = ("transactions_insert_totals", "transactions_delete_totals",
+                               "transactions_update_totals")
+
+    def create_monthly_totals_triggers(self, currency):
+        """Create the missing triggers keeping monthly_totals current; returns False on failure"""
+        add = f"""INSERT INTO monthly_totals 
+            (user_id, year, month, category_id, type{", currency" if currency else ""}, 
+             total, count) 
+            VALUES (NEW.user_id, YEAR(NEW.date), MONTH(NEW.date), NEW.category_id, NEW.type, 
+                    {"NEW.currency, " if currency else ""}NEW.amount, 1) 
+            ON DUPLICATE KEY UPDATE total = total + NEW.amount, count = count + 1"""
+        subtract = f"""UPDATE monthly_totals 
+            SET total = total - OLD.amount, count = count - 1 
+            WHERE user_id = OLD.user_id AND type = OLD.type AND year = YEAR(OLD.date) 
+            AND month = MONTH(OLD.date) AND category_id = OLD.category_id
+            {"AND currency = OLD.currency" if currency else ""}"""
+        insert, delete, update = self.MONTHLY_TOTALS_TRIGGERS
+        triggers = {
+            insert: f"AFTER INSERT ON transactions FOR EACH ROW {add}",
+            delete: f"AFTER DELETE ON transactions FOR EACH ROW {subtract}",
+            update: f"AFTER UPDATE ON transactions FOR EACH ROW BEGIN {subtract}; {add}; END",
+        }
+        try:
+            existing = {row[0] for row in self.database.fetchall("""
+                SELECT TRIGGER_NAME FROM information_schema.TRIGGERS 
+                WHERE TRIGGER_SCHEMA = DATABASE()
+            """)}
+            for name, body in triggers.items():
+                if name not in existing:
+                    self.database.execute(f"CREATE TRIGGER {name} {body}")
+        except Error as e:
+            logging.warning(f"Monthly totals unavailable, reports will group transactions: {e}")
+            for name in triggers:
+                self.database.execute(f"DROP TRIGGER IF EXISTS {name}")
+            return False
+        return True
+
+    def create_recurring_rules(self):
+        # The category foreign key needs the table while migration 4 is deferred
+        self.create_categories_table()
+        # next_date is the watermark: the first occurrence not yet materialized
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS recurring_rules (
+                id INT AUTO_INCREMENT PRIMARY KEY,
+                user_id INT NOT NULL,
+                amount DECIMAL(10,2) NOT NULL,
+                category_id SMALLINT UNSIGNED NOT NULL,
+                type ENUM('Income', 'Expense') NOT NULL,
+                description TEXT,
+                schedule VARCHAR(100) NOT NULL,
+                end_date DATE NULL,
+                next_date DATE NOT NULL,
+                active BOOLEAN NOT NULL DEFAULT TRUE,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                FOREIGN KEY (user_id) REFERENCES users(id),
+                FOREIGN KEY (category_id) REFERENCES categories(id),
+                INDEX (active, next_date)
+            )
+        """)
+
+    def add_currencies(self):
+        """Give amounts a currency (existing rows are FX_BASE_CURRENCY) and add exchange rates
+
+        users.currency is the reporting currency; budgets are in it.
+        """
+        for table in ("transactions", "deleted_transactions", "recurring_rules", "users"):
+            if not self.column_exists(table, "currency"):
+                self.database.execute(f"""
+                    ALTER TABLE {table} 
+                    ADD COLUMN currency CHAR(3) NOT NULL DEFAULT '{FX_BASE_CURRENCY}'
+                """)
+        # Value of one unit of currency in FX_BASE_CURRENCY from effective_date on
+        self.database.execute("""
+            CREATE TABLE IF NOT EXISTS fx_rates (
+                currency CHAR(3) NOT NULL,
+                effective_date DATE NOT NULL,
+                rate DECIMAL(18,8) NOT NULL,
+                PRIMARY KEY (currency, effective_date)
+            )
+        """)
+
+        if self.table_exists("monthly_totals") and not self.column_exists("monthly_totals",
+                                                                          "currency"):
+            # Existing totals are all in the base currency; the triggers must now key on it
+            for name in self.MONTHLY_TOTALS_TRIGGERS:
+                self.database.execute(f"DROP TRIGGER IF EXISTS {name}")
+            self.database.execute(f"""
+                ALTER TABLE monthly_totals 
+                ADD COLUMN currency CHAR(3) NOT NULL DEFAULT '{FX_BASE_CURRENCY}' AFTER type, 
+                DROP PRIMARY KEY, 
+                ADD PRIMARY KEY (user_id, type, year, month, category_id, currency)
+            """)
+            if not self.create_monthly_totals_triggers(True):
+                self.database.execute("DROP TABLE monthly_totals")
+
+    def add_transactions_date_index(self):
+        # The list, the dashboard and the reports all filter one user's rows by date
+        if not self.index_exists("transactions", "user_date"):
+            self.database.execute("ALTER TABLE transactions ADD INDEX user_date (user_id, date)")
+
+
+class FinanceData:
+    """Queries and writes for one user, independent of the UI
+
+    The application and the command-line tools share this class so that
+    they issue exactly the same SQL. Report queries go through reads, a
+    ReplicaRouter when replicas are configured; everything else uses the
+    primary database, which is the user's shard when sharding is set up.
+    Exchange rates are shared and come from reference (the shard directory).
+    """
+
+    def __init__(self, database, user_id=None, reads=None, fx=None, reference=None):
+        self.database = database
+        self.reads = reads or database
+        self.reference = reference or database
+        self.fx = fx or FxRates()
+        self._user_id = user_id
+        self._category_ids = None
+        self._category_types = None
+        self._category_names = None
+        self._currency = None
+        self._has_monthly_totals = None
+        self._has_client_keys = None
+
+    @property
+    def user_id(self):
+        return self._user_id
+
+    @user_id.setter
+    def user_id(self, user_id):
+        self._user_id = user_id
+        self._category_ids = None
+        self._category_names = None
+        self._currency = None
+
+    # Categories
+    def category_ids(self):
+        """Return {name: id} of the built-in categories and the user's own, cached"""
+        if self._category_ids is None:
+            rows = self.database.fetchall(
+                "SELECT id, name, type FROM categories WHERE user_id IN (0, %s) "
+                "ORDER BY user_id DESC", (self.user_id or 0,))
+            self._category_ids = {name: category_id for category_id, name, _ in rows}
+            self._category_types = {name: trans_type for _, name, trans_type in rows}
+        return self._category_ids
+
+    def check_category(self, name, trans_type):
+        """Raise ValueError if name is already a category of the other type
+
+        Names are unique per user whatever the type, so an income and an
+        expense category cannot share one.
+        """
+        self.category_ids()
+        existing = self._category_types.get(name)
+        if existing is not None and existing != trans_type:
+            raise ValueError(f"'{name}' is already an {existing.lower()} category")
+
+    def category_id(self, name, trans_type):
+        """Return the id of a category, creating it as one of the user's categories if needed
+
+        Raises ValueError if name is a category of the other type.
+        """
+        self.check_category(name, trans_type)
+        category_id = self.category_ids().get(name)
+        if category_id is None:
+            self.database.execute(
+                "INSERT IGNORE INTO categories (user_id, name, type) VALUES (%s, %s, %s)",
+                (self.user_id, name, trans_type))
+            self._category_ids = None
+            self.check_category(name, trans_type)  # another session may have created it
+            category_id = self.category_ids()[name]
+        return category_id
+
+    def category_name(self, category_id):
+        """Return the name of a category id, reloading the cache for categories created elsewhere"""
+        if self._category_names is None or category_id not in self._category_names:
+            self._category_ids = None
+            self._category_names = {category_id: name
+                                    for name, category_id in self.category_ids().items()}
+        return self._category_names[category_id]
+
+    def categories(self, trans_type):
+        """Return the names of the built-in and the user's categories of a type"""
+        return [row[0] for row in self.database.fetchall(
+            "SELECT name FROM categories WHERE user_id IN (0, %s) AND type = %s ORDER BY user_id, id",
+            (self.user_id or 0, trans_type))]
+
+    # Users
+    def find_user(self, username):
+        """Return (id, password hash) of a user, or None"""
+        return self.database.fetchone("user_by_username", (username,))
+
+    def username_exists(self, username):
+        return self.database.fetchone("SELECT id FROM users WHERE username = %s",
+                                      (username,)) is not None
+
+    def create_user(self, username, password_hash, user_id=None):
+        """Create a user with a zero budget for each built-in expense category and return its id
+
+        user_id is given when the shard directory allocated it.
+        """
+        with self.database.transaction():
+            user_id = self.database.execute(
+                "INSERT INTO users (id, username, password) VALUES (%s, %s, %s)",
+                (user_id, username, password_hash)).lastrowid
+
+            # Set default budgets for new user
+            self.database.execute(
+                """INSERT INTO budgets (user_id, category_id, amount) 
+                SELECT %s, id, 0 FROM categories WHERE user_id = 0 AND type = 'Expense'""",
+                (user_id,)
+            )
+        return user_id
+
+    # Currencies
+    def reporting_currency(self):
+        """Return the currency the user's totals are reported in, cached"""
+        if self._currency is None:
+            row = self.database.fetchone("SELECT currency FROM users WHERE id = %s",
+                                         (self.user_id,))
+            self._currency = row[0] if row else FX_BASE_CURRENCY
+        return self._currency
+
+    def set_reporting_currency(self, currency):
+        self.database.execute("UPDATE users SET currency = %s WHERE id = %s",
+                              (currency, self.user_id))
+        self._currency = currency
+
+    def exchange_rates(self):
+        """Return the FxRates, loading them on first use"""
+        if not self.fx.loaded:
+            self.fx.load(self.reference)
+        return self.fx
+
+    def fx_rates(self):
+        """Return (currency, effective date, rate) rows, newest first"""
+        return self.reference.fetchall(
+            "SELECT currency, effective_date, rate FROM fx_rates "
+            "ORDER BY effective_date DESC, currency")
+
+    def save_fx_rate(self, currency, effective_date, rate):
+        """Insert or replace the rate of a currency (in FX_BASE_CURRENCY per unit) from a date"""
+        self.reference.execute(
+            """INSERT INTO fx_rates (currency, effective_date, rate) VALUES (%s, %s, %s) 
+            ON DUPLICATE KEY UPDATE rate = %s""",
+            (currency, effective_date, rate, rate))
+        self.fx.load(self.reference)
+
+    def money_rows(self, rows):
+        """Attach the trailing currency column of rows to their amounts (the second column)"""
+        return [(row[0], Money.of(row[1], row[-1]), *row[2:-1]) for row in rows]
+
+    def converted_totals(self, columns, where, params):
+        """Return {group: Money} of the amounts of transactions t, in the reporting currency
+
+        columns are the SQL expressions grouped by (a group is a tuple when
+        there are several). Amounts in the reporting currency are summed by
+        the database as before; other currencies are summed per day and
+        converted at that day's rate.
+        """
+        currency = self.reporting_currency()
+        group = ", ".join(columns)
+        rows = self.reads.fetchall(f"""
+            SELECT {group}, t.currency, IF(t.currency = %s, NULL, t.date) AS day, SUM(t.amount) 
+            FROM transactions t 
+            WHERE {where} 
+            GROUP BY {group}, t.currency, day
+        """, (currency, *params))
+        width = len(columns)
+        return self.exchange_rates().sum_converted(
+            ((row[0] if width == 1 else tuple(row[:width]), *row[width:]) for row in rows),
+            currency)
+
+    def rollup_totals(self, columns, where, params, start, end, trans_type=None):
+        """Like converted_totals, from the monthly_totals rollup m where the currency allows
+
+        The rollup cannot convert by day, so months with amounts in other
+        currencies are summed from transactions for those currencies
+        (between start and end, by YEAR(date), MONTH(date) and category_id,
+        the same columns the rollup groups by).
+        """
+        currency = self.reporting_currency()
+        group = ", ".join(columns)
+        rows = self.reads.fetchall(f"""
+            SELECT {group}, m.currency, SUM(m.total) 
+            FROM monthly_totals m 
+            WHERE {where} AND m.count > 0 
+            GROUP BY {group}, m.currency
+        """, params)
+        width = len(columns)
+        totals = {}
+        for row in rows:
+            if row[width] == currency:
+                key = row[0] if width == 1 else tuple(row[:width])
+                totals[key] = Money.of(row[-1], currency)
+        if any(row[width] != currency for row in rows):
+            transaction_columns = [column.replace("m.year", "YEAR(t.date)")
+                                   .replace("m.month", "MONTH(t.date)").replace("m.", "t.")
+                                   for column in columns]
+            type_filter = "" if trans_type is None else " AND t.type = %s"
+            for key, amount in self.converted_totals(
+                    transaction_columns,
+                    f"t.user_id = %s AND t.currency <> %s AND t.date >= %s AND t.date < %s"
+                    f"{type_filter}",
+                    (self.user_id, currency, start, end,
+                     *(() if trans_type is None else (trans_type,)))).items():
+                totals[key] = totals.get(key, Money(0, currency)) + amount
+        return totals
+
+    # Transactions
+    def add_transaction(self, amount, category, trans_type, date, description):
+        """Insert a transaction; amount is Money, in the reporting currency unless it says otherwise"""
+        amount = Money.of(amount)
+        self.database.execute(
+            "insert_transaction",
+            (self.user_id, amount, amount.currency or self.reporting_currency(),
+             self.category_id(category, trans_type), trans_type, date, description)
+        )
+
+    def delete_transactions(self, transaction_ids, chunk_size=1000):
+        """Move the user's transactions to the deleted_transactions tombstone table
+
+        Each chunk is copied and deleted with one statement apiece, all in a
+        single transaction. Returns (undo key, number of rows deleted).
+        """
+        undo_key = uuid.uuid4().hex
+        transaction_ids = list(transaction_ids)
+        client_key = "client_key, " if self.has_client_keys() else ""
+        deleted = 0
+        with self.database.transaction():
+            for start in range(0, len(transaction_ids), chunk_size):
+                chunk = transaction_ids[start:start + chunk_size]
+                placeholders = ", ".join(["%s"] * len(chunk))
+                self.database.execute(f"""
+                    INSERT INTO deleted_transactions 
+                    (id, user_id, amount, currency, category_id, type, date, description, 
+                     {client_key}created_at, undo_key) 
+                    SELECT id, user_id, amount, currency, category_id, type, date, description, 
+                    {client_key}created_at, %s 
+                    FROM transactions 
+                    WHERE user_id = %s AND id IN ({placeholders})
+                """, (undo_key, self.user_id, *chunk))
+                deleted += self.database.execute(f"""
+                    DELETE FROM transactions 
+                    WHERE user_id = %s AND id IN ({placeholders})
+                """, (self.user_id, *chunk)).rowcount
+        return undo_key, deleted
+
+    def restore_transactions(self, undo_key):
+        """Undo delete_transactions; returns the restored (id, amount, category, type, date, description) rows"""
+        client_key = "client_key, " if self.has_client_keys() else ""
+        with self.database.transaction():
+            rows = self.database.fetchall("""
+                SELECT d.id, d.amount, c.name, d.type, d.date, d.description, d.currency 
+                FROM deleted_transactions d 
+                JOIN categories c ON c.id = d.category_id 
+                WHERE d.user_id = %s AND d.undo_key = %s
+            """, (self.user_id, undo_key))
+            self.database.execute(f"""
+                INSERT INTO transactions 
+                (id, user_id, amount, currency, category_id, type, date, description, 
+                 {client_key}created_at) 
+                SELECT id, user_id, amount, currency, category_id, type, date, description, 
+                {client_key}created_at 
+                FROM deleted_transactions 
+                WHERE user_id = %s AND undo_key = %s
+            """, (self.user_id, undo_key))
+            self.database.execute("""
+                DELETE FROM deleted_transactions 
+                WHERE user_id = %s AND undo_key = %s
+            """, (self.user_id, undo_key))
+        return self.money_rows(rows)
+
+    def transaction_filter(self):
+        """Return the WHERE clause and parameters for the transactions list"""
+        return "t.user_id = %s", (self.user_id,)
+
+    def list_transactions(self):
+        """Return (id, amount, category, type, date, description) rows of the list, newest first"""
+        where, params = self.transaction_filter()
+        return self.money_rows(self.reads.fetchall(f"""
+            SELECT t.id, t.amount, c.name, t.type, t.date, t.description, t.currency 
+            FROM transactions t 
+            JOIN categories c ON c.id = t.category_id 
+            WHERE {where} 
+            ORDER BY t.date DESC
+        """, params))
+
+    def transaction_totals(self):
+        """Return (income, expense) totals for the transactions list, summed by the database"""
+        where, params = self.transaction_filter()
+        totals = self.converted_totals(["t.type"], where, params)
+        zero = Money(0, self.reporting_currency())
+        return totals.get('Income', zero), totals.get('Expense', zero)
+
+    def report_rows(self):
+        """Return (date, amount, category, type, description) rows of the list, newest first"""
+        where, params = self.transaction_filter()
+        return [(date, Money.of(amount, currency), category, trans_type, description)
+                for date, amount, category, trans_type, description, currency
+                in self.reads.fetchall(f"""
+            SELECT t.date, t.amount, c.name, t.type, t.description, t.currency 
+            FROM transactions t 
+            JOIN categories c ON c.id = t.category_id 
+            WHERE {where} 
+            ORDER BY t.date DESC
+        """, params)]
+
+    # Dashboard
+    def month_totals(self):
+        """Return this month's (income, expense) totals"""
+        currency = self.reporting_currency()
+        totals = self.exchange_rates().sum_converted(
+            self.database.fetchall("month_total", (currency, self.user_id)), currency)
+        zero = Money(0, currency)
+        return totals.get('Income', zero), totals.get('Expense', zero)
+
+    def month_expenses_by_category(self):
+        """Return (category, amount) rows of this month's expenses"""
+        currency = self.reporting_currency()
+        totals = self.exchange_rates().sum_converted(
+            self.database.fetchall("month_expenses_by_category", (currency, self.user_id)),
+            currency)
+        return [(self.category_name(category_id), amount) for category_id, amount in totals.items()]
+
+    def recent_transactions(self):
+        return self.money_rows(self.database.fetchall("recent_transactions", (self.user_id,)))
+
+    def budget_total(self):
+        """Return the sum of the user's budgets, which are in the reporting currency"""
+        return Money.of(self.database.fetchone("budget_total", (self.user_id,))[0],
+                        self.reporting_currency())
+
+    def data_version(self):
+        """Return a counter that moves whenever the user's transactions or budgets change"""
+        return self.database.fetchone("data_version", (self.user_id,))[0]
+
+    # Reports; grouped on the integer category_id, names joined afterwards
+    def expenses_by_category_between(self, start, end):
+        """Return (category, amount) rows of the expenses between start and end (exclusive)"""
+        totals = self.converted_totals(
+            ["t.category_id"],
+            "t.user_id = %s AND t.type = 'Expense' AND t.date >= %s AND t.date < %s",
+            (self.user_id, start, end))
+        return [(self.category_name(category_id), amount) for category_id, amount in totals.items()]
+
+    def spending_series(self, start, end, bucket, trans_type='Expense'):
+        """Return {bucket start date: amount} between start and end (exclusive)
+
+        The database does the grouping, by day, by week (starting Monday) or
+        by month, so only one row per bucket is transferred.
+        """
+        if bucket == 'month' and self.has_monthly_totals():
+            # Whole months only: start and end are month starts for monthly buckets
+            last = end.year * 12 + end.month + (end.day > 1)
+            totals = self.rollup_totals(
+                ["m.year", "m.month"],
+                "m.user_id = %s AND m.type = %s "
+                "AND m.year * 12 + m.month >= %s AND m.year * 12 + m.month < %s",
+                (self.user_id, trans_type, start.year * 12 + start.month, last),
+                start, month_start(last - 1), trans_type)
+            return {datetime(year, month, 1).date(): total for (year, month), total in totals.items()}
+
+        group = {
+            'day': "t.date",
+            'week': "DATE_SUB(t.date, INTERVAL WEEKDAY(t.date) DAY)",
+            'month': "DATE_FORMAT(t.date, '%Y-%m-01')",
+        }[bucket]
+        totals = self.converted_totals(
+            [group], "t.user_id = %s AND t.type = %s AND t.date >= %s AND t.date < %s",
+            (self.user_id, trans_type, start, end))
+        return {(bucket_day if not isinstance(bucket_day, str)
+                 else datetime.strptime(bucket_day, "%Y-%m-%d").date()): total
+                for bucket_day, total in totals.items()}
+
+    def first_transaction_date(self):
+        return self.database.fetchone(
+            "SELECT MIN(date) FROM transactions WHERE user_id = %s", (self.user_id,))[0]
+
+    def has_monthly_totals(self):
+        """Return True once the monthly_totals rollup migration has run"""
+        if self._has_monthly_totals is None:
+            self._has_monthly_totals = bool(self.database.fetchone("""
+                SELECT COUNT(*) FROM information_schema.TABLES 
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'monthly_totals'
+            """)[0])
+        return self._has_monthly_totals
+
+    def has_client_keys(self):
+        """Return True once transactions.client_key exists (migration 2), as write-behind needs"""
+        if self._has_client_keys is None:
+            self._has_client_keys = bool(self.database.fetchone("""
+                SELECT COUNT(*) FROM information_schema.COLUMNS 
+                WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'transactions' 
+                AND COLUMN_NAME = 'client_key'
+            """)[0])
+        return self._has_client_keys
+
+    def monthly_category_totals(self, first_year, last_year, trans_type='Expense'):
+        """Return {(year, month, category): amount} for the years first_year..last_year
+
+        Read from the monthly_totals rollup when it exists, which costs the
+        same for five years as for one month; otherwise one grouped scan.
+        """
+        start, end = datetime(first_year, 1, 1).date(), datetime(last_year + 1, 1, 1).date()
+        if self.has_monthly_totals():
+            totals = self.rollup_totals(
+                ["m.year", "m.month", "m.category_id"],
+                "m.user_id = %s AND m.type = %s AND m.year BETWEEN %s AND %s",
+                (self.user_id, trans_type, first_year, last_year), start, end, trans_type)
+        else:
+            totals = self.converted_totals(
+                ["YEAR(t.date)", "MONTH(t.date)", "t.category_id"],
+                "t.user_id = %s AND t.type = %s AND t.date >= %s AND t.date < %s",
+                (self.user_id, trans_type, start, end))
+        return {(year, month, self.category_name(category_id)): total
+                for (year, month, category_id), total in totals.items()}
+
+    def category_month_totals(self, start, end):
+        """Return (type, category, year, month, amount) rows for the months from start to end
+
+        start and end are month starts; end is exclusive.
+        """
+        if self.has_monthly_totals():
+            totals = self.rollup_totals(
+                ["m.type", "m.category_id", "m.year", "m.month"],
+                "m.user_id = %s AND m.year BETWEEN %s AND %s",
+                (self.user_id, start.year, end.year), start, end)
+            totals = {key: total for key, total in totals.items()
+                      if start <= datetime(key[2], key[3], 1).date() < end}
+        else:
+            totals = self.converted_totals(
+                ["t.type", "t.category_id", "YEAR(t.date)", "MONTH(t.date)"],
+                "t.user_id = %s AND t.date >= %s AND t.date < %s", (self.user_id, start, end))
+        return [(trans_type, self.category_name(category_id), year, month, total)
+                for (trans_type, category_id, year, month), total in totals.items()]
+
+    def history_fingerprint(self, before):
+        """Return (row count, sum of amounts, reporting currency) of the transactions before a day"""
+        if self.has_monthly_totals():
+            count, total = self.reads.fetchone(
+                """SELECT COALESCE(SUM(count), 0), COALESCE(SUM(total), 0) 
+                FROM monthly_totals 
+                WHERE user_id = %s AND year * 12 + month <= %s""",
+                (self.user_id, month_index(before)))
+        else:
+            count, total = self.reads.fetchone(
+                """SELECT COUNT(*), COALESCE(SUM(amount), 0) 
+                FROM transactions WHERE user_id = %s AND date < %s""",
+                (self.user_id, before))
+        return int(count), Money.of(total), self.reporting_currency()
+
+    def ytd_expenses_by_category(self):
+        totals = self.converted_totals(
+            ["t.category_id"],
+            "t.user_id = %s AND t.type = 'Expense' AND t.date >= MAKEDATE(YEAR(CURDATE()), 1) "
+            "AND t.date < MAKEDATE(YEAR(CURDATE()) + 1, 1)",
+            (self.user_id,))
+        return [(self.category_name(category_id), amount) for category_id, amount in totals.items()]
+
+    def expense_trend(self, start, end):
+        """Return {(month, category): amount} of the expenses between start and end (exclusive)"""
+        totals = self.converted_totals(
+            ["MONTH(t.date)", "t.category_id"],
+            "t.user_id = %s AND t.type = 'Expense' AND t.date >= %s AND t.date < %s",
+            (self.user_id, start, end))
+        return {(month, self.category_name(category_id)): amount
+                for (month, category_id), amount in totals.items()}
+
+    # Budgets
+    def budgets(self):
+        """Return {category: amount} of the user's budgets"""
+        currency = self.reporting_currency()
+        return {row[0]: Money.of(row[1], currency) for row in self.database.fetchall(
+            """SELECT c.name, b.amount 
+            FROM budgets b 
+            JOIN categories c ON c.id = b.category_id 
+            WHERE b.user_id = %s""",
+            (self.user_id,))}
+
+    # Recurring transactions
+    def recurring_rules(self):
+        """Return (id, amount, category, type, schedule, next date, end date, description) rows"""
+        return self.money_rows(self.database.fetchall(
+            """SELECT r.id, r.amount, c.name, r.type, r.schedule, r.next_date, r.end_date, 
+            r.description, r.currency 
+            FROM recurring_rules r 
+            JOIN categories c ON c.id = r.category_id 
+            WHERE r.user_id = %s AND r.active = TRUE 
+            ORDER BY r.next_date""",
+            (self.user_id,)))
+
+    def add_recurring_rule(self, amount, category, trans_type, schedule, start_date, end_date,
+                           description):
+        """Store a rule; raises ValueError for a schedule that is invalid or never due"""
+        schedule = RecurrenceSchedule(schedule)
+        first = schedule.next_on_or_after(start_date)
+        if first is None or end_date and first > end_date:
+            raise ValueError("The schedule has no occurrence in the given dates")
+        amount = Money.of(amount)
+        self.database.execute(
+            """INSERT INTO recurring_rules 
+            (user_id, amount, currency, category_id, type, description, schedule, end_date, 
+             next_date) 
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)""",
+            (self.user_id, amount, amount.currency or self.reporting_currency(),
+             self.category_id(category, trans_type), trans_type, description,
+             schedule.expression, end_date, first))
+
+    def stop_recurring_rule(self, rule_id):
+        """Stop a rule; transactions it already created are kept"""
+        self.database.execute(
+            "UPDATE recurring_rules SET active = FALSE WHERE id = %s AND user_id = %s",
+            (rule_id, self.user_id))
+
+    def save_budgets(self, amounts):
+        """Insert or update the budget of every category in {category: amount}"""
+        with self.database.transaction():
+            for category, amount in amounts.items():
+                self.database.execute(
+                    """INSERT INTO budgets (user_id, category_id, amount) 
+                    VALUES (%s, %s, %s)
+                    ON DUPLICATE KEY UPDATE amount = %s""",
+                    (self.user_id, self.category_id(category, 'Expense'), amount, amount)
+                )
 
 
 class FinanceTracker:
@@ -26,8 +3081,13 @@ class FinanceTracker:
         self.root.geometry("1200x800")
 
         # Initialize database connection
-        self.db = None
-        self.cursor = None
+        self.database = Database()  # the logged in user's shard once sharded
+        self.replicas = ReplicaRouter(self.database) if REPLICA_CONFIGS else None
+        self.shards = ShardRouter(self.database) if SHARD_CONFIGS else None
+        self.data = FinanceData(self.database, reads=self.replicas)
+        self.offline = False
+        self.upgrade_notice = None  # deferred migrations already announced this session
+        self.upgrade_failed = False  # offline because a required migration could not run
         self.connect_to_database()
         self.initialize_database()
 
@@ -35,11 +3095,37 @@ class FinanceTracker:
         self.current_user = None
         self.current_username = None
 
+        # Columnar copy of the user's transactions used for dashboard and report aggregations
+        self.use_snapshot = True
+        self.snapshot = None
+
+        # Write-behind mode: new transactions are journaled locally and written in batches
+        self.use_write_behind = False
+        self.write_queue = None
+        self.write_queue_poll = None
+        self.write_queue_error = None  # why the last flush failed, until one succeeds
+
+        # Views whose data changed, redrawn together once the event queue is idle
+        self.dirty_views = set()
+        self.refresh_scheduled = None
+
+        # Bulk delete: the last deletion can be undone until undo_timer fires
+        self.undo_key = None
+        self.undo_timer = None
+        self.undo_seconds = 30
+        self.purger = None
+
+        # Change feed: the data version is polled to pick up other sessions' writes
+        self.data_version = None
+        self.change_poll = None
+        self.change_poll_interval = 5000
+
+        # Cash-flow forecasts, cached per user and refitted when past months change
+        self.forecaster = CashFlowForecaster()
+
         # Categories
-        self.EXPENSE_CATEGORIES = ["Travel", "Dining Out", "Shopping", "Entertainment",
-                                   "Transportation", "Education", "Utilities", "Health"]
-        self.INCOME_CATEGORIES = ["Rental", "Stock Income", "Social Security Benefit",
-                                  "Wage", "Tips and Bonus", "Other Income"]
+        self.EXPENSE_CATEGORIES = DEFAULT_EXPENSE_CATEGORIES
+        self.INCOME_CATEGORIES = DEFAULT_INCOME_CATEGORIES
 
         # Color Scheme
         self.PRIMARY_COLOR = "#4e73df"
@@ -58,6 +3144,20 @@ class FinanceTracker:
         # Initialize UI
         self.setup_ui()
         self.login_screen()
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+    def on_close(self):
+        """Persist the local snapshot and close the application"""
+        self.stop_purger()
+        self.stop_change_poll()
+        self.stop_write_queue()
+        self.save_snapshot()
+        if self.replicas is not None:
+            self.replicas.close()
+        if self.shards is not None:
+            self.shards.close()
+        self.database.close()
+        self.root.destroy()
 
     def setup_ui(self):
         """Initialize UI styles and settings"""
@@ -76,64 +3176,147 @@ class FinanceTracker:
     def connect_to_database(self):
         """Establish database connection"""
         try:
-            self.db = mysql.connector.connect(
-                host="localhost",
-                user="root",
-                password="root",
-                database="finance_tracker"
-            )
-            self.cursor = self.db.cursor()
+            self.database.connect()
+            self.offline = False
             logging.info("Successfully connected to database")
         except Error as e:
             logging.error(f"Database connection failed: {e}")
-            messagebox.showerror("Database Error", f"Failed to connect to database: {e}")
-            self.root.destroy()
+            self.offline = True
+            messagebox.showwarning("Database Error",
+                                   f"Failed to connect to database: {e}\n\n"
+                                   "Saved data can still be viewed offline (read-only).")
 
     def initialize_database(self):
-        """Create required tables if they don't exist"""
+        """Bring the schema up to date; a current schema costs one query
+
+        Required heavy migrations that were deferred run on a worker thread
+        behind a progress dialog; if they fail the application goes offline.
+        """
+        if self.offline:
+            return
+
         try:
-            # Create users table if not exists
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    username VARCHAR(50) UNIQUE NOT NULL,
-                    password VARCHAR(255) NOT NULL,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
+            deferred = self.migrate_databases()
+            if any(migration[0] in SchemaMigrations.REQUIRED for migration in deferred):
+                deferred = self.run_with_progress(
+                    "Upgrading Database",
+                    "Upgrading the database for this version.\nThis can take a few minutes.",
+                    lambda: self.migrate_databases(include=SchemaMigrations.REQUIRED))
+        except Error as e:
+            logging.error(f"Database migration failed: {e}")
+            self.offline = self.upgrade_failed = True
+            messagebox.showerror("Database Error",
+                                 f"Failed to initialize database: {e}\n\n"
+                                 "Run 'python main.py --migrate' while the application is closed. "
+                                 "Until then only data saved offline can be viewed (read-only).")
+            return
 
-            # Create transactions table if not exists
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    category VARCHAR(50) NOT NULL,
-                    type ENUM('Income', 'Expense') NOT NULL,
-                    date DATE NOT NULL,
-                    description TEXT,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    FOREIGN KEY (user_id) REFERENCES users(id)
-                )
-            """)
+        self.upgrade_failed = False
+        if deferred:
+            self.announce_upgrade(deferred)
+
+    def migrate_databases(self, include=()):
+        """Migrate the database, or every shard and the directory; returns the deferred steps"""
+        if self.shards is None:
+            return SchemaMigrations(self.database).migrate(include=include)
+        # Every shard, and the directory for the shared fx_rates
+        self.shards.create_directory()
+        directory = self.shards.directory
+        deferred = {migration[0]: migration for database in
+                    [directory] + [shard for shard in self.shards.shards if shard is not directory]
+                    for migration in SchemaMigrations(database).migrate(include=include)}
+        return sorted(deferred.values())
+
+    def run_with_progress(self, title, message, work):
+        """Run work() on a worker thread behind a modal progress dialog and return its result
+
+        An exception raised by work() is raised again here.
+        """
+        dialog = tk.Toplevel(self.root)
+        dialog.title(title)
+        dialog.resizable(False, False)
+        dialog.protocol("WM_DELETE_WINDOW", lambda: None)  # the work cannot be cancelled
+        tk.Label(dialog, text=message, font=("Segoe UI", 10), padx=20, pady=10).pack()
+        progress = ttk.Progressbar(dialog, mode="indeterminate", length=300)
+        progress.pack(padx=20, pady=(0, 20))
+        progress.start(10)
+
+        outcome = {}
+
+        def target():
+            try:
+                outcome["result"] = work()
+            except Exception as err:
+                outcome["error"] = err
+
+        thread = threading.Thread(target=target, name="progress-work", daemon=True)
+
+        def check():
+            if thread.is_alive():
+                dialog.after(100, check)
+            else:
+                dialog.destroy()
+
+        thread.start()
+        dialog.after(100, check)
+        dialog.grab_set()
+        self.root.wait_window(dialog)
+        if "error" in outcome:
+            raise outcome["error"]
+        return outcome["result"]
+
+    def announce_upgrade(self, deferred):
+        """Tell about the deferred heavy migrations
+
+        They are only announced again when the set of deferred versions
+        changes, so every launch does not repeat the dialog.
+        """
+        versions = ",".join(str(migration[0]) for migration in deferred)
+        if versions == self.upgrade_notice:
+            return
+        self.upgrade_notice = versions
+        notice_path = os.path.join(LOCAL_DATA_DIR, "upgrade_notice")
+        try:
+            with open(notice_path, encoding="utf-8") as f:
+                if f.read().strip() == versions:
+                    return
+        except OSError:
+            pass
 
-            # Create budgets table if not exists
-            self.cursor.execute("""
-                CREATE TABLE IF NOT EXISTS budgets (
-                    id INT AUTO_INCREMENT PRIMARY KEY,
-                    user_id INT NOT NULL,
-                    category VARCHAR(50) NOT NULL,
-                    amount DECIMAL(10,2) NOT NULL,
-                    FOREIGN KEY (user_id) REFERENCES users(id),
-                    UNIQUE (user_id, category)
-                )
-            """)
+        message = (f"{len(deferred)} database upgrade(s) take too long to run at startup:\n"
+                   + "\n".join(f"  {description}" for _, description, _, _ in deferred)
+                   + "\n\nRun 'python main.py --migrate' while the application is closed.")
+        if 2 in {migration[0] for migration in deferred}:
+            message += "\n\nWrite-behind mode is unavailable until then."
+        messagebox.showinfo("Database Upgrade Available", message)
 
-            self.db.commit()
-            logging.info("Database tables initialized successfully")
-        except Error as e:
-            logging.error(f"Database initialization failed: {e}")
-            messagebox.showerror("Database Error", f"Failed to initialize database: {e}")
+        try:
+            os.makedirs(LOCAL_DATA_DIR, exist_ok=True)
+            with open(notice_path, "w", encoding="utf-8") as f:
+                f.write(versions)
+        except OSError as e:
+            logging.warning(f"Failed to save the upgrade notice: {e}")
+
+    def use_shard(self, username):
+        """Send the user's queries to the shard holding username; returns False if it is unknown"""
+        location = self.shards.locate(username, cached=False)
+        if location is None:
+            return False
+        directory = self.shards.directory
+        self.database = self.shards.shards[location[1]]
+        reads = self.replicas if self.replicas is not None and self.database is directory else None
+        self.data = FinanceData(self.database, reads=reads, reference=directory)
+        return True
+
+    def moved_since(self, saved_at):
+        """Return True if the current user moved to another shard after saved_at
+
+        Rows get new ids when they move, so an older snapshot file cannot be caught up.
+        """
+        if self.shards is None:
+            return False
+        location = self.shards.locate(self.current_username)
+        return location is not None and location[2] is not None and location[2] >= saved_at
 
     # Helper Functions
     def hash_password(self, password):
@@ -143,16 +3326,66 @@ class FinanceTracker:
         return bcrypt.checkpw(password.encode('utf-8'), hashed.encode('utf-8'))
 
     def format_currency(self, amount):
-        return f"${float(amount):,.2f}"
+        """Format an amount in its own currency, or the reporting currency if it has none"""
+        amount = Money.of(amount)
+        return format_money(amount.cents, amount.currency or self.reporting_currency())
+
+    def reporting_currency(self):
+        """Return the current user's reporting currency (the snapshot's when offline)"""
+        if self.offline or self.current_user is None:
+            return self.snapshot.reporting_currency if self.snapshot is not None else None
+        try:
+            return self.data.reporting_currency()
+        except Error as err:
+            logging.error(f"Failed to load the reporting currency: {err}", extra={"sample": 10})
+            return None
+
+    def apply_currency(self, snapshot):
+        """Give a snapshot the user's reporting currency and exchange rates"""
+        snapshot.set_currency(self.data.exchange_rates(), self.data.reporting_currency())
+
+    def current_month_range(self):
+        """Return the first day of this month and of the next month"""
+        start = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+        end = (start + timedelta(days=32)).replace(day=1)
+        return start.date(), end.date()
+
+    def widget_exists(self, name):
+        """Return True if the widget stored in the given attribute is still on screen"""
+        widget = getattr(self, name, None)
+        return widget is not None and bool(widget.winfo_exists())
+
+    def category_names(self, trans_type):
+        """Return the categories offered for a transaction type"""
+        defaults = self.INCOME_CATEGORIES if trans_type == "Income" else self.EXPENSE_CATEGORIES
+        if self.offline:
+            return defaults
+        try:
+            return self.data.categories(trans_type)
+        except Error as err:
+            logging.error(f"Failed to load categories: {err}")
+            return defaults
+
+    def require_online(self):
+        """Show an error and return False when running from the offline snapshot"""
+        if self.offline:
+            messagebox.showerror("Offline", "The database is unavailable. "
+                                            "Offline data is read-only.")
+            return False
+        return True
 
     def validate_amount(self, amount_str):
+        """Return the amount typed as Money, or None after showing an error"""
         try:
-            amount = float(amount_str)
-            if amount <= 0:
+            amount = Money.parse(amount_str)
+            if amount <= Money(0):
                 raise ValueError("Amount must be positive")
+            if amount.cents >= 10 ** 10:
+                raise ValueError("Amount too large")  # DECIMAL(10,2)
             return amount
         except ValueError:
-            messagebox.showerror("Error", "Amount must be a positive number!")
+            messagebox.showerror("Error", "Amount must be a positive number with at most "
+                                          "two decimal places, below 100,000,000!")
             return None
 
     def validate_date(self, date_str):
@@ -168,6 +3401,13 @@ class FinanceTracker:
         for widget in self.root.winfo_children():
             widget.destroy()
 
+        self.stop_purger()
+        self.stop_change_poll()
+        self.stop_write_queue()
+        self.save_snapshot()
+        self.snapshot = None
+        self.undo_key = None
+
         self.root.configure(bg=self.PRIMARY_COLOR)
 
         # Main container with shadow effect
@@ -293,23 +3533,68 @@ class FinanceTracker:
             messagebox.showerror("Error", "Username and password are required!")
             return
 
+        if self.offline:
+            self.connect_to_database()  # the database may be back
+            if not self.offline:
+                self.initialize_database()  # leaves it offline if a required upgrade fails
+            if self.offline:
+                self.offline_login(username, password)
+                return
+
         try:
-            self.cursor.execute("SELECT id, password FROM users WHERE username = %s", (username,))
-            user = self.cursor.fetchone()
+            if self.shards is not None and not self.use_shard(username):
+                messagebox.showerror("Error", "Invalid username or password!")
+                return
+            user = self.data.find_user(username)
 
             if user and self.check_password(password, user[1]):
-                self.current_user = user[0]
+                self.current_user = self.data.user_id = user[0]
                 self.current_username = username
+                self.materialize_recurring()
+                warm_start = self.load_snapshot(user[1])
+                if (os.path.exists(self.journal_path()) and os.path.getsize(self.journal_path())
+                        and self.data.has_client_keys()):
+                    self.start_write_queue()  # replay transactions left by an earlier session
                 messagebox.showinfo("Success", "Login successful!")
                 self.main_app()
+                if warm_start:
+                    # Render from the local file first, then catch up with the database
+                    self.root.after_idle(self.sync_snapshot)
             else:
                 messagebox.showerror("Error", "Invalid username or password!")
         except Error as err:
             logging.error(f"Login failed: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def offline_login(self, username, password):
+        """Log in against the local snapshot when the database is unavailable"""
+        snapshot = self.open_snapshot_file(username)
+        if snapshot is None or not snapshot.password_hash:
+            if self.upgrade_failed:
+                messagebox.showerror("Offline", "The database needs an upgrade this version "
+                                                "could not apply. Run 'python main.py --migrate' "
+                                                "while the application is closed.")
+            else:
+                messagebox.showerror("Offline", "The database is unavailable and there is "
+                                                "no offline data for this user.")
+            return
+
+        if not self.check_password(password, snapshot.password_hash):
+            messagebox.showerror("Error", "Invalid username or password!")
+            return
+
+        self.current_user = self.data.user_id = snapshot.user_id
+        self.current_username = username
+        self.snapshot = snapshot
+        messagebox.showinfo("Offline",
+                            f"Showing data saved on {snapshot.saved_at:%Y-%m-%d %H:%M} (read-only).")
+        self.main_app()
+
     def signup(self):
         """Handle user signup"""
+        if not self.require_online():
+            return
+
         username = self.entry_username.get()
         password = self.entry_password.get()
         confirm_password = self.entry_confirm_password.get()
@@ -327,25 +3612,26 @@ class FinanceTracker:
             return
 
         try:
-            self.cursor.execute("SELECT id FROM users WHERE username = %s", (username,))
-            existing_user = self.cursor.fetchone()
-
-            if existing_user:
+            if self.shards is not None:
+                exists = self.shards.locate(username, cached=False) is not None
+            else:
+                exists = self.data.username_exists(username)
+            if exists:
                 messagebox.showerror("Error", "Username already exists!")
                 return
 
             hashed_password = self.hash_password(password)
-            self.cursor.execute("INSERT INTO users (username, password) VALUES (%s, %s)",
-                                (username, hashed_password))
-
-            # Set default budgets for new user
-            user_id = self.cursor.lastrowid
-            for category in self.EXPENSE_CATEGORIES:
-                self.cursor.execute(
-                    "INSERT INTO budgets (user_id, category, amount) VALUES (%s, %s, %s)",
-                    (user_id, category, 0)  # Default budget of 0
-                )
-            self.db.commit()
+            if self.shards is None:
+                self.data.create_user(username, hashed_password)
+            else:
+                # The directory hands out the id; the user row goes to the ring's shard
+                user_id, shard = self.shards.register(username)
+                try:
+                    FinanceData(self.shards.shards[shard]).create_user(username, hashed_password,
+                                                                       user_id)
+                except Error:
+                    self.shards.unregister(username)
+                    raise
 
             messagebox.showinfo("Success", "Account created successfully!")
             self.login_screen()
@@ -353,6 +3639,289 @@ class FinanceTracker:
             logging.error(f"Signup failed: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def snapshot_path(self, username):
+        """Return the local snapshot file of a user"""
+        name = hashlib.sha256(username.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(LOCAL_DATA_DIR, f"{name}.snap")
+
+    def open_snapshot_file(self, username):
+        """Map the user's local snapshot file, or return None if it is missing or unreadable"""
+        path = self.snapshot_path(username)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            return TransactionSnapshot.open(path)
+        except (OSError, ValueError, struct.error) as e:
+            logging.error(f"Failed to open snapshot file {path}: {e}")
+            return None
+
+    def save_snapshot(self):
+        """Write the current snapshot to its local file"""
+        if self.snapshot is None or self.offline:
+            return
+
+        try:
+            self.snapshot.save(self.snapshot_path(self.current_username))
+        except OSError as e:
+            logging.error(f"Failed to save snapshot file: {e}")
+
+    def load_snapshot(self, password_hash):
+        """Load the columnar snapshot of the current user's transactions
+
+        Returns True when it was opened from the local file and still needs
+        to be synced with the database.
+        """
+        self.snapshot = None
+        if not self.use_snapshot:
+            return False
+
+        snapshot = self.open_snapshot_file(self.current_username)
+        if (snapshot is not None and snapshot.user_id == self.current_user
+                and not self.moved_since(snapshot.saved_at)):
+            try:
+                self.apply_currency(snapshot)
+            except Error as err:
+                logging.error(f"Failed to load exchange rates for the snapshot: {err}")
+            snapshot.password_hash = password_hash
+            self.snapshot = snapshot
+            logging.info(f"Opened snapshot file with {len(snapshot)} transactions")
+            return True
+
+        try:
+            snapshot = TransactionSnapshot(self.current_user)
+            snapshot.password_hash = password_hash
+            self.apply_currency(snapshot)
+            snapshot.load(self.database)
+            snapshot.budget_total = self.data.budget_total()
+            self.snapshot = snapshot
+            logging.info(f"Loaded snapshot with {len(snapshot)} transactions")
+            self.save_snapshot()
+        except Error as err:
+            logging.error(f"Failed to load snapshot, falling back to queries: {err}")
+        return False
+
+    def sync_snapshot(self):
+        """Apply the changes made since the snapshot file was saved"""
+        if self.snapshot is None or self.offline:
+            return
+
+        self.root.update_idletasks()
+        try:
+            self.snapshot.refresh(self.database)
+            self.snapshot.budget_total = self.data.budget_total()
+        except Error as err:
+            logging.error(f"Failed to sync snapshot: {err}")
+            return
+
+        self.save_snapshot()
+        self.mark_dirty()
+
+    # Write-behind Functions
+    def journal_path(self):
+        """Return the write-behind journal of the current user"""
+        return os.path.join(LOCAL_DATA_DIR, f"journal_{self.current_user}.jsonl")
+
+    def start_write_queue(self):
+        """Start the write-behind queue for the current user if it is not running"""
+        if self.write_queue is None:
+            self.write_queue = WriteBehindQueue(self.current_user, self.journal_path(),
+                                                config=self.database.config)
+            if self.snapshot is not None:
+                for entry in self.write_queue.pending():
+                    self.snapshot.append([self.pending_row(entry)])
+        if self.write_queue_poll is None:
+            self.write_queue_poll = self.root.after(500, self.poll_write_queue)
+
+    def stop_write_queue(self):
+        """Stop the write-behind queue; unwritten entries stay in the journal"""
+        if self.write_queue_poll is not None:
+            self.root.after_cancel(self.write_queue_poll)
+            self.write_queue_poll = None
+        if self.write_queue is not None:
+            self.write_queue.stop()
+            self.write_queue = None
+        self.write_queue_error = None
+
+    def pending_row(self, entry):
+        """Return a journal entry as an (id, amount, category, type, date, description) row"""
+        return (entry["temp_id"], Money.of(entry["amount"], entry.get("currency")),
+                entry["category"], entry["type"],
+                datetime.strptime(entry["date"], "%Y-%m-%d").date(), entry["description"])
+
+    def pending_transactions(self):
+        """Return the rows waiting in the write-behind journal, newest first"""
+        if self.write_queue is None:
+            return []
+        return [self.pending_row(entry) for entry in reversed(self.write_queue.pending())]
+
+    def poll_write_queue(self):
+        """Apply write-behind results on the UI thread"""
+        self.write_queue_poll = None
+        if self.write_queue is None:
+            return
+
+        flushed, conflicts = [], []
+        while True:
+            try:
+                event = self.write_queue.events.get_nowait()
+            except queue.Empty:
+                break
+            if event[0] == 'flushed':
+                flushed.extend(event[1])
+                self.write_queue_error = None
+            elif event[0] == 'conflict':
+                conflicts.append((event[1], event[2]))
+            elif event[0] == 'retry':
+                self.write_queue_error = event[2]
+
+        if flushed and self.replicas is not None:
+            self.replicas.note_write()  # written by the queue's own connection
+
+        if flushed or conflicts:
+            if self.snapshot is not None:
+                self.snapshot.discard([entry["temp_id"] for entry in flushed] +
+                                      [entry["temp_id"] for entry, _ in conflicts])
+                self.refresh_snapshot()
+            self.mark_dirty()
+
+        self.update_pending_label()
+        if conflicts:
+            details = "\n".join(f"{entry['date']} {entry['category']} {entry['amount']}: {message}"
+                                for entry, message in conflicts)
+            messagebox.showwarning("Transactions Not Saved",
+                                   f"The database refused these transactions:\n{details}\n\n"
+                                   f"They were kept in {self.write_queue.rejected_path}")
+
+        self.write_queue_poll = self.root.after(500, self.poll_write_queue)
+
+    def update_pending_label(self):
+        """Show how many transactions are waiting to be written"""
+        if not self.widget_exists('pending_label'):
+            return
+        count = len(self.write_queue.pending()) if self.write_queue is not None else 0
+        if count and self.write_queue_error:
+            error = self.write_queue_error.splitlines()[0][:80]
+            self.pending_label.config(text=f"{count} pending, not saved yet, retrying: {error}",
+                                      fg=self.DANGER_COLOR)
+        else:
+            self.pending_label.config(text=f"{count} pending" if count else "",
+                                      fg=self.DARK_COLOR)
+
+    def toggle_write_behind(self):
+        """Switch write-behind mode from the transactions form"""
+        self.use_write_behind = self.write_behind_var.get()
+        if self.use_write_behind:
+            try:
+                available = self.data.has_client_keys()
+            except Error as err:
+                logging.error(f"Failed to check for write-behind support: {err}")
+                available = False
+            if not available:
+                self.use_write_behind = False
+                self.write_behind_var.set(False)
+                messagebox.showinfo("Write-behind Unavailable",
+                                    "Write-behind mode needs a database upgrade first. "
+                                    "Run 'python main.py --migrate' while the application "
+                                    "is closed.")
+                return
+            self.start_write_queue()
+
+    # Refresh Scheduling
+    def view_refreshers(self):
+        """Return {view: (widget attribute shown only by that view, refresh method)}"""
+        return {
+            'transactions': ('transaction_list', self.view_transactions),
+            'dashboard': ('income_label', self.update_dashboard),
+        }
+
+    def mark_dirty(self, *views):
+        """Note that the data shown by views (all views by default) changed
+
+        The refresh runs once from after_idle, so a burst of changes made
+        while handling one event costs a single redraw.
+        """
+        self.dirty_views.update(views or self.view_refreshers())
+        if self.refresh_scheduled is None:
+            self.refresh_scheduled = self.root.after_idle(self.run_refresh)
+
+    def run_refresh(self):
+        """Redraw the dirty views that are on screen; hidden views reload when shown"""
+        self.refresh_scheduled = None
+        dirty, self.dirty_views = self.dirty_views, set()
+        if not self.current_user:
+            return
+
+        self.sync_data_version()
+        for view, (widget, refresh) in self.view_refreshers().items():
+            if view in dirty and self.widget_exists(widget):
+                refresh()
+
+    # Change Feed
+    def start_change_poll(self):
+        """Start polling the data version while logged in"""
+        self.stop_change_poll()
+        if self.offline:
+            return
+        self.data_version = None
+        self.sync_data_version()
+        self.change_poll = self.root.after(self.change_poll_interval, self.poll_changes)
+
+    def stop_change_poll(self):
+        if self.change_poll is not None:
+            self.root.after_cancel(self.change_poll)
+            self.change_poll = None
+
+    def stop_purger(self):
+        """Stop purging the tombstones of the user logging out"""
+        if self.purger is not None:
+            self.purger.stop()
+            self.purger = None
+
+    def read_data_version(self):
+        """Return the user's data version, or None if it cannot be read"""
+        try:
+            return self.data.data_version()
+        except Error as err:
+            logging.warning(f"Failed to read data version: {err}", extra={"sample": 60})
+            return None
+
+    def sync_data_version(self):
+        """Record the current data version, catching the snapshot up if it moved"""
+        if self.offline:
+            return
+        version = self.read_data_version()
+        if version is not None and version != self.data_version:
+            if self.data_version is not None:
+                self.refresh_snapshot()
+            self.data_version = version
+
+    def poll_changes(self):
+        """Redraw the views when another session changed the user's data
+
+        A tick costs one primary key lookup; the views are only reloaded
+        when the version differs from the one recorded at the last refresh.
+        """
+        self.change_poll = None
+        if not self.current_user or self.offline:
+            return
+
+        version = self.read_data_version()
+        if version is not None and version != self.data_version:
+            self.mark_dirty()
+        self.change_poll = self.root.after(self.change_poll_interval, self.poll_changes)
+
+    def refresh_snapshot(self):
+        """Bring the snapshot up to date with the database"""
+        if self.snapshot is None:
+            return
+
+        try:
+            self.snapshot.refresh(self.database)
+        except Error as err:
+            logging.error(f"Failed to refresh snapshot, falling back to queries: {err}")
+            self.snapshot = None
+
     # Main Application
     def main_app(self):
         """Main application screen"""
@@ -375,7 +3944,10 @@ class FinanceTracker:
             ("Dashboard", self.show_dashboard),
             ("Transactions", self.show_transactions),
             ("Reports", self.show_reports),
-            ("Budgets", self.show_budgets)
+            ("Trends", self.show_trends),
+            ("Budgets", self.show_budgets),
+            ("Recurring", self.show_recurring),
+            ("Currencies", self.show_currencies)
         ]
 
         for text, command in nav_buttons:
@@ -396,6 +3968,9 @@ class FinanceTracker:
         self.content_area.pack(side=tk.RIGHT, fill=tk.BOTH, expand=True)
 
         self.show_dashboard()
+        self.start_change_poll()
+        if self.purger is None and not self.offline:
+            self.purger = TombstonePurger(self.current_user, self.database.config)
 
     def clear_content_area(self):
         """Clear the content area"""
@@ -412,6 +3987,7 @@ class FinanceTracker:
 
         summary_frame = tk.Frame(self.content_area, bg=self.LIGHT_COLOR)
         summary_frame.pack(fill=tk.X, padx=20, pady=10)
+        zero = self.format_currency(0)  # placeholder in the reporting currency
 
         # Income Card
         income_card = tk.Frame(summary_frame, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
@@ -422,7 +3998,7 @@ class FinanceTracker:
                  bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR).pack(pady=5)
         content = tk.Frame(income_card, bg=self.WHITE_COLOR)
         content.pack(fill=tk.BOTH, expand=True)
-        self.income_label = tk.Label(content, text="$0.00", font=("Segoe UI", 24, "bold"),
+        self.income_label = tk.Label(content, text=zero, font=("Segoe UI", 24, "bold"),
                                      bg=self.WHITE_COLOR, fg=self.PRIMARY_COLOR)
         self.income_label.pack(pady=10)
 
@@ -435,7 +4011,7 @@ class FinanceTracker:
                  bg=self.DANGER_COLOR, fg=self.WHITE_COLOR).pack(pady=5)
         content = tk.Frame(expense_card, bg=self.WHITE_COLOR)
         content.pack(fill=tk.BOTH, expand=True)
-        self.expense_label = tk.Label(content, text="$0.00", font=("Segoe UI", 24, "bold"),
+        self.expense_label = tk.Label(content, text=zero, font=("Segoe UI", 24, "bold"),
                                       bg=self.WHITE_COLOR, fg=self.DANGER_COLOR)
         self.expense_label.pack(pady=10)
 
@@ -448,7 +4024,7 @@ class FinanceTracker:
                  bg=self.SECONDARY_COLOR, fg=self.WHITE_COLOR).pack(pady=5)
         content = tk.Frame(balance_card, bg=self.WHITE_COLOR)
         content.pack(fill=tk.BOTH, expand=True)
-        self.balance_label = tk.Label(content, text="$0.00", font=("Segoe UI", 24, "bold"),
+        self.balance_label = tk.Label(content, text=zero, font=("Segoe UI", 24, "bold"),
                                       bg=self.WHITE_COLOR, fg=self.SECONDARY_COLOR)
         self.balance_label.pack(pady=10)
 
@@ -463,13 +4039,31 @@ class FinanceTracker:
         content.pack(fill=tk.BOTH, expand=True)
         budget_top = tk.Frame(content, bg=self.WHITE_COLOR)
         budget_top.pack(fill=tk.X, pady=(10, 0))
-        self.budget_label = tk.Label(budget_top, text="$0.00 / $5,000.00",
+        self.budget_label = tk.Label(budget_top, text=f"{zero} / {zero}",
                                      font=("Segoe UI", 14), bg=self.WHITE_COLOR)
         self.budget_label.pack()
         self.budget_progress = ttk.Progressbar(content, orient="horizontal",
                                                length=100, mode="determinate")
         self.budget_progress.pack(fill=tk.X, padx=10, pady=(0, 10))
 
+        # Forecast Card
+        forecast_card = tk.Frame(summary_frame, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        forecast_card.grid(row=0, column=4, padx=10, sticky="ew")
+        header = tk.Frame(forecast_card, bg=self.DARK_COLOR)
+        header.pack(fill=tk.X)
+        tk.Label(header, text="Month-End Forecast", font=("Segoe UI", 10, "bold"),
+                 bg=self.DARK_COLOR, fg=self.WHITE_COLOR).pack(pady=5)
+        content = tk.Frame(forecast_card, bg=self.WHITE_COLOR)
+        content.pack(fill=tk.BOTH, expand=True)
+        self.forecast_label = tk.Label(content, text=zero, font=("Segoe UI", 14, "bold"),
+                                       bg=self.WHITE_COLOR, fg=self.DANGER_COLOR)
+        self.forecast_label.pack(pady=(10, 0))
+        tk.Label(content, text="projected month-end spend", font=("Segoe UI", 9),
+                 bg=self.WHITE_COLOR, fg=self.DARK_COLOR).pack()
+        self.forecast_detail = tk.Label(content, text="", font=("Segoe UI", 9),
+                                        bg=self.WHITE_COLOR, justify=tk.LEFT)
+        self.forecast_detail.pack(padx=10, pady=(0, 10))
+
         # Charts and Recent Transactions
         bottom_frame = tk.Frame(self.content_area, bg=self.LIGHT_COLOR)
         bottom_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
@@ -534,6 +4128,7 @@ class FinanceTracker:
             return
 
         self.update_summary_cards()
+        self.update_forecast()
         self.update_expense_chart()
         self.update_recent_transactions()
 
@@ -544,39 +4139,33 @@ class FinanceTracker:
             if not hasattr(self, 'income_label') or not self.income_label.winfo_exists():
                 return
 
-            # Total Income
-            self.cursor.execute(
-                """SELECT COALESCE(SUM(amount), 0) 
-                FROM transactions 
-                WHERE user_id = %s AND type = 'Income' AND MONTH(date) = MONTH(CURDATE())""",
-                (self.current_user,))
-            total_income = self.cursor.fetchone()[0]
-            self.income_label.config(text=self.format_currency(total_income))
+            if self.snapshot is not None:
+                month_start, month_end = self.current_month_range()
+                totals = self.snapshot.group_by('type', month_start, month_end)
+                total_income = totals.get('Income', Money(0))
+                total_expense = totals.get('Expense', Money(0))
+            else:
+                total_income, total_expense = self.data.month_totals()
 
-            # Total Expenses
-            self.cursor.execute(
-                """SELECT COALESCE(SUM(amount), 0) 
-                FROM transactions 
-                WHERE user_id = %s AND type = 'Expense' AND MONTH(date) = MONTH(CURDATE())""",
-                (self.current_user,))
-            total_expense = self.cursor.fetchone()[0]
+            self.income_label.config(text=self.format_currency(total_income))
             self.expense_label.config(text=self.format_currency(total_expense))
 
             # Balance
             balance = total_income - total_expense
             self.balance_label.config(text=self.format_currency(balance))
-            self.balance_label.config(fg=self.SECONDARY_COLOR if balance >= 0 else self.DANGER_COLOR)
+            self.balance_label.config(fg=self.SECONDARY_COLOR if balance >= Money(0) else self.DANGER_COLOR)
 
             # Monthly Budget Progress
-            self.cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) FROM budgets WHERE user_id = %s",
-                (self.current_user,))
-            budget = self.cursor.fetchone()[0] or 2500  # Default budget if not set
+            if self.offline:
+                budget = self.snapshot.budget_total
+            else:
+                budget = self.data.budget_total()
+            budget = budget or Money(250000)  # Default budget if not set
 
-            remaining_budget = max(0, budget - total_expense)
+            remaining_budget = max(Money(0), budget - total_expense)
             self.budget_label.config(
                 text=f"{self.format_currency(remaining_budget)} / {self.format_currency(budget)}")
-            self.budget_progress['value'] = (total_expense / budget) * 100 if budget > 0 else 0
+            self.budget_progress['value'] = (total_expense / budget) * 100 if budget > Money(0) else 0
 
         except Error as err:
             logging.error(f"Failed to update summary cards: {err}")
@@ -584,16 +4173,60 @@ class FinanceTracker:
         except tk.TclError as e:
             logging.error(f"Widget error in update_summary_cards: {e}")
 
+    def user_forecast(self):
+        """Return the current user's CashFlowForecast from the snapshot or the database"""
+        today = datetime.now().date()
+        this_month, _ = self.current_month_range()
+        if self.snapshot is not None:
+            snapshot = self.snapshot
+
+            def load_rows(start, end):
+                return [(trans_type, category, year, month, amount)
+                        for (trans_type, category, (year, month)), amount
+                        in snapshot.group_by(('type', 'category', 'month'), start, end).items()]
+            fingerprint = (snapshot.count(end=this_month), snapshot.total(end=this_month))
+        else:
+            load_rows = self.data.category_month_totals
+            fingerprint = self.data.history_fingerprint(this_month)
+        return self.forecaster.forecast(self.current_user, today, load_rows, fingerprint)
+
+    def update_forecast(self):
+        """Update the forecast card with the projected month-end spend by category and net"""
+        try:
+            if not self.widget_exists('forecast_label'):
+                return
+
+            forecast = self.user_forecast()
+            expense = forecast.total('Expense')
+            budget = self.snapshot.budget_total if self.offline else self.data.budget_total()
+            budget = budget or Money(250000)  # Default budget if not set
+
+            self.forecast_label.config(
+                text=self.format_currency(expense),
+                fg=self.DANGER_COLOR if expense > float(budget) else self.SECONDARY_COLOR)
+            lines = [f"{category}: {self.format_currency(amount)}"
+                     for category, amount in forecast.top_categories('Expense')]
+            if lines:
+                lines.append("")
+            lines += [f"{calendar.month_abbr[month]} {year} net: {self.format_currency(net)}"
+                      for (year, month), net in forecast.net_by_month()]
+            self.forecast_detail.config(text="\n".join(lines))
+
+        except Error as err:
+            logging.error(f"Failed to update forecast: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+        except tk.TclError as e:
+            logging.error(f"Widget error in update_forecast: {e}")
+
     def update_expense_chart(self):
         """Update expense chart with latest data"""
         try:
-            self.cursor.execute(
-                """SELECT category, SUM(amount) 
-                FROM transactions 
-                WHERE user_id = %s AND type = 'Expense' AND MONTH(date) = MONTH(CURDATE()) 
-                GROUP BY category""",
-                (self.current_user,))
-            data = self.cursor.fetchall()
+            if self.snapshot is not None:
+                month_start, month_end = self.current_month_range()
+                data = list(self.snapshot.group_by('category', month_start, month_end,
+                                                   income=False).items())
+            else:
+                data = self.data.month_expenses_by_category()
 
             if not data:
                 for widget in self.chart_frame.winfo_children():
@@ -603,7 +4236,7 @@ class FinanceTracker:
                 return
 
             categories = [row[0] for row in data]
-            amounts = [row[1] for row in data]
+            amounts = [float(row[1]) for row in data]
 
             fig = plt.Figure(figsize=(5, 3), dpi=80, facecolor=self.LIGHT_COLOR)
             ax = fig.add_subplot(111)
@@ -617,7 +4250,7 @@ class FinanceTracker:
             for bar in bars:
                 height = bar.get_height()
                 ax.text(bar.get_x() + bar.get_width() / 2., height,
-                        f'${height:,.0f}',
+                        self.format_currency(height),
                         ha='center', va='bottom', fontsize=8)
 
             for widget in self.chart_frame.winfo_children():
@@ -637,14 +4270,12 @@ class FinanceTracker:
             for row in self.recent_transactions_list.get_children():
                 self.recent_transactions_list.delete(row)
 
-            self.cursor.execute("""
-                SELECT id, amount, category, type, date, description 
-                FROM transactions 
-                WHERE user_id = %s 
-                ORDER BY date DESC LIMIT 5
-            """, (self.current_user,))
+            if self.snapshot is not None:
+                rows = self.snapshot.rows(limit=5)
+            else:
+                rows = self.data.recent_transactions()
 
-            for row in self.cursor.fetchall():
+            for row in rows:
                 trans_id, amount, category, trans_type, date, description = row
                 formatted_amount = self.format_currency(amount)
 
@@ -656,7 +4287,7 @@ class FinanceTracker:
                 formatted_date = date_obj.strftime("%b %d")
 
                 self.recent_transactions_list.insert("", "end", values=(
-                    trans_id,
+                    trans_id if trans_id > 0 else "...",
                     formatted_amount,
                     category,
                     trans_type,
@@ -702,7 +4333,7 @@ class FinanceTracker:
             row=1, column=0, sticky="e", padx=5, pady=5)
         self.category_var = tk.StringVar()
         category_dropdown = ttk.Combobox(form_inner, textvariable=self.category_var,
-                                         values=self.EXPENSE_CATEGORIES + self.INCOME_CATEGORIES,
+                                         values=self.category_names("Expense"),
                                          font=self.LABEL_FONT)
         category_dropdown.grid(row=1, column=1, sticky="w", padx=5, pady=5)
 
@@ -716,11 +4347,9 @@ class FinanceTracker:
         type_dropdown.grid(row=1, column=3, sticky="w", padx=5, pady=5)
 
         # Update categories based on transaction type
+        # A name typed into the box that is not listed becomes a new category of the user
         def update_categories(*args):
-            if self.transaction_type_var.get() == "Income":
-                category_dropdown['values'] = self.INCOME_CATEGORIES
-            else:
-                category_dropdown['values'] = self.EXPENSE_CATEGORIES
+            category_dropdown['values'] = self.category_names(self.transaction_type_var.get())
             self.category_var.set('')
 
         self.transaction_type_var.trace('w', update_categories)
@@ -731,20 +4360,39 @@ class FinanceTracker:
         self.entry_description = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
         self.entry_description.grid(row=2, column=1, columnspan=3, sticky="ew", padx=5, pady=5)
 
+        # Row 4
+        tk.Label(form_inner, text="Currency:", font=self.LABEL_FONT, bg=self.WHITE_COLOR).grid(
+            row=3, column=0, sticky="e", padx=5, pady=5)
+        self.currency_var = tk.StringVar(value=self.reporting_currency() or FX_BASE_CURRENCY)
+        ttk.Combobox(form_inner, textvariable=self.currency_var, values=CURRENCIES,
+                     state="readonly", width=6, font=self.LABEL_FONT).grid(
+            row=3, column=1, sticky="w", padx=5, pady=5)
+
         btn_frame = tk.Frame(form_inner, bg=self.WHITE_COLOR)
-        btn_frame.grid(row=3, column=0, columnspan=4, pady=10)
+        btn_frame.grid(row=4, column=0, columnspan=4, pady=10)
 
         tk.Button(btn_frame, text="Add Transaction", command=self.add_transaction,
                   bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT, bd=0).pack(side=tk.LEFT, padx=5)
         tk.Button(btn_frame, text="Clear Form", command=self.clear_form,
                   bg=self.DARK_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT, bd=0).pack(side=tk.LEFT, padx=5)
 
+        self.write_behind_var = tk.BooleanVar(value=self.use_write_behind)
+        tk.Checkbutton(btn_frame, text="Fast entry (save in background)",
+                       variable=self.write_behind_var, command=self.toggle_write_behind,
+                       font=self.LABEL_FONT, bg=self.WHITE_COLOR).pack(side=tk.LEFT, padx=5)
+        self.pending_label = tk.Label(btn_frame, text="", font=self.LABEL_FONT,
+                                      bg=self.WHITE_COLOR, fg=self.DARK_COLOR)
+        self.pending_label.pack(side=tk.LEFT, padx=5)
+
         # Transactions list
         list_frame = tk.Frame(self.content_area, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
         list_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=(0, 20))
 
         tk.Label(list_frame, text="All Transactions", font=("Segoe UI", 12, "bold"),
                  bg=self.WHITE_COLOR).pack(pady=10)
+        self.anomaly_label = tk.Label(list_frame, text="", font=self.LABEL_FONT,
+                                      bg=self.WHITE_COLOR, fg=self.DARK_COLOR)
+        self.anomaly_label.pack()
 
         list_inner = tk.Frame(list_frame, bg=self.WHITE_COLOR)
         list_inner.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
@@ -753,6 +4401,7 @@ class FinanceTracker:
             list_inner,
             columns=("ID", "Amount", "Category", "Type", "Date", "Description"),
             show="headings",
+            selectmode="extended",
             height=15
         )
 
@@ -792,6 +4441,10 @@ class FinanceTracker:
                                             font=('Segoe UI', 10, 'bold'))
         self.transaction_list.tag_configure('balance_total', foreground='blue',
                                             font=('Segoe UI', 10, 'bold'))
+        self.transaction_list.tag_configure('pending', foreground='gray',
+                                            font=('Segoe UI', 10, 'italic'))
+        self.transaction_list.tag_configure('duplicate', background='#fff3cd')
+        self.transaction_list.tag_configure('outlier', background='#f8d7da')
 
         self.view_transactions()
 
@@ -801,6 +4454,12 @@ class FinanceTracker:
         tk.Button(btn_frame, text="Delete Selected", command=self.delete_transaction,
                   bg=self.DANGER_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT, bd=0).pack(side=tk.LEFT, padx=5)
 
+        self.undo_button = tk.Button(btn_frame, text="Undo Delete", command=self.undo_delete,
+                                     bg=self.WARNING_COLOR, fg=self.WHITE_COLOR,
+                                     font=self.BUTTON_FONT, bd=0)
+        if self.undo_key is not None:
+            self.undo_button.pack(side=tk.LEFT, padx=5)
+
         tk.Button(btn_frame, text="Export to PDF", command=self.generate_pdf,
                   bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT, bd=0).pack(side=tk.LEFT, padx=5)
 
@@ -815,6 +4474,9 @@ class FinanceTracker:
 
     def add_transaction(self):
         """Add a new transaction"""
+        if not self.require_online():
+            return
+
         # Validate amount
         amount = self.validate_amount(self.entry_amount.get())
         if amount is None:
@@ -832,40 +4494,143 @@ class FinanceTracker:
             messagebox.showerror("Error", "Category and Type are required!")
             return
 
+        currency = self.currency_var.get()
         try:
-            self.cursor.execute(
-                """INSERT INTO transactions 
-                (user_id, amount, category, type, date, description) 
-                VALUES (%s, %s, %s, %s, %s, %s)""",
-                (self.current_user, amount, category, transaction_type, date, description)
-            )
-            self.db.commit()
-            messagebox.showinfo("Success", "Transaction added successfully!")
+            self.data.check_category(category, transaction_type)
+            known = (currency == self.data.reporting_currency()
+                     or self.data.exchange_rates().has_rate(currency))
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        except Error as err:
+            logging.error(f"Failed to load exchange rates: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+            return
+        if not known:
+            messagebox.showerror("Error", f"There is no exchange rate for {currency}. "
+                                          f"Add one on the Currencies screen first.")
+            return
+        amount = Money(amount.cents, currency)
+
+        if self.use_write_behind:
+            self.enqueue_transaction(amount, category, transaction_type, date, description)
+            return
+
+        try:
+            self.data.add_transaction(amount, category, transaction_type, date, description)
+            self.refresh_snapshot()
             self.clear_form()
-            self.view_transactions()
-            self.update_dashboard()
+            self.mark_dirty()
+            messagebox.showinfo("Success", "Transaction added successfully!")
         except Error as err:
             logging.error(f"Failed to add transaction: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def enqueue_transaction(self, amount, category, transaction_type, date, description):
+        """Journal a transaction for background writing and show it right away"""
+        self.start_write_queue()
+        try:
+            entry = self.write_queue.append(amount, category, transaction_type, date, description)
+        except OSError as e:
+            logging.error(f"Failed to journal transaction: {e}")
+            messagebox.showerror("Error", f"Failed to save transaction locally: {e}")
+            return
+
+        row = self.pending_row(entry)
+        if self.snapshot is not None:
+            self.snapshot.append([row])
+        self.insert_transaction_row(0, row, 'pending')
+        self.update_pending_label()
+        self.clear_form()
+
+    def insert_transaction_row(self, index, row, tag):
+        """Insert an (id, amount, category, type, date, description) row in the transactions list"""
+        trans_id, amount, category, trans_type, date, description = row
+        self.transaction_list.insert("", index, values=(
+            trans_id if trans_id > 0 else "...",
+            self.format_currency(amount),
+            category,
+            trans_type,
+            date.strftime("%Y-%m-%d"),
+            description
+        ), tags=(tag,))
+
     def delete_transaction(self):
-        """Delete selected transaction"""
-        selected_item = self.transaction_list.selection()
-        if not selected_item:
+        """Delete the selected transactions, keeping them restorable for a short while"""
+        if not self.require_online():
+            return
+
+        items, transaction_ids = [], []
+        for item in self.transaction_list.selection():
+            tags = self.transaction_list.item(item, 'tags')
+            if 'pending' in tags:
+                messagebox.showerror("Error", "Transactions still being saved cannot be deleted!")
+                return
+            if 'income' in tags or 'expense' in tags:  # skip the total rows
+                items.append(item)
+                transaction_ids.append(int(self.transaction_list.set(item, "ID")))
+
+        if not transaction_ids:
             messagebox.showerror("Error", "Please select a transaction to delete!")
             return
 
-        transaction_id = self.transaction_list.item(selected_item)['values'][0]
         try:
-            self.cursor.execute("DELETE FROM transactions WHERE id = %s", (transaction_id,))
-            self.db.commit()
-            messagebox.showinfo("Success", "Transaction deleted successfully!")
-            self.view_transactions()
-            self.update_dashboard()
+            started = time.perf_counter()
+            self.undo_key, deleted = self.data.delete_transactions(transaction_ids)
+            logging.info(f"Deleted {deleted} transactions in {time.perf_counter() - started:.2f}s")
+            if self.snapshot is not None:
+                self.snapshot.discard(transaction_ids)
+
+            # Update the list in place instead of reloading it
+            self.transaction_list.delete(*items)
+            self.update_transaction_totals(*self.data.transaction_totals())
+            self.mark_dirty('dashboard')
+            self.show_undo(deleted)
         except Error as err:
-            logging.error(f"Failed to delete transaction: {err}")
+            logging.error(f"Failed to delete transactions: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def show_undo(self, count):
+        """Offer to undo the last deletion until the undo window closes"""
+        if self.undo_timer is not None:
+            self.root.after_cancel(self.undo_timer)
+        self.undo_timer = self.root.after(self.undo_seconds * 1000, self.expire_undo)
+        if self.widget_exists('undo_button'):
+            self.undo_button.config(text=f"Undo Delete ({count})")
+            self.undo_button.pack(side=tk.LEFT, padx=5)
+
+    def expire_undo(self):
+        self.undo_timer = None
+        self.undo_key = None
+        if self.widget_exists('undo_button'):
+            self.undo_button.pack_forget()
+
+    def undo_delete(self):
+        """Restore the transactions removed by the last deletion"""
+        if self.undo_key is None or not self.require_online():
+            return
+
+        try:
+            rows = self.data.restore_transactions(self.undo_key)
+            if self.snapshot is not None and rows:
+                self.snapshot.append(rows)
+            if self.undo_timer is not None:
+                self.root.after_cancel(self.undo_timer)
+            self.expire_undo()
+            self.mark_dirty()
+        except Error as err:
+            logging.error(f"Failed to restore transactions: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def update_transaction_totals(self, total_income, total_expense):
+        """Rewrite the total rows at the bottom of the transactions list"""
+        for tag, label, amount in (('income_total', "INCOME:", total_income),
+                                   ('expense_total', "EXPENSE:", total_expense),
+                                   ('balance_total', "BALANCE:", total_income - total_expense)):
+            for item in self.transaction_list.tag_has(tag):
+                self.transaction_list.item(item, values=(
+                    "", "", "", label, self.format_currency(amount), ""))
+
     def view_transactions(self):
         """View all transactions"""
         if not self.current_user:
@@ -876,16 +4641,19 @@ class FinanceTracker:
             self.transaction_list.delete(row)
 
         try:
-            self.cursor.execute("""
-                SELECT id, amount, category, type, date, description 
-                FROM transactions 
-                WHERE user_id = %s 
-                ORDER BY date DESC
-            """, (self.current_user,))
+            if self.offline:
+                transactions = self.snapshot.rows()
+                totals = self.snapshot.group_by('type')
+                total_income = totals.get('Income', Money(0))
+                total_expense = totals.get('Expense', Money(0))
+            else:
+                transactions = self.data.list_transactions()
+                total_income, total_expense = self.data.transaction_totals()
+
+            for row in self.pending_transactions():
+                self.insert_transaction_row("end", row, 'pending')
 
-            transactions = self.cursor.fetchall()
-            total_income = 0
-            total_expense = 0
+            flags = self.transaction_flags(transactions)
 
             for row in transactions:
                 trans_id, amount, category, trans_type, date, description = row
@@ -898,11 +4666,6 @@ class FinanceTracker:
                     date_obj = date
                 formatted_date = date_obj.strftime("%Y-%m-%d")
 
-                if trans_type == "Expense":
-                    total_expense += amount
-                else:
-                    total_income += amount
-
                 self.transaction_list.insert("", "end", values=(
                     trans_id,
                     formatted_amount,
@@ -910,7 +4673,8 @@ class FinanceTracker:
                     trans_type,
                     formatted_date,
                     description
-                ), tags=('income' if trans_type == 'Income' else 'expense'))
+                ), tags=('income' if trans_type == 'Income' else 'expense',
+                         *([flags[trans_id]] if trans_id in flags else [])))
 
             # Add total rows
             self.transaction_list.insert("", "end", values=(
@@ -929,6 +4693,24 @@ class FinanceTracker:
             logging.error(f"Failed to view transactions: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def transaction_flags(self, transactions):
+        """Return {id: 'duplicate' or 'outlier'} for the listed transactions and update the legend"""
+        started = time.perf_counter()
+        if self.snapshot is not None:
+            detector = AnomalyDetector.from_snapshot(self.snapshot)
+        else:
+            detector = AnomalyDetector.from_rows(transactions)
+        flags = detector.flags()
+        logging.debug(f"Scanned {len(detector.ids)} transactions for anomalies in "
+                      f"{time.perf_counter() - started:.3f}s")
+
+        duplicates = sum(1 for flag in flags.values() if flag == 'duplicate')
+        if self.widget_exists('anomaly_label'):
+            self.anomaly_label.config(text=(
+                f"Highlighted: {duplicates} possible duplicates (yellow), "
+                f"{len(flags) - duplicates} unusual amounts (red)") if flags else "")
+        return flags
+
     # Report Functions
     def show_reports(self):
         """Display reports screen"""
@@ -965,6 +4747,13 @@ class FinanceTracker:
                                       font=self.LABEL_FONT)
         month_dropdown.pack(side=tk.LEFT, padx=5)
 
+        tk.Label(month_controls, text="Year:",
+                 font=self.LABEL_FONT, bg=self.WHITE_COLOR).pack(side=tk.LEFT, padx=5)
+        self.report_year_var = tk.IntVar()
+        self.report_year_var.set(datetime.now().year)
+        tk.Spinbox(month_controls, textvariable=self.report_year_var, from_=1970,
+                   to=datetime.now().year, width=6, font=self.LABEL_FONT).pack(side=tk.LEFT, padx=5)
+
         tk.Button(monthly_frame, text="Generate Monthly Report",
                   command=self.generate_monthly_statement,
                   bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR,
@@ -982,35 +4771,65 @@ class FinanceTracker:
                   bg=self.SECONDARY_COLOR, fg=self.WHITE_COLOR,
                   font=self.BUTTON_FONT, bd=0).pack(pady=10)
 
+        # Comparison report section
+        comparison_frame = tk.Frame(reports_inner, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        comparison_frame.pack(fill=tk.X, pady=10)
+
+        tk.Label(comparison_frame, text="Year-over-Year Comparison",
+                 font=("Segoe UI", 10, "bold"), bg=self.WHITE_COLOR).pack(pady=10)
+
+        comparison_controls = tk.Frame(comparison_frame, bg=self.WHITE_COLOR)
+        comparison_controls.pack(pady=10)
+
+        tk.Label(comparison_controls, text="Years to compare:",
+                 font=self.LABEL_FONT, bg=self.WHITE_COLOR).pack(side=tk.LEFT, padx=5)
+        self.comparison_years_var = tk.IntVar()
+        self.comparison_years_var.set(3)
+        tk.Spinbox(comparison_controls, textvariable=self.comparison_years_var, from_=2, to=10,
+                   width=4, font=self.LABEL_FONT).pack(side=tk.LEFT, padx=5)
+
+        tk.Button(comparison_frame, text="Generate Comparison Report",
+                  command=self.generate_comparison_report,
+                  bg=self.WARNING_COLOR, fg=self.WHITE_COLOR,
+                  font=self.BUTTON_FONT, bd=0).pack(pady=10)
+
     def generate_monthly_statement(self):
         """Generate monthly statement report"""
-        month = self.month_var.get()
+        try:
+            month = self.month_var.get()
+            year = self.report_year_var.get()
+        except tk.TclError:  # the Spinbox text is empty or not a number
+            messagebox.showerror("Error", "Month and year must be numbers")
+            return
         if not 1 <= month <= 12:
             messagebox.showerror("Error", "Month must be between 1 and 12")
             return
+        if not 1 <= year <= 9999:
+            messagebox.showerror("Error", "Year must be between 1 and 9999")
+            return
+        month_start = datetime(year, month, 1).date()
+        month_end = (month_start + timedelta(days=32)).replace(day=1)
 
         try:
-            self.cursor.execute(
-                """SELECT category, SUM(amount) 
-                FROM transactions 
-                WHERE user_id = %s AND MONTH(date) = %s AND type = 'Expense' 
-                GROUP BY category""",
-                (self.current_user, month))
-            data = self.cursor.fetchall()
+            if self.snapshot is not None:
+                data = list(self.snapshot.group_by('category', month_start, month_end,
+                                                   income=False).items())
+            else:
+                data = self.data.expenses_by_category_between(month_start, month_end)
 
             if not data:
-                messagebox.showinfo("No Data",
-                                    f"No expense transactions found for {calendar.month_name[month]}")
+                messagebox.showinfo("No Data", f"No expense transactions found for "
+                                               f"{calendar.month_name[month]} {year}")
                 return
 
             categories = [row[0] for row in data]
-            amounts = [row[1] for row in data]
+            amounts = [float(row[1]) for row in data]
 
             fig = plt.figure(figsize=(10, 6))
             ax = fig.add_subplot(111)
             bars = ax.bar(categories, amounts, color=self.PRIMARY_COLOR)
 
-            ax.set_title(f"Monthly Finance Statement for {calendar.month_name[month]}",
+            ax.set_title(f"Monthly Finance Statement for {calendar.month_name[month]} {year}",
                          fontsize=14)
             ax.set_ylabel("Amount Spent", fontsize=12)
             ax.set_facecolor(self.LIGHT_COLOR)
@@ -1020,7 +4839,7 @@ class FinanceTracker:
             for bar in bars:
                 height = bar.get_height()
                 ax.text(bar.get_x() + bar.get_width() / 2, height,
-                        f"${height:,.2f}",
+                        self.format_currency(height),
                         ha='center', va='bottom',
                         fontsize=10, color='black')
 
@@ -1034,13 +4853,13 @@ class FinanceTracker:
     def generate_ytd_statement(self):
         """Generate year-to-date statement"""
         try:
-            self.cursor.execute(
-                """SELECT category, SUM(amount) 
-                FROM transactions 
-                WHERE user_id = %s AND YEAR(date) = YEAR(CURDATE()) AND type = 'Expense' 
-                GROUP BY category""",
-                (self.current_user,))
-            data = self.cursor.fetchall()
+            if self.snapshot is not None:
+                year_start = datetime(datetime.now().year, 1, 1).date()
+                year_end = datetime(datetime.now().year + 1, 1, 1).date()
+                data = list(self.snapshot.group_by('category', year_start, year_end,
+                                                   income=False).items())
+            else:
+                data = self.data.ytd_expenses_by_category()
 
             if not data:
                 messagebox.showinfo("No Data",
@@ -1048,8 +4867,8 @@ class FinanceTracker:
                 return
 
             categories = [row[0] for row in data]
-            amounts = [row[1] for row in data]
-            total_amount = sum(amounts)
+            total_amount = sum(Money.of(row[1]) for row in data)
+            amounts = [float(row[1]) for row in data]
 
             fig = plt.figure(figsize=(8, 6))
             ax = fig.add_subplot(111)
@@ -1058,14 +4877,16 @@ class FinanceTracker:
                       self.DANGER_COLOR, self.DARK_COLOR]
             wedges, texts, autotexts = ax.pie(
                 amounts,
-                labels=[f"{cat}\n${amt:,.0f}" for cat, amt in zip(categories, amounts)],
+                labels=[f"{cat}\n{self.format_currency(amt)}"
+                        for cat, amt in zip(categories, amounts)],
                 autopct=lambda p: f"{p:.1f}%",
                 startangle=140,
                 colors=colors[:len(amounts)],
                 textprops={'fontsize': 8}
             )
 
-            ax.set_title(f"Year-to-Date Finance Statement\nTotal: ${total_amount:,.2f}",
+            ax.set_title(f"Year-to-Date Finance Statement\nTotal: "
+                         f"{self.format_currency(total_amount)}",
                          fontsize=12)
             fig.patch.set_facecolor(self.LIGHT_COLOR)
 
@@ -1075,9 +4896,242 @@ class FinanceTracker:
             logging.error(f"Failed to generate YTD statement: {err}")
             messagebox.showerror("Database Error", f"An error occurred: {err}")
 
+    def comparison_totals(self, first_year, last_year):
+        """Return {(year, month, category): amount} of the expenses in the given years"""
+        if self.snapshot is not None:
+            totals = self.snapshot.group_by(('month', 'category'),
+                                            datetime(first_year, 1, 1).date(),
+                                            datetime(last_year + 1, 1, 1).date(), income=False)
+            return {(year, month, category): amount
+                    for ((year, month), category), amount in totals.items()}
+        return self.data.monthly_category_totals(first_year, last_year)
+
+    @staticmethod
+    def change(current, previous):
+        """Return the relative change as text, or an em dash without a base"""
+        if not previous:
+            return "—" if not current else "new"
+        return f"{(current - previous) / previous:+.0%}"
+
+    def generate_comparison_report(self):
+        """Compare monthly expenses across years, with month-over-month and year-over-year deltas"""
+        try:
+            years = self.comparison_years_var.get()
+        except tk.TclError:  # the Spinbox text is empty or not a number
+            messagebox.showerror("Error", "Compare between 2 and 10 years")
+            return
+        if not 2 <= years <= 10:
+            messagebox.showerror("Error", "Compare between 2 and 10 years")
+            return
+
+        today = datetime.now().date()
+        last_year, month = today.year, today.month
+        first_year = last_year - years + 1
+        try:
+            totals = self.comparison_totals(first_year, last_year)
+        except Error as err:
+            logging.error(f"Failed to generate comparison report: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+            return
+
+        if not totals:
+            messagebox.showinfo("No Data", f"No expense transactions found since {first_year}!")
+            return
+
+        # Monthly series per year, and per category: this and last month, this and last YTD
+        monthly = {year: [0.0] * 12 for year in range(first_year, last_year + 1)}
+        previous_month = (last_year, month - 1) if month > 1 else (last_year - 1, 12)
+        by_category = {}
+        for (year, m, category), amount in totals.items():
+            amount = float(amount)
+            monthly[year][m - 1] += amount
+            row = by_category.setdefault(category, [0.0, 0.0, 0.0, 0.0])
+            if (year, m) == (last_year, month):
+                row[0] += amount
+            elif (year, m) == previous_month:
+                row[1] += amount
+            if m <= month and year == last_year:
+                row[2] += amount
+            elif m <= month and year == last_year - 1:
+                row[3] += amount
+
+        fig = plt.figure(figsize=(11, 9))
+        line_ax = fig.add_subplot(311)
+        bar_ax = fig.add_subplot(312)
+        table_ax = fig.add_subplot(313)
+        fig.patch.set_facecolor(self.LIGHT_COLOR)
+
+        months = [calendar.month_abbr[m] for m in range(1, 13)]
+        for year, series in monthly.items():
+            shown = series[:month] if year == last_year else series
+            line_ax.plot(months[:len(shown)], shown, marker="o", label=str(year))
+        line_ax.set_title(f"Monthly Expenses {first_year}–{last_year}", fontsize=12)
+        line_ax.set_ylabel("Amount Spent")
+        line_ax.legend(fontsize=8, ncol=min(years, 5))
+        line_ax.set_facecolor(self.LIGHT_COLOR)
+
+        categories = sorted(by_category, key=lambda c: -by_category[c][2])
+        width = 0.8 / years
+        for i, year in enumerate(range(first_year, last_year + 1)):
+            ytd = [sum(float(totals.get((year, m, category), 0)) for m in range(1, month + 1))
+                   for category in categories]
+            bar_ax.bar([x + i * width for x in range(len(categories))], ytd, width,
+                       label=str(year))
+        bar_ax.set_xticks([x + 0.4 - width / 2 for x in range(len(categories))])
+        bar_ax.set_xticklabels(categories, rotation=30, ha="right", fontsize=8)
+        bar_ax.set_title(f"Expenses by Category, January–{calendar.month_name[month]}",
+                         fontsize=12)
+        bar_ax.legend(fontsize=8, ncol=min(years, 5))
+        bar_ax.set_facecolor(self.LIGHT_COLOR)
+
+        money = self.format_currency
+        rows = [[category, money(this), money(last), self.change(this, last),
+                 money(ytd), money(prior), self.change(ytd, prior)]
+                for category, (this, last, ytd, prior) in
+                ((category, by_category[category]) for category in categories)]
+        table_ax.axis("off")
+        table = table_ax.table(
+            cellText=rows, loc="center",
+            colLabels=["Category", calendar.month_abbr[month], calendar.month_abbr[previous_month[1]],
+                       "MoM", f"YTD {last_year}", f"YTD {last_year - 1}", "YoY"])
+        table.auto_set_font_size(False)
+        table.set_fontsize(8)
+
+        fig.tight_layout()
+        plt.show()
+
+    # Trend Functions
+    TREND_RANGES = {"Last 3 months": 91, "Last year": 365, "Last 3 years": 3 * 365,
+                    "Last 10 years": 10 * 365 + 2, "All time": None}
+
+    def show_trends(self):
+        """Display spending over time as a trend line and a calendar heatmap"""
+        self.clear_content_area()
+
+        tk.Label(self.content_area, text="Spending Trends",
+                 font=self.HEADER_FONT, bg=self.LIGHT_COLOR).pack(pady=20)
+
+        controls = tk.Frame(self.content_area, bg=self.LIGHT_COLOR)
+        controls.pack(pady=5)
+
+        tk.Label(controls, text="Range:", font=self.LABEL_FONT,
+                 bg=self.LIGHT_COLOR).pack(side=tk.LEFT, padx=5)
+        self.trend_range_var = tk.StringVar(value="Last year")
+        range_box = ttk.Combobox(controls, textvariable=self.trend_range_var, state="readonly",
+                                 values=list(self.TREND_RANGES), font=self.LABEL_FONT)
+        range_box.pack(side=tk.LEFT, padx=5)
+
+        tk.Label(controls, text="Type:", font=self.LABEL_FONT,
+                 bg=self.LIGHT_COLOR).pack(side=tk.LEFT, padx=5)
+        self.trend_type_var = tk.StringVar(value="Expense")
+        type_box = ttk.Combobox(controls, textvariable=self.trend_type_var, state="readonly",
+                                values=["Expense", "Income"], font=self.LABEL_FONT)
+        type_box.pack(side=tk.LEFT, padx=5)
+
+        range_box.bind("<<ComboboxSelected>>", lambda event: self.update_trends())
+        type_box.bind("<<ComboboxSelected>>", lambda event: self.update_trends())
+
+        self.trend_frame = tk.Frame(self.content_area, bg=self.LIGHT_COLOR)
+        self.trend_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+
+        self.update_trends()
+
+    def trend_series(self, start, end, bucket, trans_type):
+        """Return {bucket start: amount} from the snapshot or the database"""
+        if self.snapshot is not None:
+            series = self.snapshot.group_by(bucket, start, end, income=trans_type == 'Income')
+            if bucket == 'month':
+                return {datetime(year, month, 1).date(): total
+                        for (year, month), total in series.items()}
+            return series
+        return self.data.spending_series(start, end, bucket, trans_type)
+
+    def update_trends(self):
+        """Redraw the trend chart and heatmap for the selected range"""
+        today = datetime.now().date()
+        end = today + timedelta(days=1)
+        trans_type = self.trend_type_var.get()
+        days = self.TREND_RANGES[self.trend_range_var.get()]
+
+        try:
+            if days is not None:
+                start = today - timedelta(days=days - 1)
+            elif self.snapshot is not None:
+                start = (datetime.fromordinal(int(self.snapshot.dates.min())).date()
+                         if len(self.snapshot) else today)
+            else:
+                start = self.data.first_transaction_date() or today
+
+            bucket = trend_bucket(start, end)
+            if bucket != 'day':
+                start = bucket_start(start, bucket)
+            series = self.trend_series(start, end, bucket, trans_type)
+
+            # A daily calendar for up to a year, otherwise a year x month grid
+            heatmap_daily = (end - start).days <= 371
+            if heatmap_daily:
+                heat = series if bucket == 'day' else self.trend_series(start, end, 'day',
+                                                                        trans_type)
+            else:
+                heat_start = start.replace(month=1, day=1)
+                heat = series if bucket == 'month' and start == heat_start else \
+                    self.trend_series(heat_start, end, 'month', trans_type)
+        except Error as err:
+            logging.error(f"Failed to load trends: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+            return
+
+        fig = Figure(figsize=(9, 6), dpi=80, facecolor=self.LIGHT_COLOR)
+        line_ax = fig.add_subplot(211)
+        heat_ax = fig.add_subplot(212)
+
+        # Fill empty buckets with zero so gaps show as dips, not as interpolated lines
+        buckets = sorted({bucket_start(day, bucket) for day in
+                          (start + timedelta(days=i) for i in range((end - start).days))})
+        values = [float(series.get(day, 0)) for day in buckets]
+        color = self.DANGER_COLOR if trans_type == 'Expense' else self.SECONDARY_COLOR
+        line_ax.plot(buckets, values, color=color, linewidth=1)
+        line_ax.fill_between(buckets, values, alpha=0.2, color=color)
+        line_ax.set_title(f"{trans_type} per {bucket}, {start:%b %d, %Y} – {today:%b %d, %Y}",
+                          fontsize=10)
+        line_ax.set_facecolor(self.LIGHT_COLOR)
+
+        if heatmap_daily:
+            grid, first = daily_heatmap_grid(heat, start, today)
+            image = heat_ax.imshow(grid, aspect='auto', cmap='Reds' if trans_type == 'Expense'
+                                   else 'Greens', interpolation='nearest')
+            heat_ax.set_yticks(range(7))
+            heat_ax.set_yticklabels([calendar.day_abbr[i] for i in range(7)], fontsize=7)
+            month_ticks = [(week, first + timedelta(weeks=week)) for week in range(grid.shape[1])
+                           if (first + timedelta(weeks=week)).day <= 7]
+            heat_ax.set_xticks([week for week, _ in month_ticks])
+            heat_ax.set_xticklabels([f"{day:%b}" for _, day in month_ticks], fontsize=7)
+        else:
+            first_year = min(heat, default=start).year
+            grid = monthly_heatmap_grid(heat, first_year, today.year)
+            image = heat_ax.imshow(grid, aspect='auto', cmap='Reds' if trans_type == 'Expense'
+                                   else 'Greens', interpolation='nearest')
+            heat_ax.set_xticks(range(12))
+            heat_ax.set_xticklabels([calendar.month_abbr[m] for m in range(1, 13)], fontsize=7)
+            heat_ax.set_yticks(range(grid.shape[0]))
+            heat_ax.set_yticklabels([str(first_year + i) for i in range(grid.shape[0])],
+                                    fontsize=7)
+        fig.colorbar(image, ax=heat_ax, fraction=0.03)
+        heat_ax.set_title("Daily calendar" if heatmap_daily else "Monthly calendar", fontsize=10)
+        fig.tight_layout()
+
+        for widget in self.trend_frame.winfo_children():
+            widget.destroy()
+        canvas = FigureCanvasTkAgg(fig, master=self.trend_frame)
+        canvas.draw()
+        canvas.get_tk_widget().pack(fill=tk.BOTH, expand=True)
+
     # Budget Functions
     def show_budgets(self):
         """Display budget management screen"""
+        if not self.require_online():
+            return
+
         self.clear_content_area()
 
         tk.Label(self.content_area, text="Budget Management",
@@ -1094,19 +5148,19 @@ class FinanceTracker:
 
         # Load existing budgets
         try:
-            self.cursor.execute(
-                "SELECT category, amount FROM budgets WHERE user_id = %s",
-                (self.current_user,))
-            budgets = {row[0]: row[1] for row in self.cursor.fetchall()}
+            budgets = self.data.budgets()
+            currency = self.data.reporting_currency()
         except Error as err:
             logging.error(f"Failed to load budgets: {err}")
             messagebox.showerror("Database Error", f"Failed to load budgets: {err}")
             return
+        symbol = CURRENCY_SYMBOLS.get(currency, currency)
 
         self.budget_vars = {}
 
         # Create budget entries for each expense category
-        for i, category in enumerate(self.EXPENSE_CATEGORIES):
+        categories = self.category_names("Expense")
+        for i, category in enumerate(categories):
             row_frame = tk.Frame(budget_inner, bg=self.WHITE_COLOR)
             row_frame.grid(row=i, column=0, sticky="ew", pady=5)
 
@@ -1120,12 +5174,12 @@ class FinanceTracker:
                              bd=1, relief=tk.SOLID, width=15)
             entry.pack(side=tk.LEFT, padx=5)
 
-            tk.Label(row_frame, text="$", font=self.LABEL_FONT,
+            tk.Label(row_frame, text=symbol, font=self.LABEL_FONT,
                      bg=self.WHITE_COLOR).pack(side=tk.LEFT)
 
         # Save button
         btn_frame = tk.Frame(budget_inner, bg=self.WHITE_COLOR)
-        btn_frame.grid(row=len(self.EXPENSE_CATEGORIES), column=0, pady=20)
+        btn_frame.grid(row=len(categories), column=0, pady=20)
 
         tk.Button(btn_frame, text="Save Budgets", command=self.save_budgets,
                   bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR,
@@ -1133,38 +5187,344 @@ class FinanceTracker:
 
     def save_budgets(self):
         """Save budget amounts"""
-        try:
-            for category, var in self.budget_vars.items():
-                amount = self.validate_amount(var.get())
-                if amount is None:
-                    return
-
-                self.cursor.execute(
-                    """INSERT INTO budgets (user_id, category, amount) 
-                    VALUES (%s, %s, %s)
-                    ON DUPLICATE KEY UPDATE amount = %s""",
-                    (self.current_user, category, amount, amount)
-                )
+        amounts = {}
+        for category, var in self.budget_vars.items():
+            amount = self.validate_amount(var.get())
+            if amount is None:
+                return
+            amounts[category] = amount
 
-            self.db.commit()
+        try:
+            self.data.save_budgets(amounts)
+            self.mark_dirty('dashboard')
             messagebox.showinfo("Success", "Budgets saved successfully!")
-            self.update_dashboard()
         except Error as err:
             logging.error(f"Failed to save budgets: {err}")
             messagebox.showerror("Database Error", f"Failed to save budgets: {err}")
 
+    # Recurring Transactions
+    def materialize_recurring(self):
+        """Create the user's recurring transactions that fell due since the last session"""
+        try:
+            RecurringMaterializer(self.database).run(user_id=self.current_user)
+        except Error as err:
+            logging.error(f"Failed to create recurring transactions: {err}")
+
+    def show_recurring(self):
+        """Display the recurring transaction rules"""
+        if not self.require_online():
+            return
+
+        self.clear_content_area()
+
+        tk.Label(self.content_area, text="Recurring Transactions",
+                 font=self.HEADER_FONT, bg=self.LIGHT_COLOR).pack(pady=20)
+
+        form_frame = tk.Frame(self.content_area, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        form_frame.pack(fill=tk.X, padx=20, pady=10)
+
+        tk.Label(form_frame, text="New Rule", font=("Segoe UI", 12, "bold"),
+                 bg=self.WHITE_COLOR).pack(pady=10)
+
+        form_inner = tk.Frame(form_frame, bg=self.WHITE_COLOR)
+        form_inner.pack(padx=10, pady=10)
+
+        tk.Label(form_inner, text="Amount:", font=self.LABEL_FONT, bg=self.WHITE_COLOR).grid(
+            row=0, column=0, sticky="e", padx=5, pady=5)
+        self.rule_amount = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rule_amount.grid(row=0, column=1, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Type:", font=self.LABEL_FONT, bg=self.WHITE_COLOR).grid(
+            row=0, column=2, sticky="e", padx=5, pady=5)
+        self.rule_type_var = tk.StringVar(value="Expense")
+        ttk.Combobox(form_inner, textvariable=self.rule_type_var, values=["Expense", "Income"],
+                     font=self.LABEL_FONT).grid(row=0, column=3, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Category:", font=self.LABEL_FONT, bg=self.WHITE_COLOR).grid(
+            row=1, column=0, sticky="e", padx=5, pady=5)
+        self.rule_category_var = tk.StringVar()
+        rule_categories = ttk.Combobox(form_inner, textvariable=self.rule_category_var,
+                                       values=self.category_names("Expense"),
+                                       font=self.LABEL_FONT)
+        rule_categories.grid(row=1, column=1, sticky="w", padx=5, pady=5)
+
+        def update_categories(*args):
+            rule_categories['values'] = self.category_names(self.rule_type_var.get())
+            self.rule_category_var.set('')
+
+        self.rule_type_var.trace('w', update_categories)
+
+        tk.Label(form_inner, text="Schedule:", font=self.LABEL_FONT, bg=self.WHITE_COLOR).grid(
+            row=1, column=2, sticky="e", padx=5, pady=5)
+        self.rule_schedule_var = tk.StringVar(value="1 * *")
+        ttk.Combobox(form_inner, textvariable=self.rule_schedule_var,
+                     values=["1 * *", "L * *", "* * 5", "1,15 * *", "1 1,4,7,10 *"],
+                     font=self.LABEL_FONT).grid(row=1, column=3, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Start (YYYY-MM-DD):", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=2, column=0, sticky="e", padx=5, pady=5)
+        self.rule_start = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rule_start.grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        self.rule_start.insert(0, datetime.now().strftime("%Y-%m-%d"))
+
+        tk.Label(form_inner, text="End (optional):", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=2, column=2, sticky="e", padx=5, pady=5)
+        self.rule_end = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rule_end.grid(row=2, column=3, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Description:", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=3, column=0, sticky="e", padx=5, pady=5)
+        self.rule_description = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rule_description.grid(row=3, column=1, columnspan=3, sticky="ew", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Schedule: day of month, month, day of week (0 = Sunday); "
+                                  "'L' is the last day of the month",
+                 font=("Segoe UI", 8), fg=self.DARK_COLOR, bg=self.WHITE_COLOR).grid(
+            row=4, column=0, columnspan=4, pady=5)
+
+        tk.Button(form_inner, text="Add Rule", command=self.add_recurring_rule,
+                  bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT,
+                  bd=0).grid(row=5, column=0, columnspan=4, pady=10)
+
+        list_frame = tk.Frame(self.content_area, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+
+        columns = ("ID", "Amount", "Category", "Type", "Schedule", "Next", "Ends", "Description")
+        self.rule_list = ttk.Treeview(list_frame, columns=columns, show="headings", height=8)
+        for column, width in zip(columns, (40, 90, 120, 70, 100, 90, 90, 180)):
+            self.rule_list.heading(column, text=column)
+            self.rule_list.column(column, width=width, anchor="w")
+        self.rule_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        tk.Button(list_frame, text="Stop Selected Rule", command=self.stop_recurring_rule,
+                  bg=self.DANGER_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT,
+                  bd=0).pack(pady=10)
+
+        self.view_recurring_rules()
+
+    def view_recurring_rules(self):
+        for row in self.rule_list.get_children():
+            self.rule_list.delete(row)
+        try:
+            for (rule_id, amount, category, trans_type, schedule, next_date, end_date,
+                 description) in self.data.recurring_rules():
+                self.rule_list.insert("", "end", values=(
+                    rule_id, self.format_currency(amount), category, trans_type, schedule,
+                    next_date.strftime("%Y-%m-%d"),
+                    end_date.strftime("%Y-%m-%d") if end_date else "", description or ""))
+        except Error as err:
+            logging.error(f"Failed to load recurring rules: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def add_recurring_rule(self):
+        """Save a new rule and create any occurrences already due"""
+        amount = self.validate_amount(self.rule_amount.get())
+        if amount is None:
+            return
+        start_date = self.validate_date(self.rule_start.get())
+        if start_date is None:
+            return
+        end_date = None
+        if self.rule_end.get().strip():
+            end_date = self.validate_date(self.rule_end.get())
+            if end_date is None:
+                return
+
+        category = self.rule_category_var.get()
+        if not category:
+            messagebox.showerror("Error", "Category is required!")
+            return
+
+        try:
+            self.data.check_category(category, self.rule_type_var.get())
+        except ValueError as e:
+            messagebox.showerror("Error", str(e))
+            return
+        except Error as err:
+            logging.error(f"Failed to load categories: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+            return
+
+        try:
+            self.data.add_recurring_rule(amount, category, self.rule_type_var.get(),
+                                         self.rule_schedule_var.get(), start_date, end_date,
+                                         self.rule_description.get())
+            self.materialize_recurring()
+            self.refresh_snapshot()
+            self.mark_dirty()
+            self.view_recurring_rules()
+        except ValueError as e:
+            messagebox.showerror("Error", f"Invalid schedule: {e}")
+        except Error as err:
+            logging.error(f"Failed to add recurring rule: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def stop_recurring_rule(self):
+        selected = self.rule_list.selection()
+        if not selected:
+            messagebox.showerror("Error", "Please select a rule to stop!")
+            return
+        try:
+            self.data.stop_recurring_rule(int(self.rule_list.set(selected[0], "ID")))
+            self.view_recurring_rules()
+        except Error as err:
+            logging.error(f"Failed to stop recurring rule: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    # Currency Functions
+    def show_currencies(self):
+        """Display the reporting currency and the exchange rates"""
+        if not self.require_online():
+            return
+
+        self.clear_content_area()
+
+        tk.Label(self.content_area, text="Currencies",
+                 font=self.HEADER_FONT, bg=self.LIGHT_COLOR).pack(pady=20)
+
+        form_frame = tk.Frame(self.content_area, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        form_frame.pack(fill=tk.X, padx=20, pady=10)
+
+        form_inner = tk.Frame(form_frame, bg=self.WHITE_COLOR)
+        form_inner.pack(padx=10, pady=10)
+
+        tk.Label(form_inner, text="Report totals in:", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=0, column=0, sticky="e", padx=5, pady=5)
+        self.reporting_currency_var = tk.StringVar(
+            value=self.reporting_currency() or FX_BASE_CURRENCY)
+        ttk.Combobox(form_inner, textvariable=self.reporting_currency_var, values=CURRENCIES,
+                     state="readonly", width=6, font=self.LABEL_FONT).grid(
+            row=0, column=1, sticky="w", padx=5, pady=5)
+        tk.Button(form_inner, text="Apply", command=self.save_reporting_currency,
+                  bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT,
+                  bd=0).grid(row=0, column=2, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Currency:", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=1, column=0, sticky="e", padx=5, pady=5)
+        self.rate_currency_var = tk.StringVar(value=CURRENCIES[1])
+        ttk.Combobox(form_inner, textvariable=self.rate_currency_var,
+                     values=[code for code in CURRENCIES if code != FX_BASE_CURRENCY],
+                     state="readonly", width=6, font=self.LABEL_FONT).grid(
+            row=1, column=1, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text=f"{FX_BASE_CURRENCY} per unit:", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=1, column=2, sticky="e", padx=5, pady=5)
+        self.rate_entry = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rate_entry.grid(row=1, column=3, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="From (YYYY-MM-DD):", font=self.LABEL_FONT,
+                 bg=self.WHITE_COLOR).grid(row=2, column=0, sticky="e", padx=5, pady=5)
+        self.rate_date = tk.Entry(form_inner, font=self.LABEL_FONT, bd=1, relief=tk.SOLID)
+        self.rate_date.grid(row=2, column=1, sticky="w", padx=5, pady=5)
+        self.rate_date.insert(0, datetime.now().strftime("%Y-%m-%d"))
+
+        tk.Button(form_inner, text="Save Rate", command=self.save_fx_rate,
+                  bg=self.PRIMARY_COLOR, fg=self.WHITE_COLOR, font=self.BUTTON_FONT,
+                  bd=0).grid(row=2, column=3, sticky="w", padx=5, pady=5)
+
+        tk.Label(form_inner, text="Amounts are converted at the rate in effect on their date. "
+                                  "Budgets are in the reporting currency and are not converted.",
+                 font=("Segoe UI", 8), fg=self.DARK_COLOR, bg=self.WHITE_COLOR).grid(
+            row=3, column=0, columnspan=4, pady=5)
+
+        list_frame = tk.Frame(self.content_area, bg=self.WHITE_COLOR, bd=1, relief=tk.SOLID)
+        list_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=10)
+
+        columns = ("Currency", "From", "Rate")
+        self.rate_list = ttk.Treeview(list_frame, columns=columns, show="headings", height=12)
+        for column, width in zip(columns, (90, 110, 140)):
+            self.rate_list.heading(column, text=column)
+            self.rate_list.column(column, width=width, anchor="w")
+        self.rate_list.pack(fill=tk.BOTH, expand=True, padx=10, pady=10)
+
+        self.view_fx_rates()
+
+    def view_fx_rates(self):
+        for row in self.rate_list.get_children():
+            self.rate_list.delete(row)
+        try:
+            for currency, effective_date, rate in self.data.fx_rates():
+                self.rate_list.insert("", "end", values=(
+                    currency, effective_date.strftime("%Y-%m-%d"), f"{rate:f}"))
+        except Error as err:
+            logging.error(f"Failed to load exchange rates: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def save_fx_rate(self):
+        try:
+            rate = Decimal(self.rate_entry.get().strip())
+            if not rate.is_finite() or rate <= 0 or rate >= 10 ** 10:
+                raise InvalidOperation
+        except InvalidOperation:
+            messagebox.showerror("Error", "Rate must be a positive number!")
+            return
+        effective_date = self.validate_date(self.rate_date.get())
+        if effective_date is None:
+            return
+
+        try:
+            self.data.save_fx_rate(self.rate_currency_var.get(), effective_date, rate)
+            self.currency_changed()
+            self.rate_entry.delete(0, tk.END)
+            self.view_fx_rates()
+        except Error as err:
+            logging.error(f"Failed to save exchange rate: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def save_reporting_currency(self):
+        currency = self.reporting_currency_var.get()
+        try:
+            if not self.data.exchange_rates().has_rate(currency):
+                messagebox.showerror("Error", f"There is no exchange rate for {currency}. "
+                                              f"Add one first.")
+                return
+            self.data.set_reporting_currency(currency)
+            self.currency_changed()
+            messagebox.showinfo("Success", f"Totals are now reported in {currency}.")
+        except Error as err:
+            logging.error(f"Failed to change the reporting currency: {err}")
+            messagebox.showerror("Database Error", f"An error occurred: {err}")
+
+    def currency_changed(self):
+        """Reconvert the snapshot after the reporting currency or a rate changed"""
+        if self.snapshot is not None:
+            self.apply_currency(self.snapshot)
+            self.snapshot.budget_total = self.data.budget_total()
+            self.save_snapshot()
+        self.mark_dirty()
+
     # PDF Generation
+    def report_chart_data(self):
+        """Return this month's and this year's expenses by category and this year's monthly trend"""
+        month_start, month_end = self.current_month_range()
+        year_start = datetime(month_start.year, 1, 1).date()
+        year_end = datetime(month_start.year + 1, 1, 1).date()
+
+        if self.snapshot is not None:
+            monthly = self.snapshot.group_by('category', month_start, month_end, income=False)
+            yearly = self.snapshot.group_by('category', year_start, year_end, income=False)
+            trend = {(month, category): amount for ((_, month), category), amount in
+                     self.snapshot.group_by(('month', 'category'), year_start, year_end,
+                                            income=False).items()}
+            return monthly, yearly, trend
+
+        trend = self.data.expense_trend(year_start, year_end)
+
+        monthly, yearly = {}, {}
+        for (month, category), amount in trend.items():
+            yearly[category] = yearly.get(category, 0) + amount
+            if month == month_start.month:
+                monthly[category] = amount
+        return monthly, yearly, trend
+
     def generate_pdf(self):
         """Generate PDF report of transactions"""
+        if not self.require_online():
+            return
+
         try:
             # Get transactions data
-            self.cursor.execute("""
-                SELECT date, amount, category, type, description 
-                FROM transactions 
-                WHERE user_id = %s 
-                ORDER BY date DESC
-            """, (self.current_user,))
-            transactions = self.cursor.fetchall()
+            transactions = self.data.report_rows()
 
             if not transactions:
                 messagebox.showinfo("No Data", "No transactions found to export!")
@@ -1180,71 +5540,36 @@ class FinanceTracker:
             if not file_path:
                 return  # User cancelled
 
-            # Create PDF
-            pdf = FPDF()
-            pdf.add_page()
-            pdf.set_font("Arial", 'B', 16)
-
-            # Title
-            pdf.cell(0, 10, f"Financial Report for {self.current_username}", 0, 1, 'C')
-            pdf.ln(10)
-
-            # Summary
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, "Transaction Summary", 0, 1)
-            pdf.set_font("Arial", '', 10)
+            started = time.perf_counter()
 
             # Get summary data
-            self.cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = %s AND type = 'Income'",
-                (self.current_user,))
-            total_income = self.cursor.fetchone()[0]
-
-            self.cursor.execute(
-                "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = %s AND type = 'Expense'",
-                (self.current_user,))
-            total_expense = self.cursor.fetchone()[0]
-
+            total_income, total_expense = self.data.transaction_totals()
             balance = total_income - total_expense
+            summary = [f"Total Income: {self.format_currency(total_income)}",
+                       f"Total Expenses: {self.format_currency(total_expense)}",
+                       f"Balance: {self.format_currency(balance)}"]
 
-            pdf.cell(0, 6, f"Total Income: {self.format_currency(total_income)}", 0, 1)
-            pdf.cell(0, 6, f"Total Expenses: {self.format_currency(total_expense)}", 0, 1)
-            pdf.cell(0, 6, f"Balance: {self.format_currency(balance)}", 0, 1)
-            pdf.ln(10)
-
-            # Transactions table
-            pdf.set_font("Arial", 'B', 12)
-            pdf.cell(0, 10, "Transaction Details", 0, 1)
-            pdf.set_font("Arial", 'B', 10)
-
-            # Table header
-            pdf.cell(30, 6, "Date", 1)
-            pdf.cell(25, 6, "Amount", 1)
-            pdf.cell(30, 6, "Category", 1)
-            pdf.cell(25, 6, "Type", 1)
-            pdf.cell(80, 6, "Description", 1)
-            pdf.ln()
-
-            # Table rows
-            pdf.set_font("Arial", '', 8)
-            for row in transactions:
-                date, amount, category, trans_type, description = row
-
+            rows = []
+            for date, amount, category, trans_type, description in transactions:
                 # Handle date formatting
                 if isinstance(date, str):
                     date_str = date.split()[0]
                 else:
                     date_str = date.strftime("%Y-%m-%d")
+                rows.append((date_str, self.format_currency(amount), category, trans_type,
+                             description or ""))
+
+            monthly, yearly, trend = self.report_chart_data()
+            charts = FinanceReport.standard_charts(
+                datetime.now().strftime("%B %Y"), monthly, yearly, trend, self.PRIMARY_COLOR,
+                [self.PRIMARY_COLOR, self.SECONDARY_COLOR, self.WARNING_COLOR,
+                 self.DANGER_COLOR, self.DARK_COLOR], self.reporting_currency())
 
-                pdf.cell(30, 6, date_str, 1)
-                pdf.cell(25, 6, self.format_currency(amount), 1)
-                pdf.cell(30, 6, category, 1)
-                pdf.cell(25, 6, trans_type, 1)
-                pdf.cell(80, 6, description or "", 1)
-                pdf.ln()
+            pdf = FinanceReport(f"Financial Report for {self.current_username}")
+            pdf.build(file_path, summary, rows, charts)
 
-            # Save PDF
-            pdf.output(file_path)
+            logging.info(f"PDF report with {len(rows)} transactions generated in "
+                         f"{time.perf_counter() - started:.2f}s")
             messagebox.showinfo("Success", f"PDF report saved successfully at:\n{file_path}")
 
         except Exception as e:
@@ -1252,8 +5577,172 @@ class FinanceTracker:
             messagebox.showerror("Error", f"Failed to generate PDF: {str(e)}")
 
 
+def connect_shards():
+    """Return the connected directory database (DB_CONFIG) and shard databases, for batch jobs
+
+    The directory is also a shard when DB_CONFIG is listed in SHARD_CONFIGS
+    or nothing is sharded.
+    """
+    directory = Database()
+    shards = []
+    try:
+        directory.connect()
+        for config in shard_configs():
+            if config == DB_CONFIG:
+                shards.append(directory)
+            else:
+                shards.append(Database(config))
+                shards[-1].connect()
+    except Error:
+        close_shards(directory, shards)
+        raise
+    return directory, shards
+
+
+def close_shards(directory, shards):
+    directory.close()
+    for shard in shards:
+        shard.close()
+
+
+def forecast_command(output):
+    """Forecast every user's cash flow and write it as CSV to output ('-' for stdout)"""
+    directory, shards = Database(), []
+    try:
+        directory, shards = connect_shards()
+        started = time.perf_counter()
+        today = datetime.now().date()
+        fx = FxRates()
+        fx.load(directory)  # rates are shared by the shards
+        keys, month_end, projected = [], [], []
+        for database in shards:
+            shard_keys, months, shard_month_end, shard_projected = forecast_all(database, today,
+                                                                                fx=fx)
+            keys += shard_keys
+            month_end.append(shard_month_end)
+            projected.append(shard_projected)
+        month_end, projected = np.concatenate(month_end), np.vstack(projected)
+        elapsed = time.perf_counter() - started
+
+        stream = sys.stdout if output == "-" else open(output, "w", newline="", encoding="utf-8")
+        try:
+            writer = csv.writer(stream)
+            writer.writerow(["user_id", "type", "category", "month", "amount"])
+            current = f"{today:%Y-%m}"
+            for row, (user_id, trans_type, category) in enumerate(keys):
+                writer.writerow([user_id, trans_type, category, current, f"{month_end[row]:.2f}"])
+                for (year, month), amount in zip(months, projected[row]):
+                    writer.writerow([user_id, trans_type, category, f"{year}-{month:02d}",
+                                     f"{amount:.2f}"])
+        finally:
+            if stream is not sys.stdout:
+                stream.close()
+        print(f"Forecast {len(keys)} series for {len({key[0] for key in keys})} users "
+              f"in {elapsed:.2f}s", file=sys.stderr)
+        return 0
+    except (Error, OSError) as err:
+        logging.error(f"Forecasting failed: {err}")
+        print(f"Forecasting failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        close_shards(directory, shards)
+
+
+def migrate_command():
+    """Apply every pending schema migration, including heavy ones, to every database"""
+    directory, shards = Database(), []
+    try:
+        directory, shards = connect_shards()
+        if SHARD_CONFIGS:
+            ShardRouter(directory, []).create_directory()
+        # The directory is migrated too, for the shared fx_rates
+        for database in [directory] + [shard for shard in shards if shard is not directory]:
+            migrations = SchemaMigrations(database)
+            pending = migrations.pending()
+            name = database.config.get("database")
+            if not pending:
+                print(f"{name}: schema is up to date (version {migrations.latest})")
+                continue
+            for version, description, _, heavy in pending:
+                print(f"  {version}: {description}{' (heavy)' if heavy else ''}")
+            started = time.perf_counter()
+            migrations.migrate(include_heavy=True)
+            print(f"{name}: migrated to version {migrations.latest} in "
+                  f"{time.perf_counter() - started:.1f}s")
+        return 0
+    except Error as err:
+        logging.error(f"Migration failed: {err}")
+        print(f"Migration failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        close_shards(directory, shards)
+
+
+def materialize_command():
+    """Create the due recurring transactions of every user"""
+    directory, shards = Database(), []
+    try:
+        directory, shards = connect_shards()
+        started = time.perf_counter()
+        inserted = sum(RecurringMaterializer(shard).run() for shard in shards)
+        print(f"Created {inserted} recurring transactions in {time.perf_counter() - started:.1f}s")
+        return 0
+    except Error as err:
+        logging.error(f"Materializing recurring transactions failed: {err}")
+        print(f"Materializing recurring transactions failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        close_shards(directory, shards)
+
+
+def purge_command():
+    """Remove the expired deleted transactions of every user"""
+    directory, shards = Database(), []
+    try:
+        directory, shards = connect_shards()
+        started = time.perf_counter()
+        removed = 0
+        for shard in shards:
+            while True:
+                count = shard.execute(TombstonePurger.PURGE_SQL, (
+                    TombstonePurger.MAX_AGE, TombstonePurger.BATCH_SIZE)).rowcount
+                removed += count
+                if count < TombstonePurger.BATCH_SIZE:
+                    break
+        print(f"Purged {removed} deleted transactions in {time.perf_counter() - started:.1f}s")
+        return 0
+    except Error as err:
+        logging.error(f"Purging deleted transactions failed: {err}")
+        print(f"Purging deleted transactions failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        close_shards(directory, shards)
+
 # Main application entry point
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Personal finance tracker")
+    parser.add_argument("--migrate", action="store_true",
+                        help="apply all pending schema migrations, including heavy ones, and exit")
+    parser.add_argument("--materialize-recurring", action="store_true",
+                        help="create the due recurring transactions of all users and exit")
+    parser.add_argument("--purge-deleted", action="store_true",
+                        help="remove every user's deleted transactions past the undo window "
+                             "and exit")
+    parser.add_argument("--forecast-all", nargs="?", const="-", metavar="CSV",
+                        help="forecast every user's cash flow to a CSV file (default: stdout) "
+                             "and exit")
+    args = parser.parse_args()
+    configure_logging()
+
+    if args.migrate:
+        sys.exit(migrate_command())
+    if args.materialize_recurring:
+        sys.exit(materialize_command())
+    if args.purge_deleted:
+        sys.exit(purge_command())
+    if args.forecast_all:
+        sys.exit(forecast_command(args.forecast_all))
+
     root = tk.Tk()
     app = FinanceTracker(root)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,280 @@
+"""Query plan regression check: python plan_check.py [options]
+
+Seeds a separate database (--database, on the DB_CONFIG server) with
+--users users of --rows transactions each, runs every FinanceData query the
+application issues for one of them, the local snapshot load and refresh,
+the write-behind insert and the batch jobs (recurring materializer,
+tombstone purges, forecast), and records each distinct statement. Every
+recorded statement is then run through EXPLAIN.
+
+The check fails (exit status 1) if any plan scans transactions (access
+type ALL, or a full index scan) or estimates more rows examined than
+--max-rows, by default twice one user's transactions; a plan that reads
+every user's rows is far above that. A filter such as MONTH(date) =
+MONTH(CURDATE()) that cannot seek on an index shows up here rather than as
+dashboard latency once the table has grown.
+
+The database is created, migrated (heavy migrations included) and seeded
+on the first run and reused afterwards; --reseed starts it over.
+"""
+import argparse
+import random
+import re
+import sys
+import uuid
+from datetime import date, timedelta
+
+import bcrypt
+import mysql.connector
+from mysql.connector import Error
+
+from main import (DB_CONFIG, FX_BASE_CURRENCY, QUERIES, Database, FinanceData, Money,
+                  RecurringMaterializer, SchemaMigrations, TombstonePurger, TransactionSnapshot,
+                  WriteBehindQueue, adapt_params, forecast_all, month_index, month_start)
+from loadtest import random_transaction
+
+USER_PREFIX = "plan_check_user_"
+FOREIGN_CURRENCY = "EUR"
+SCANS = ("ALL", "index")
+# Only statements that read rows have plans worth checking
+EXPLAINED = ("SELECT", "INSERT", "UPDATE", "DELETE")
+TABLE_ALIAS = re.compile(
+    r"\b(?:FROM|JOIN|UPDATE|INTO)\s+(\w+)(?:\s+(?:AS\s+)?(?!(?:WHERE|JOIN|ON|GROUP|ORDER|LIMIT|"
+    r"SET|LEFT|INNER|VALUES|SELECT)\b)(\w+))?", re.IGNORECASE)
+
+
+class RecordingDatabase(Database):
+    """Database that keeps the first parameters of every distinct statement run through it"""
+
+    def __init__(self, config):
+        super().__init__(config, retries=0)
+        self.label = None  # the operation being exercised
+        self.statements = {}  # normalized SQL -> (label, SQL, params)
+
+    def record(self, query, params):
+        sql = QUERIES.get(query, query)
+        key = " ".join(sql.split())
+        if key.upper().startswith(EXPLAINED) and "information_schema" not in key:
+            self.statements.setdefault(key, (self.label, sql, adapt_params(params)))
+
+    def fetchall(self, query, params=()):
+        self.record(query, params)
+        return super().fetchall(query, params)
+
+    def fetchone(self, query, params=()):
+        self.record(query, params)
+        return super().fetchone(query, params)
+
+    def execute(self, query, params=()):
+        self.record(query, params)
+        return super().execute(query, params)
+
+    def executemany(self, sql, seq_params):
+        seq_params = list(seq_params)
+        if seq_params:
+            self.record(sql, seq_params[0])
+        return super().executemany(sql, seq_params)
+
+
+def prepare(config, users, rows, reseed):
+    """Create, migrate and seed the check database if needed"""
+    server = {key: value for key, value in config.items() if key != "database"}
+    connection = mysql.connector.connect(**server)
+    try:
+        cursor = connection.cursor()
+        if reseed:
+            cursor.execute(f"DROP DATABASE IF EXISTS `{config['database']}`")
+        cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{config['database']}`")
+    finally:
+        connection.close()
+
+    database = Database(config)
+    try:
+        SchemaMigrations(database).migrate(include_heavy=True)
+        database.execute(
+            "INSERT IGNORE INTO fx_rates (currency, effective_date, rate) VALUES (%s, %s, %s)",
+            (FOREIGN_CURRENCY, date.today() - timedelta(days=400), 1.1))
+        password_hash = bcrypt.hashpw(b"plan_check", bcrypt.gensalt()).decode()
+        rng = random.Random(0)
+        today = date.today()
+        for n in range(1, users + 1):
+            data = FinanceData(database)
+            if data.find_user(f"{USER_PREFIX}{n}"):
+                continue
+            data.user_id = data.create_user(f"{USER_PREFIX}{n}", password_hash)
+            seed = []
+            for _ in range(rows):
+                amount, category, trans_type, day, description = random_transaction(rng, today)
+                currency = FOREIGN_CURRENCY if rng.random() < 0.1 else FX_BASE_CURRENCY
+                seed.append((data.user_id, amount, currency,
+                             data.category_id(category, trans_type), trans_type, day, description))
+            for start in range(0, len(seed), 5000):
+                with database.transaction():
+                    database.executemany(
+                        "INSERT INTO transactions "
+                        "(user_id, amount, currency, category_id, type, date, description) "
+                        "VALUES (%s, %s, %s, %s, %s, %s, %s)", seed[start:start + 5000])
+            print(f"Seeded {USER_PREFIX}{n} with {rows} transactions", flush=True)
+        database.execute("ANALYZE TABLE transactions")
+        return max(count for count, in database.fetchall(
+            "SELECT COUNT(*) FROM transactions GROUP BY user_id"))
+    finally:
+        database.close()
+
+
+def exercise(database, username):
+    """Run the application's queries for one user; returns the failed operations"""
+    today = date.today()
+    this_month = month_start(month_index(today))
+    next_month = month_start(month_index(today) + 1)
+    year_start, year_end = date(today.year, 1, 1), date(today.year + 1, 1, 1)
+    data = FinanceData(database)
+    data.user_id = data.find_user(username)[0]
+    category = data.categories("Expense")[0]
+    snapshot = TransactionSnapshot(data.user_id)
+    state = {}
+
+    def delete_and_undo():
+        data.add_transaction("12.34", category, "Expense", today, "plan_check")
+        newest = max(row[0] for row in data.recent_transactions())
+        undo_key, _ = data.delete_transactions([newest])
+        data.restore_transactions(undo_key)
+        data.delete_transactions([newest])
+
+    def write_behind():
+        # One batch of WriteBehindQueue._flush
+        with database.transaction():
+            database.executemany(WriteBehindQueue.INSERT_SQL, [(
+                data.user_id, Money.of("12.34"), data.reporting_currency(),
+                data.category_id(category, "Expense"), "Expense", today, "plan_check",
+                uuid.uuid4().hex)])
+
+    def recurring():
+        data.add_recurring_rule("5.00", category, "Expense", "1 * *", next_month,
+                                None, "plan_check")
+        state["rules"] = data.recurring_rules()
+
+    operations = [
+        ("login", lambda: data.username_exists(username)),
+        ("snapshot load", lambda: snapshot.load(database)),
+        ("snapshot refresh", lambda: snapshot.refresh(database)),
+        ("categories", lambda: data.categories("Income")),
+        ("currency", lambda: (data.reporting_currency(), data.exchange_rates())),
+        ("transactions list", data.list_transactions),
+        ("transaction totals", data.transaction_totals),
+        ("pdf report", data.report_rows),
+        ("dashboard", lambda: (data.month_totals(), data.month_expenses_by_category(),
+                               data.recent_transactions(), data.budget_total())),
+        ("change poll", data.data_version),
+        ("monthly report", lambda: data.expenses_by_category_between(this_month, next_month)),
+        ("ytd report", data.ytd_expenses_by_category),
+        ("trend report", lambda: data.expense_trend(year_start, year_end)),
+        ("trends", lambda: [data.spending_series(today - timedelta(days=365), next_month, bucket)
+                            for bucket in ("day", "week", "month")]),
+        ("history", lambda: (data.first_transaction_date(),
+                             data.monthly_category_totals(today.year - 1, today.year),
+                             data.category_month_totals(year_start, next_month),
+                             data.history_fingerprint(this_month))),
+        ("budgets", lambda: data.save_budgets(data.budgets())),
+        ("delete and undo", delete_and_undo),
+        ("write-behind", write_behind),
+        ("recurring rules", recurring),
+        ("materialize", lambda: RecurringMaterializer(database).run(next_month, data.user_id)),
+        ("stop rule", lambda: [data.stop_recurring_rule(rule[0]) for rule in state["rules"]]),
+        ("tombstone purge", lambda: database.execute(TombstonePurger.USER_PURGE_SQL, (
+            data.user_id, TombstonePurger.MAX_AGE, TombstonePurger.BATCH_SIZE))),
+        ("purge command", lambda: database.execute(TombstonePurger.PURGE_SQL, (
+            TombstonePurger.MAX_AGE, TombstonePurger.BATCH_SIZE))),
+        ("forecast", lambda: forecast_all(database, today)),
+    ]
+    failed = []
+    for label, operation in operations:
+        database.label = label
+        try:
+            operation()
+        except Exception as err:
+            failed.append(f"{label}: {type(err).__name__}: {err}")
+    return failed
+
+
+def explain(cursor, sql, params):
+    """Return the EXPLAIN rows of a statement as dicts"""
+    cursor.execute("EXPLAIN " + sql, params)
+    return [dict(zip(cursor.column_names, row)) for row in cursor.fetchall()]
+
+
+def judge(plan, sql, max_rows):
+    """Return (access summary, rows examined, problems) of one plan"""
+    tables = {}
+    for table, alias in TABLE_ALIAS.findall(sql):
+        tables[alias or table] = table
+        tables[table] = table
+    access, examined, problems = [], 0, []
+    for row in plan:
+        table = tables.get(row["table"], row["table"])
+        if table is None:  # e.g. "Select tables optimized away"
+            continue
+        access.append(f"{row['table']}:{row['type']}" + (f"({row['key']})" if row["key"] else ""))
+        examined += row["rows"] or 0
+        if table == "transactions" and row["type"] in SCANS:
+            problems.append(f"full {'index ' if row['type'] == 'index' else ''}scan of "
+                            f"transactions ({row['rows']} rows)")
+    if examined > max_rows:
+        problems.append(f"examines about {examined} rows (limit {max_rows})")
+    return " ".join(access) or "-", examined, problems
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--database", default=DB_CONFIG["database"] + "_plan_check",
+                        help="database created for the check (default: %(default)s)")
+    parser.add_argument("--users", type=int, default=20,
+                        help="seeded users (default: %(default)s)")
+    parser.add_argument("--rows", type=int, default=20000,
+                        help="seeded transactions per user (default: %(default)s)")
+    parser.add_argument("--max-rows", type=int,
+                        help="rows a plan may examine (default: twice one user's transactions)")
+    parser.add_argument("--reseed", action="store_true",
+                        help="drop and seed the check database again")
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    args = parser.parse_args()
+
+    config = {**DB_CONFIG, "database": args.database}
+    try:
+        largest = prepare(config, args.users, args.rows, args.reseed)
+    except Error as err:
+        print(f"Cannot prepare {args.database}: {err}", file=sys.stderr)
+        return 2
+    max_rows = args.max_rows or 2 * largest
+
+    database = RecordingDatabase(config)
+    connection = mysql.connector.connect(**config)
+    try:
+        failed = exercise(database, f"{USER_PREFIX}1")
+        cursor = connection.cursor()
+        print(f"{len(database.statements)} statements, limit {max_rows} rows examined\n")
+        failures = [f"operation failed, {message}" for message in failed]
+        for key, (label, sql, params) in database.statements.items():
+            try:
+                plan = explain(cursor, sql, params)
+            except Error as err:
+                failures.append(f"{label}: cannot explain: {err}\n    {key[:200]}")
+                continue
+            access, examined, problems = judge(plan, sql, max_rows)
+            if problems or args.verbose:
+                print(f"{'FAIL' if problems else 'ok':<6}{label:<20}{examined:>9}  {access}")
+                print(f"      {key[:200]}")
+            failures += [f"{label}: {problem}\n    {key[:200]}" for problem in problems]
+    finally:
+        connection.close()
+        database.close()
+
+    if failures:
+        print("\nFAILED:\n  " + "\n  ".join(failures))
+        return 1
+    print(f"OK: no transactions scans, every plan within {max_rows} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
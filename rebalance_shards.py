@@ -0,0 +1,279 @@
+"""Shard directory maintenance: python rebalance_shards.py COMMAND [options]
+
+Users live on the shard databases of main.SHARD_CONFIGS; shard_directory in
+the directory database (DB_CONFIG) records which one holds each username.
+Commands:
+
+  --init                 create and migrate the shard databases and the directory
+  --register             add users already on the shards to the directory
+  --status               users per shard, and how many are off their ring shard
+  --move USERNAME SHARD  move one user to another shard
+  --rebalance            move every user to the shard the hash ring assigns,
+                         e.g. after adding a shard (--dry-run lists the moves)
+  --cleanup              delete the copies an interrupted move left behind
+
+A move copies the user's rows to the target in one transaction, checks the
+counts and sums, switches the directory entry and only then deletes the
+source rows. Transactions, budgets and recurring rules get new ids on the
+target (their client keys are kept); the undo history is not moved. The
+user should not be using the app while being moved.
+
+--databases a,b,c uses databases of those names on the DB_CONFIG server
+instead of SHARD_CONFIGS, to try sharding on a single server.
+"""
+import argparse
+import sys
+from collections import Counter
+
+import mysql.connector
+from mysql.connector import Error
+
+from main import DB_CONFIG, SHARD_CONFIGS, Database, SchemaMigrations, ShardRouter
+
+# Per-user tables copied by a move, parents first; each has id and user_id columns
+COPIED_TABLES = ("budgets", "recurring_rules", "transactions")
+# Per-user tables emptied on the source after a move, children first
+USER_TABLES = ("transactions", "deleted_transactions", "budgets", "recurring_rules",
+               "monthly_totals", "user_data_versions")
+
+
+def shard_configs(databases):
+    if databases:
+        return [{**DB_CONFIG, "database": name} for name in databases.split(",")]
+    return SHARD_CONFIGS or [DB_CONFIG]
+
+
+def columns(database, table):
+    return [row[0] for row in database.fetchall("""
+        SELECT COLUMN_NAME FROM information_schema.COLUMNS
+        WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = %s ORDER BY ORDINAL_POSITION
+    """, (table,))]
+
+
+def insert_sql(table, names, verb="INSERT"):
+    return (f"{verb} INTO {table} ({', '.join(f'`{name}`' for name in names)}) "
+            f"VALUES ({', '.join(['%s'] * len(names))})")
+
+
+def init(router, configs):
+    """Create the shard databases, migrate them and the directory, create shard_directory"""
+    server = {key: value for key, value in DB_CONFIG.items() if key != "database"}
+    for config in [DB_CONFIG] + configs:
+        connection = mysql.connector.connect(
+            **{**server, **{key: value for key, value in config.items() if key != "database"}})
+        try:
+            connection.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{config['database']}`")
+        finally:
+            connection.close()
+    for database in [router.directory] + [shard for shard in router.shards
+                                          if shard is not router.directory]:
+        SchemaMigrations(database).migrate(include_heavy=True)
+        print(f"{database.config['database']}: migrated")
+    router.create_directory()
+    print(f"Directory ready for {len(router.shards)} shards")
+
+
+def register(router):
+    """Add the users found on the shards that have no directory entry yet
+
+    Their ids are kept, so ids must not collide between shards.
+    """
+    added = 0
+    for index, shard in enumerate(router.shards):
+        for user_id, username in shard.fetchall("SELECT id, username FROM users"):
+            location = router.locate(username, cached=False)
+            if location is None:
+                router.register(username, shard=index, user_id=user_id)
+                added += 1
+            elif location[:2] != (user_id, index):
+                print(f"  {username} on shard {index} (id {user_id}) is listed as shard "
+                      f"{location[1]} (id {location[0]}); run --cleanup once moves are done")
+    print(f"Registered {added} users")
+
+
+def status(router):
+    rows = router.directory.fetchall("SELECT username, shard FROM shard_directory")
+    counts = Counter(shard for _, shard in rows)
+    misplaced = Counter(shard for username, shard in rows if router.ring_shard(username) != shard)
+    print(f"{'shard':>5}  {'database':<24}{'users':>8}{'to move':>9}")
+    for index, shard in enumerate(router.shards):
+        name = f"{shard.config.get('host')}/{shard.config.get('database')}"
+        print(f"{index:>5}  {name:<24}{counts[index]:>8}{misplaced[index]:>9}")
+    unknown = sorted(set(counts) - set(range(len(router.shards))))
+    if unknown:
+        print(f"Directory entries point at unconfigured shards: {unknown}")
+
+
+def category_map(source, target, user_id):
+    """Copy the categories the user can see to target; return {source id: target id}"""
+    names = columns(source, "categories")
+    rows = source.fetchall(
+        f"SELECT {', '.join(f'`{name}`' for name in names)} FROM categories "
+        "WHERE user_id IN (0, %s)", (user_id,))
+    copied = [name for name in names if name != "id"]
+    # Built-in categories usually exist already; the unique (user_id, name) skips them
+    target.executemany(insert_sql("categories", copied, "INSERT IGNORE"),
+                       [row[1:] for row in rows])
+    target_ids = {(owner, name): category_id for category_id, owner, name in target.fetchall(
+        "SELECT id, user_id, name FROM categories WHERE user_id IN (0, %s)", (user_id,))}
+    owner, name = names.index("user_id"), names.index("name")
+    return {row[0]: target_ids[row[owner], row[name]] for row in rows}
+
+
+def copy_rows(source, target, table, user_id, categories, after_id, batch):
+    """Copy the user's rows of table with ids above after_id; returns (rows, last id)"""
+    names = columns(source, table)
+    copied = [name for name in names if name != "id"]
+    category = names.index("category_id") if "category_id" in names else None
+    select = (f"SELECT {', '.join(f'`{name}`' for name in names)} FROM {table} "
+              "WHERE user_id = %s AND id > %s ORDER BY id LIMIT %s")
+    count = 0
+    while True:
+        rows = source.fetchall(select, (user_id, after_id, batch))
+        if not rows:
+            return count, after_id
+        if category is not None:
+            rows = [row[:category] + (categories[row[category]],) + row[category + 1:]
+                    for row in rows]
+        target.executemany(insert_sql(table, copied), [row[1:] for row in rows])
+        count += len(rows)
+        after_id = rows[-1][0]
+
+
+def totals(database, user_id):
+    return database.fetchone(
+        "SELECT COUNT(*), COALESCE(SUM(amount), 0) FROM transactions WHERE user_id = %s",
+        (user_id,))
+
+
+def delete_user(database, user_id):
+    """Delete every row of a user from one shard"""
+    migrations = SchemaMigrations(database)
+    with database.transaction():
+        for table in USER_TABLES:
+            if migrations.table_exists(table):
+                database.execute(f"DELETE FROM {table} WHERE user_id = %s", (user_id,))
+        database.execute("DELETE FROM categories WHERE user_id = %s", (user_id,))
+        database.execute("DELETE FROM users WHERE id = %s", (user_id,))
+
+
+def move(router, username, target_index, batch):
+    """Move a user's rows to another shard and point the directory at it"""
+    location = router.locate(username, cached=False)
+    if location is None:
+        raise LookupError(f"{username} is not in the shard directory")
+    user_id, source_index, _ = location
+    if source_index == target_index:
+        return False
+    source, target = router.shards[source_index], router.shards[target_index]
+    if SchemaMigrations(source).applied_versions() != SchemaMigrations(target).applied_versions():
+        raise RuntimeError(f"Shards {source_index} and {target_index} are at different schema "
+                           f"versions; run 'python main.py --migrate' first")
+    if target.fetchone("SELECT 1 FROM users WHERE id = %s", (user_id,)):
+        # Left behind by an interrupted move; the directory still says source
+        delete_user(target, user_id)
+
+    names = columns(source, "users")
+    user = source.fetchone(f"SELECT {', '.join(f'`{name}`' for name in names)} FROM users "
+                           "WHERE id = %s", (user_id,))
+    if user is None:
+        raise LookupError(f"{username} (id {user_id}) is missing from shard {source_index}")
+    with target.transaction():
+        target.execute(insert_sql("users", names), user)
+        categories = category_map(source, target, user_id)
+        last_ids = {table: copy_rows(source, target, table, user_id, categories, 0, batch)[1]
+                    for table in COPIED_TABLES}
+    if totals(source, user_id) != totals(target, user_id):
+        delete_user(target, user_id)
+        raise RuntimeError(f"Copy of {username} does not match the source; nothing was moved")
+    router.set_shard(username, target_index)
+
+    # Rows written through a stale directory lookup while copying
+    with target.transaction():
+        categories = category_map(source, target, user_id)
+        late = sum(copy_rows(source, target, table, user_id, categories, last_ids[table],
+                             batch)[0] for table in COPIED_TABLES)
+    delete_user(source, user_id)
+    print(f"Moved {username} from shard {source_index} to {target_index}"
+          + (f" ({late} late rows)" if late else ""))
+    return True
+
+
+def rebalance(router, batch, dry_run):
+    moves = [(username, shard, router.ring_shard(username)) for username, shard in
+             router.directory.fetchall("SELECT username, shard FROM shard_directory")
+             if router.ring_shard(username) != shard]
+    for username, source, target in moves:
+        if dry_run:
+            print(f"  {username}: {source} -> {target}")
+        else:
+            move(router, username, target, batch)
+    print(f"{len(moves)} users {'to move' if dry_run else 'moved'}")
+
+
+def cleanup(router):
+    """Delete users from shards the directory does not point them at"""
+    removed = 0
+    for index, shard in enumerate(router.shards):
+        for user_id, username in shard.fetchall("SELECT id, username FROM users"):
+            location = router.locate(username, cached=False)
+            if location is not None and location[:2] != (user_id, index):
+                delete_user(shard, user_id)
+                removed += 1
+            elif location is None:
+                print(f"  {username} on shard {index} is not in the directory; see --register")
+    print(f"Removed {removed} stale copies")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_mutually_exclusive_group(required=True)
+    commands.add_argument("--init", action="store_true",
+                          help="create and migrate the databases and the shard directory")
+    commands.add_argument("--register", action="store_true",
+                          help="add the users on the shards to the directory")
+    commands.add_argument("--status", action="store_true", help="show users per shard")
+    commands.add_argument("--move", nargs=2, metavar=("USERNAME", "SHARD"),
+                          help="move one user to the shard with this index")
+    commands.add_argument("--rebalance", action="store_true",
+                          help="move every user to its ring shard")
+    commands.add_argument("--cleanup", action="store_true",
+                          help="delete copies left by interrupted moves")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="with --rebalance, list the moves without making them")
+    parser.add_argument("--databases",
+                        help="comma separated database names on the DB_CONFIG server to use "
+                             "as shards instead of SHARD_CONFIGS")
+    parser.add_argument("--batch", type=int, default=1000,
+                        help="rows copied per statement (default: %(default)s)")
+    args = parser.parse_args()
+
+    configs = shard_configs(args.databases)
+    router = ShardRouter(Database(retries=0), configs)
+    try:
+        if args.init:
+            init(router, configs)
+        elif args.register:
+            register(router)
+        elif args.status:
+            status(router)
+        elif args.move:
+            username, shard = args.move[0], int(args.move[1])
+            if not 0 <= shard < len(router.shards):
+                parser.error(f"SHARD must be between 0 and {len(router.shards) - 1}")
+            if not move(router, username, shard, args.batch):
+                print(f"{username} is already on shard {shard}")
+        elif args.rebalance:
+            rebalance(router, args.batch, args.dry_run)
+        elif args.cleanup:
+            cleanup(router)
+        return 0
+    except (Error, LookupError, RuntimeError) as err:
+        print(f"Failed: {err}", file=sys.stderr)
+        return 1
+    finally:
+        router.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())